@@ -0,0 +1,87 @@
+## Micro-benchmark of tokenize_pgn against the header/move parsing get_gameDict used to do
+## usage: python benchmark_tokenizer.py [pgn files or directories ...]
+## With no arguments it uses the pgn files in data/ and the games in the JSON corpora (rebuilt as pgn from their FENs).
+
+import sys
+import os
+import glob
+import json
+import timeit
+
+import chess
+
+import functions as f
+
+JSON_CORPORA = ['test_data.json', 'Dan_blitz_games.json', 'magnus_bullet_50_games.json', 'magnus_nihal.json', 'rosen_bart.json']
+
+## The parsing get_gameDict did before tokenize_pgn
+def old_tokenize(gamepgn):
+	headers = {}
+	for tag, offset in [('Site', 6), ('White "', 7), ('Black "', 7), ('ECO', 5), ('TimeControl', 13)]:
+		start = gamepgn.find(tag) + offset
+		end = gamepgn.find('"', start)
+		headers[tag] = gamepgn[start:end]
+
+	end_header = gamepgn.rfind("]")
+	move_begin = gamepgn.find('1.', end_header)
+	move_list = gamepgn[move_begin:].split()
+	for move in move_list:
+		if move[0].isdigit(): move_list.remove(move)
+	return headers, move_list
+
+## Rebuilds a pgn string from a game dictionary of the JSON corpora, by finding the move between consecutive FENs
+def gameDict_to_pgn(game_dict):
+	fens = game_dict['board_states_FEN']
+	board = chess.Board(fens[0])
+	movetext = []
+	for fen in fens[1:]:
+		target = fen.split()[0]
+		for move in board.legal_moves:
+			board.push(move)
+			found = board.board_fen() == target
+			board.pop()
+			if found: break
+		else:
+			break
+		if board.turn: movetext.append('%d.' % board.fullmove_number)
+		elif not movetext: movetext.append('%d...' % board.fullmove_number)
+		movetext.append(board.san(move))
+		board.push(move)
+	movetext.append('1-0')
+
+	headers = [('Site', game_dict.get('game_id', '')), ('White', game_dict['white_player']), ('Black', game_dict['black_player']),
+			   ('ECO', game_dict['opening']), ('TimeControl', game_dict['time_control'])]
+	# some of the corpora start after white's first move
+	if fens[0] != chess.STARTING_FEN: headers += [('SetUp', '1'), ('FEN', fens[0])]
+	return '\n'.join('[%s "%s"]' % tag for tag in headers) + '\n\n' + ' '.join(movetext) + '\n'
+
+def load_pgns(paths):
+	pgns = []
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(glob.glob(os.path.join(path, '*.pgn*'))):
+				pgns.extend(f.read_pgn_games(name))
+		elif path.endswith('.json'):
+			pgns.extend(gameDict_to_pgn(game_dict) for game_dict in json.load(open(path)))
+		else:
+			pgns.extend(f.read_pgn_games(path))
+	return pgns
+
+def benchmark(pgns, repeat=5):
+	results = {}
+	for name, tokenize in [('old', old_tokenize), ('tokenize_pgn', f.tokenize_pgn)]:
+		seconds = min(timeit.repeat(lambda: [tokenize(pgn) for pgn in pgns], number=1, repeat=repeat))
+		results[name] = seconds
+		print('%-14s %8.1f us/game' % (name, 1e6 * seconds / len(pgns)))
+	print('speedup %.2fx' % (results['old'] / results['tokenize_pgn']))
+
+	# games where the old parsing got a different move list (ex. skipped tokens or clock comments)
+	different = sum(old_tokenize(pgn)[1] != f.tokenize_pgn(pgn)[1] for pgn in pgns)
+	print('games with different move lists: %d of %d' % (different, len(pgns)))
+	return results
+
+if __name__ == '__main__':
+	paths = sys.argv[1:] or ['data'] + [name for name in JSON_CORPORA if os.path.exists(name)]
+	pgns = load_pgns(paths)
+	print('%d games' % len(pgns))
+	benchmark(pgns)
@@ -0,0 +1,240 @@
+########################################
+### Game corpora
+########################################
+
+### A compact file format for lists of game dictionaries, in place of the json.dump of make_test_data (test_data.json,
+### magnus_nihal.json, ...), which writes every position of every game three times over (8x8 board, FEN and piece lists)
+### and has to be json.load-ed whole.
+###
+### ex. convert_json('magnus_nihal.json', 'magnus_nihal.games')        # once
+###     games = CorpusReader('magnus_nihal.games')
+###     game_dict = games[3]                     # one game, read from its offset
+###     for game_dict in games: ...              # one game at a time
+###     games.read_all()                         # the same list json.load('magnus_nihal.json') gave
+###
+###     with CorpusWriter('konevlad.games') as writer:
+###         for gamepgn in read_pgn_games('konevlad.pgn'): writer.write(get_gameDict(gamepgn))
+###
+### Each game is stored as its headers (every key that isn't a position or a move, as JSON) and one GAME_CACHE_DTYPE
+### record per half move (the bitboards of the position after the move and the move itself, see pack_records),
+### compressed together with zlib (the headers of the older corpora carry most of the game, see below). 'board_states', 'board_states_FEN', 'white_pieces', 'black_pieces' and the move
+### dictionaries are rebuilt from the records when the game is read.
+### The older corpora don't all have the layout get_gameDict has now (ex. test_data.json numbers the squares from 1 and
+### has no piece lists), so a game is only packed if it reads back exactly the same; whatever wouldn't is kept as JSON
+### in the headers, and a converted corpus always reads back as the JSON it came from.
+###
+### The file is
+###     CORPUS_MAGIC, version (uint16), reserved (uint16 and uint32)
+###     one block per game: header length, data length, number of records (uint32 each), then data, the zlib of the
+###     header JSON followed by the records
+###     the index: the offset of each game's block (uint64 each)
+###     footer: number of games, offset of the index (uint64 each), INDEX_MAGIC
+### The footer is written when the writer is closed. A file without one (ex. a writer that didn't finish) can still
+### be read one game at a time, up to its last complete block.
+
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+import functions
+
+CORPUS_MAGIC = b'CHSGAMES'
+INDEX_MAGIC = b'GAMEINDX'
+## Bumped if the layout of the file or of the records changes
+## (version 1 files, which compressed the records only and had the header JSON as it is, are still read)
+CORPUS_VERSION = 2
+
+FILE_HEADER = struct.Struct('<8sHHI')
+BLOCK_HEADER = struct.Struct('<III')
+FOOTER = struct.Struct('<QQ8s')
+
+POSITION_KEYS = ['board_states', 'board_states_FEN', 'white_pieces', 'black_pieces']
+MOVE_KEYS = ['white_moves', 'black_moves']
+
+class CorpusWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(CORPUS_MAGIC, CORPUS_VERSION, 0, 0))
+        self.offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, game_dict):
+        header, records = pack_corpus_game(game_dict)
+        header = json.dumps(header).encode()
+        data = zlib.compress(header + records.tobytes(), 9)
+        self.offsets.append(self.file.tell())
+        self.file.write(BLOCK_HEADER.pack(len(header), len(data), len(records)))
+        self.file.write(data)
+
+    def write_all(self, game_dicts):
+        for game_dict in game_dicts:
+            self.write(game_dict)
+
+    ## Writes the index and the footer
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.offsets, dtype='<u8').tobytes())
+        self.file.write(FOOTER.pack(len(self.offsets), index_offset, INDEX_MAGIC))
+        self.file.close()
+
+class CorpusReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, _, _ = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+            if magic != CORPUS_MAGIC:
+                raise ValueError('%s is not a game corpus' % path)
+            if version not in [1, CORPUS_VERSION]:
+                raise ValueError('%s is a version %d corpus, expected version %d' % (path, version, CORPUS_VERSION))
+            self.version = version
+            self.offsets = self._read_index(f)
+
+    ## The offsets of the games' blocks, from the index if the file has one, else by going over the blocks
+    def _read_index(self, f):
+        size = f.seek(0, os.SEEK_END)
+        if size >= FILE_HEADER.size + FOOTER.size:
+            f.seek(size - FOOTER.size)
+            n_games, index_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic == INDEX_MAGIC:
+                f.seek(index_offset)
+                self.end = index_offset
+                return np.frombuffer(f.read(8 * n_games), dtype='<u8').astype(np.int64)
+        offsets = []
+        offset = FILE_HEADER.size
+        f.seek(offset)
+        while True:
+            block = f.read(BLOCK_HEADER.size)
+            if len(block) < BLOCK_HEADER.size:
+                break
+            header_length, data_length, _ = BLOCK_HEADER.unpack(block)
+            length = data_length + (header_length if self.version == 1 else 0)
+            if offset + BLOCK_HEADER.size + length > size:
+                break
+            offsets.append(offset)
+            offset = f.seek(length, os.SEEK_CUR)
+        self.end = offset
+        return np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+    ## The game dictionary of the i-th game, see get_gameDict for compact
+    def get(self, i, compact=False):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[i])
+            return self._read_block(f, compact)
+
+    ## The games one after another, reading one block at a time
+    def __iter__(self):
+        return self.iter_games()
+
+    def iter_games(self, compact=False):
+        with open(self.path, 'rb') as f:
+            f.seek(FILE_HEADER.size)
+            while f.tell() < self.end:
+                yield self._read_block(f, compact)
+
+    def read_all(self, compact=False):
+        return list(self.iter_games(compact))
+
+    def _read_block(self, f, compact):
+        header_length, data_length, n_records = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+        if self.version == 1:
+            data = f.read(header_length) + zlib.decompress(f.read(data_length))
+        else:
+            data = zlib.decompress(f.read(data_length))
+        header = json.loads(data[:header_length])
+        records = np.frombuffer(data, dtype=functions.GAME_CACHE_DTYPE, count=n_records, offset=header_length)
+        return unpack_corpus_game(header, records, compact)
+
+## (header, records) of a game dictionary for a corpus
+## The header has the keys that aren't rebuilt from the records, and the keys the records would not give back exactly
+## under '_raw' (None for a key the game dictionary didn't have)
+def pack_corpus_game(game_dict):
+    header = {key: value for key, value in game_dict.items()
+              if key not in POSITION_KEYS + MOVE_KEYS and key not in ['positions', '_derived', 'packed']}
+    try:
+        # (on a copy, so the move table isn't left in the game dictionary, see GameIndices)
+        records = functions.pack_records(dict(game_dict))
+    except (ValueError, KeyError, TypeError, IndexError):
+        records = np.zeros(0, dtype=functions.GAME_CACHE_DTYPE)
+    rebuilt = as_json(_rebuild(records, False))
+    raw = {}
+    for key in POSITION_KEYS + MOVE_KEYS:
+        value = as_json(game_dict[key]) if key in game_dict else None
+        if value != rebuilt[key]:
+            raw[key] = value
+    if len(raw) == len(POSITION_KEYS + MOVE_KEYS):
+        records = records[:0]
+    if raw:
+        header['_raw'] = raw
+    return header, records
+
+## The game dictionary of a corpus game
+def unpack_corpus_game(header, records, compact=False):
+    game_dict = dict(header)
+    raw = game_dict.pop('_raw', {})
+    # (the positions of a game with raw keys don't all come from the records, so it can't be compact)
+    game_dict.update(_rebuild(records, compact and not raw, skip=raw))
+    for key, value in raw.items():
+        if value is not None:
+            game_dict[key] = value
+    return game_dict
+
+## The moves and positions of the records, but for the keys in skip
+def _rebuild(records, compact, skip=()):
+    game_dict = {}
+    if not all(key in skip for key in MOVE_KEYS):
+        game_dict.update(functions.unpack_moves(records))
+    functions.set_positions(game_dict, functions.record_positions(records), True)
+    if not compact:
+        del game_dict['positions']
+        for key in POSITION_KEYS:
+            if key not in skip:
+                game_dict[key] = list(game_dict[key])
+    for key in skip:
+        game_dict.pop(key, None)
+    return game_dict
+
+## The value as json.load would give it back (ex. tuples become lists)
+def as_json(value):
+    return json.loads(json.dumps(value))
+
+########################################
+### Converters
+########################################
+
+## Converts a JSON corpus (a json.dump of a list of game dictionaries, ex. test_data.json) to a corpus file
+def convert_json(json_path, corpus_path):
+    with open(json_path) as f:
+        game_dicts = json.load(f)
+    with CorpusWriter(corpus_path) as writer:
+        writer.write_all(game_dicts)
+    return len(game_dicts)
+
+## Writes a corpus file back out as a JSON corpus
+def export_json(corpus_path, json_path):
+    game_dicts = [as_json(game_dict) for game_dict in CorpusReader(corpus_path)]
+    with open(json_path, 'w') as f:
+        json.dump(game_dicts, f)
+    return len(game_dicts)
+
+## Reads a corpus of either kind, by its extension (.json or not)
+def load_corpus(path, compact=False):
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    return CorpusReader(path).read_all(compact)
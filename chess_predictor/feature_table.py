@@ -0,0 +1,476 @@
+########################################
+### Feature table
+########################################
+
+### FeatureTable is a column store for the output of get_features: one numpy array per feature, plus the game_id and
+### white_player of each row. It is the fast replacement for the 100 csvs in data/, which Summary.ipynb reads with
+### pd.read_csv one by one and pd.concats.
+###
+### ex. table = FeatureTable.from_csvs(glob.glob('data/*.csv'))     # once
+###     table.save('features')
+###     df = FeatureTable.load('features').to_dataframe()           # later on, the whole corpus
+###     df = FeatureTable.load('features', players=['Konevlad', 'AdriD']).to_dataframe()
+###
+###     table = FeatureTable()
+###     for gamepgn in read_pgn_games('games.pgn'): table.append(get_features(get_gameDict(gamepgn)))
+###
+### Columns are float32, except the flags, sides and opening codes of functions.FEATURE_SCHEMA (INT8_COLUMNS), which are int8.
+### A missing value is NaN in a float32 column and INT8_MISSING in an int8 column (to_numpy turns both into NaN,
+### to_dataframe gives the columns their schema dtypes, see functions.apply_schema).
+### The arrays are allocated ahead of time and doubled when they fill up, so append doesn't copy the table every row.
+###
+### save writes a directory with one .npy per column and a manifest.json of the column names and dtypes.
+### load memory maps the .npy files, so only the rows and columns that are used are read from disk.
+### A path ending in .parquet is written/read with pandas instead (this needs pyarrow).
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import functions
+
+## The columns that aren't features
+ID_COLUMNS = functions.ID_COLUMNS
+
+## Features that only take small integer values (flags, -1/0/1 sides and the ECO letters and numbers)
+INT8_COLUMNS = [column for column, (dtype, low, high, missing) in functions.FEATURE_SCHEMA.items() if dtype in ['bool', 'int8']]
+INT8_MISSING = -128
+
+def column_dtype(column):
+    if column in INT8_COLUMNS:
+        return np.dtype(np.int8)
+    return np.dtype(np.float32)
+
+class FeatureTable:
+    ## columns : the feature names (in order), taken from the first row appended if not given
+    def __init__(self, columns=None, capacity=1024):
+        self.columns = None
+        self.n_rows = 0
+        self.capacity = capacity
+        self.players = []
+        self.player_codes = {}
+        if columns is not None:
+            self._allocate(list(columns))
+
+    def _allocate(self, columns):
+        self.columns = [column for column in columns if column not in ID_COLUMNS]
+        self.data = {column: self._empty(column_dtype(column), self.capacity) for column in self.columns}
+        self.game_ids = np.empty(self.capacity, dtype=object)
+        self.player = np.empty(self.capacity, dtype=np.int16)
+
+    @staticmethod
+    def _empty(dtype, n):
+        if dtype == np.int8:
+            return np.full(n, INT8_MISSING, dtype=dtype)
+        return np.full(n, np.nan, dtype=dtype)
+
+    def __len__(self):
+        return self.n_rows
+
+    ## Doubles the arrays until n_rows more rows fit
+    def _reserve(self, n_rows):
+        if self.n_rows + n_rows <= self.capacity:
+            return
+        capacity = self.capacity
+        while self.n_rows + n_rows > capacity:
+            capacity *= 2
+        for column in self.columns:
+            grown = self._empty(self.data[column].dtype, capacity)
+            grown[:self.n_rows] = self.data[column][:self.n_rows]
+            self.data[column] = grown
+        for name in ['game_ids', 'player']:
+            grown = np.empty(capacity, dtype=getattr(self, name).dtype)
+            grown[:self.n_rows] = getattr(self, name)[:self.n_rows]
+            setattr(self, name, grown)
+        self.capacity = capacity
+
+    def _player_code(self, player):
+        if player not in self.player_codes:
+            self.player_codes[player] = len(self.players)
+            self.players.append(player)
+        return self.player_codes[player]
+
+    ## Appends one row, a dict of get_features (missing features are left missing)
+    def append(self, features):
+        if self.columns is None:
+            self._allocate(list(features))
+        self._reserve(1)
+        i = self.n_rows
+        for column in self.columns:
+            value = features.get(column)
+            if value is not None and value == value:
+                self.data[column][i] = self._check(column, value)
+        self.game_ids[i] = features.get('game_id', '')
+        self.player[i] = self._player_code(features.get('white_player', ''))
+        self.n_rows += 1
+
+    def extend(self, rows):
+        for features in rows:
+            self.append(features)
+
+    ## Makes sure a value fits its column (FEATURE_SCHEMA, and an int8 column rather than letting numpy wrap it around)
+    def _check(self, column, value):
+        functions.check_features({column: value})
+        if self.data[column].dtype == np.int8 and not (value == int(value) and -127 <= value <= 127):
+            raise ValueError('%s=%r does not fit an int8 column' % (column, value))
+        return value
+
+    ## Appends the rows of a DataFrame with the columns of get_features (ex. from extract_features or a data/ csv)
+    def append_dataframe(self, df):
+        if self.columns is None:
+            self._allocate(list(df.columns))
+        self._reserve(len(df))
+        rows = slice(self.n_rows, self.n_rows + len(df))
+        for column in self.columns:
+            if column not in df:
+                continue
+            values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+            if self.data[column].dtype == np.int8:
+                missing = np.isnan(values)
+                present = values[~missing]
+                if len(present) and ((present != np.round(present)).any() or np.abs(present).max() > 127):
+                    raise ValueError('%s has values that do not fit an int8 column' % column)
+                values = np.where(missing, INT8_MISSING, values)
+            self.data[column][rows] = values
+        # (rows of games that failed have no game_id or player, those are left as '')
+        self.game_ids[rows] = df['game_id'].fillna('').to_numpy(dtype=object) if 'game_id' in df else ''
+        players = df['white_player'].fillna('') if 'white_player' in df else [''] * len(df)
+        self.player[rows] = [self._player_code(player) for player in players]
+        self.n_rows += len(df)
+
+    @classmethod
+    def from_dataframe(cls, df):
+        table = cls(df.columns, capacity=max(len(df), 1))
+        table.append_dataframe(df)
+        return table
+
+    ## Reads the csvs written by extract_features / the notebooks (ex. glob.glob('data/*.csv')) into one table
+    @classmethod
+    def from_csvs(cls, paths):
+        table = None
+        for path in paths:
+            df = pd.read_csv(path)
+            if table is None:
+                table = cls(df.columns)
+            table.append_dataframe(df)
+        return table
+
+    ## The array of a column (the first len(self) rows, not a copy)
+    def column(self, column):
+        if column == 'game_id':
+            return self.game_ids[:self.n_rows]
+        if column == 'white_player':
+            return np.array(self.players, dtype=object)[self.player[:self.n_rows]]
+        return self.data[column][:self.n_rows]
+
+    ## Boolean mask of the rows of the given players
+    def player_rows(self, players):
+        codes = [self.player_codes[player] for player in players if player in self.player_codes]
+        return np.isin(self.player[:self.n_rows], codes)
+
+    ## A new table with only the rows of the given players
+    def select(self, players):
+        rows = np.flatnonzero(self.player_rows(players))
+        table = FeatureTable(self.columns, capacity=max(len(rows), 1))
+        for column in self.columns:
+            table.data[column][:len(rows)] = self.data[column][rows]
+        table.game_ids[:len(rows)] = self.game_ids[rows]
+        for row, code in enumerate(self.player[rows]):
+            table.player[row] = table._player_code(self.players[code])
+        table.n_rows = len(rows)
+        return table
+
+    ## float32 matrix of the given feature columns (all of them by default), with the missing int8 values as NaN
+    def to_numpy(self, columns=None):
+        columns = columns or self.columns
+        matrix = np.empty((self.n_rows, len(columns)), dtype=np.float32)
+        for j, column in enumerate(columns):
+            values = self.data[column][:self.n_rows]
+            matrix[:, j] = values
+            if values.dtype == np.int8:
+                matrix[values == INT8_MISSING, j] = np.nan
+        return matrix
+
+    ## DataFrame in the same layout as the data/ csvs (game_id, white_player, then the features), in the schema's dtypes
+    def to_dataframe(self):
+        df = pd.DataFrame(self.to_numpy(), columns=self.columns)
+        df.insert(0, 'white_player', self.column('white_player'))
+        df.insert(0, 'game_id', self.column('game_id'))
+        return functions.apply_schema(df)
+
+    def save(self, path):
+        if path.endswith('.parquet'):
+            self.to_dataframe().to_parquet(path, index=False)
+            return
+        os.makedirs(path, exist_ok=True)
+        manifest = {'n_rows': self.n_rows, 'players': self.players,
+                    'columns': [{'name': column, 'dtype': self.data[column].dtype.str, 'file': 'column_%03d.npy' % j}
+                                for j, column in enumerate(self.columns)]}
+        for entry in manifest['columns']:
+            np.save(os.path.join(path, entry['file']), self.data[entry['name']][:self.n_rows])
+        np.save(os.path.join(path, 'player.npy'), self.player[:self.n_rows])
+        np.save(os.path.join(path, 'game_id.npy'), self.game_ids[:self.n_rows].astype(str))
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    ## Reads a table written by save, only the rows of players if it is given
+    ## The columns stay memory mapped (read only) when every row is loaded
+    @classmethod
+    def load(cls, path, players=None, columns=None):
+        if path.endswith('.parquet'):
+            df = pd.read_parquet(path)
+            if players is not None:
+                df = df[df['white_player'].isin(players)]
+            if columns is not None:
+                df = df[ID_COLUMNS + list(columns)]
+            return cls.from_dataframe(df)
+
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        entries = manifest['columns']
+        if columns is not None:
+            entries = [entry for entry in entries if entry['name'] in columns]
+
+        table = cls.__new__(cls)
+        table.columns = [entry['name'] for entry in entries]
+        table.players = manifest['players']
+        table.player_codes = {player: code for code, player in enumerate(table.players)}
+        table.player = np.load(os.path.join(path, 'player.npy'), mmap_mode='r')
+        table.game_ids = np.load(os.path.join(path, 'game_id.npy'), mmap_mode='r')
+        table.data = {entry['name']: np.load(os.path.join(path, entry['file']), mmap_mode='r') for entry in entries}
+        table.n_rows = table.capacity = manifest['n_rows']
+        if players is not None:
+            table = table.select(players)
+        else:
+            # appending to a loaded table needs arrays of its own
+            table.game_ids = table.game_ids.astype(object)
+        return table
+
+########################################
+### Feature store
+########################################
+
+### FeatureStore keeps the whole corpus of features in one directory: a float32 matrix (rows x features) in one
+### contiguous file, the player of each row, the game_id of each row and a manifest.json of the column names.
+### The files are memory mapped, so opening the store doesn't read it, and more rows (ex. a new player's csv) are
+### appended at the end of the files rather than rewriting them.
+###
+### ex. store = FeatureStore.from_csvs('features.store', glob.glob('data/*.csv'))     # once
+###     store = FeatureStore('features.store')                                       # later on
+###     X = store.matrix                                     # (n_rows, n_features), memory mapped
+###     X = store.select(players=['Konevlad'], columns=['wn_mobility', 'wn_pair'])
+###     store.append_dataframe(pd.read_csv('data/new_player.csv'))
+###
+### Slicing doesn't copy when it can be done with a view of the matrix: the rows of a player (the rows a player was
+### appended with are kept together), of a run of rows, and a run of adjacent columns. Other selections are copied.
+### Rows appended for a player later on (ex. by ingest.refresh_players) go at the end of the files, away from the
+### player's other rows, so their selections are copied until compact() puts each player's rows back together.
+### Every column is float32 in the matrix (the int8 columns of FeatureTable included), a missing value is NaN;
+### to_dataframe gives the columns their schema dtypes (see functions.apply_schema).
+
+## Bumped if the layout of the files changes
+STORE_VERSION = 1
+## game_ids are stored as fixed width bytes, longer ones are refused
+GAME_ID_WIDTH = 64
+
+class FeatureStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != STORE_VERSION:
+            raise ValueError('%s is a version %d store, expected version %d' % (path, manifest['version'], STORE_VERSION))
+        self.columns = manifest['columns']
+        self.column_index = {column: j for j, column in enumerate(self.columns)}
+        self.players = manifest['players']
+        self.player_codes = {player: code for code, player in enumerate(self.players)}
+        self.game_id_dtype = np.dtype('S%d' % manifest['game_id_width'])
+        self.n_rows = manifest['n_rows']
+        self._map()
+
+    ## Makes a new, empty store of the given feature columns (the id columns are left out)
+    @classmethod
+    def create(cls, path, columns, game_id_width=GAME_ID_WIDTH):
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            raise FileExistsError('%s already has a feature store' % path)
+        os.makedirs(path, exist_ok=True)
+        for name in ['features.f32', 'player.i32', 'game_id.bin']:
+            open(os.path.join(path, name), 'wb').close()
+        manifest = {'version': STORE_VERSION, 'n_rows': 0, 'game_id_width': game_id_width, 'players': [],
+                    'columns': [column for column in columns if column not in ID_COLUMNS]}
+        cls._write_manifest(path, manifest)
+        return cls(path)
+
+    ## Reads the csvs written by extract_features / the notebooks (ex. glob.glob('data/*.csv')) into a new store
+    @classmethod
+    def from_csvs(cls, path, paths):
+        store = None
+        for csv_path in paths:
+            df = pd.read_csv(csv_path)
+            if store is None:
+                store = cls.create(path, df.columns)
+            store.append_dataframe(df)
+        return store
+
+    @staticmethod
+    def _write_manifest(path, manifest):
+        # written aside and renamed, so a store is never left with half a manifest
+        temp = os.path.join(path, 'manifest.json.tmp')
+        with open(temp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp, os.path.join(path, 'manifest.json'))
+
+    ## (Re)maps the files, for the n_rows of the manifest
+    def _map(self):
+        n_rows = self.n_rows
+        self.matrix = self._memmap('features.f32', np.float32, (n_rows, len(self.columns)))
+        self.player = self._memmap('player.i32', np.int32, (n_rows,))
+        self.game_ids = self._memmap('game_id.bin', self.game_id_dtype, (n_rows,))
+        self._segments = None
+        self._game_rows = None
+
+    def _memmap(self, name, dtype, shape):
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, game_id):
+        return game_id in self.game_rows()
+
+    def _player_code(self, player):
+        if player not in self.player_codes:
+            self.player_codes[player] = len(self.players)
+            self.players.append(player)
+        return self.player_codes[player]
+
+    ## Appends the rows of a DataFrame with the columns of get_features (ex. from extract_features or a data/ csv)
+    def append_dataframe(self, df):
+        matrix = np.full((len(df), len(self.columns)), np.nan, dtype=np.float32)
+        for j, column in enumerate(self.columns):
+            if column in df:
+                matrix[:, j] = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        # (rows of games that failed have no game_id or player, those are left as '')
+        game_ids = df['game_id'].fillna('') if 'game_id' in df else [''] * len(df)
+        players = df['white_player'].fillna('') if 'white_player' in df else [''] * len(df)
+        self._append(matrix, players, game_ids)
+
+    ## Appends rows of get_features (dicts, missing features are left missing)
+    def append(self, rows):
+        rows = list(rows)
+        matrix = np.full((len(rows), len(self.columns)), np.nan, dtype=np.float32)
+        for i, features in enumerate(rows):
+            for j, column in enumerate(self.columns):
+                value = features.get(column)
+                if value is not None:
+                    matrix[i, j] = value
+        self._append(matrix, [features.get('white_player', '') for features in rows],
+                     [features.get('game_id', '') for features in rows])
+
+    ## Appends a FeatureTable (its columns are matched by name)
+    def append_table(self, table):
+        self.append_dataframe(table.to_dataframe())
+
+    def _append(self, matrix, players, game_ids):
+        game_ids = [str(game_id) for game_id in game_ids]
+        too_long = [game_id for game_id in game_ids if len(game_id.encode()) > self.game_id_dtype.itemsize]
+        if too_long:
+            raise ValueError('game_id %r is longer than the %d bytes of the store' % (too_long[0], self.game_id_dtype.itemsize))
+        codes = np.array([self._player_code(str(player)) for player in players], dtype=np.int32)
+        # anything past n_rows was left by an append that didn't get to write the manifest
+        for name, data, itemsize in [('features.f32', matrix, 4 * len(self.columns)), ('player.i32', codes, 4),
+                                     ('game_id.bin', np.array(game_ids, dtype=self.game_id_dtype), self.game_id_dtype.itemsize)]:
+            with open(os.path.join(self.path, name), 'r+b') as f:
+                f.truncate(self.n_rows * itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(data).tobytes())
+        self.n_rows += len(codes)
+        self._write_manifest(self.path, {'version': STORE_VERSION, 'n_rows': self.n_rows, 'columns': self.columns,
+                                         'game_id_width': self.game_id_dtype.itemsize, 'players': self.players})
+        self._map()
+
+    ## Rewrites the files with the rows of each player together (in the order the players were added, a player's rows in
+    ## the order they were appended), so every player's rows are a view again. Returns False if they all were already.
+    ## The new files are written aside, a block of rows at a time, and then renamed over the old ones.
+    def compact(self, block_size=65536):
+        segments = self.segments()
+        if all(len(runs) <= 1 for runs in segments.values()):
+            return False
+        names = [('features.f32', self.matrix), ('player.i32', self.player), ('game_id.bin', self.game_ids)]
+        files = [open(os.path.join(self.path, name + '.compact'), 'wb') for name, data in names]
+        try:
+            for player in self.players:
+                for start, stop in segments.get(player, []):
+                    for block in range(start, stop, block_size):
+                        for f, (name, data) in zip(files, names):
+                            f.write(np.ascontiguousarray(data[block:min(block + block_size, stop)]).tobytes())
+        finally:
+            for f in files:
+                f.close()
+        # (the maps of the old files are let go before they are replaced)
+        self.matrix = self.player = self.game_ids = names = None
+        for name in ['features.f32', 'player.i32', 'game_id.bin']:
+            os.replace(os.path.join(self.path, name + '.compact'), os.path.join(self.path, name))
+        self._map()
+        return True
+
+    ## {player: [(start, stop), ...]}, the runs of rows of each player
+    def segments(self):
+        if self._segments is None:
+            self._segments = {}
+            player = np.asarray(self.player)
+            starts = np.flatnonzero(np.r_[True, player[1:] != player[:-1]]) if len(player) else np.array([], dtype=int)
+            stops = np.r_[starts[1:], len(player)]
+            for start, stop in zip(starts, stops):
+                self._segments.setdefault(self.players[player[start]], []).append((int(start), int(stop)))
+        return self._segments
+
+    ## {game_id: row}
+    def game_rows(self):
+        if self._game_rows is None:
+            self._game_rows = {game_id.decode(): row for row, game_id in enumerate(self.game_ids)}
+        return self._game_rows
+
+    ## {(game_id, player)} of every row, to tell whether a game's row is in the store already
+    def row_keys(self):
+        return set(zip(np.char.decode(np.asarray(self.game_ids)).tolist(), self.row_players().tolist()))
+
+    ## The rows of the given players: a slice when they are one run of rows, else an array of row numbers
+    def player_rows(self, players):
+        runs = sorted(run for player in players for run in self.segments().get(player, []))
+        if not runs:
+            return slice(0, 0)
+        if all(stop == next_start for (_, stop), (next_start, _) in zip(runs, runs[1:])):
+            return slice(runs[0][0], runs[-1][1])
+        return np.concatenate([np.arange(start, stop) for start, stop in runs])
+
+    ## The columns given by name: a slice when they are adjacent in the store (in the store's order), else their indices
+    def column_positions(self, columns):
+        positions = [self.column_index[column] for column in columns]
+        if positions and positions == list(range(positions[0], positions[-1] + 1)):
+            return slice(positions[0], positions[-1] + 1)
+        return positions
+
+    ## The matrix of the given players and columns (all of them by default), a view of the file when it can be
+    def select(self, players=None, columns=None):
+        rows = slice(None) if players is None else self.player_rows(players)
+        matrix = self.matrix[rows]
+        if columns is not None:
+            matrix = matrix[:, self.column_positions(columns)]
+        return matrix
+
+    ## The player of each of the given rows
+    def row_players(self, rows=slice(None)):
+        return np.array(self.players, dtype=object)[self.player[rows]]
+
+    ## DataFrame in the same layout as the data/ csvs (game_id, white_player, then the features), in the schema's dtypes
+    def to_dataframe(self, players=None, columns=None):
+        rows = slice(None) if players is None else self.player_rows(players)
+        df = pd.DataFrame(self.select(players, columns), columns=self.columns if columns is None else list(columns))
+        df.insert(0, 'white_player', self.row_players(rows))
+        df.insert(0, 'game_id', np.char.decode(np.asarray(self.game_ids[rows])).astype(object))
+        return functions.apply_schema(df)
@@ -9,15 +9,28 @@ import pandas as pd
 
 ## Need this to work with chess data
 import chess.pgn
-from lichess.format import SINGLE_PGN
+from lichess.format import SINGLE_PGN, PGN
 import lichess.api
 
+## For reading compressed pgn files (the lichess database dumps)
+import bz2
+import io
+
 ## Need this to save the test data
 import json
 
+## For tokenizing pgn movetext
+import re
+
 ## For error handling
 import sys
 
+## For extracting features from many games at once
+import os
+from multiprocessing import Pool
+from collections import deque, OrderedDict
+import itertools
+
 ########################################
 ### Gobal Variables
 ########################################
@@ -39,14 +52,143 @@ def get_dicts(player_name, num_games, time_type, format_):
     return [get_gameDict(game) for game in games_list]
 
 ## This will generates a JSON of the test_data to be created of the games of a player, in the quantity given by num_games
+## A file_name that doesn't end in .json is written as a corpus file instead (much smaller, see corpus.py)
 def make_test_data(file_name, player_name, num_games, time_type):
+    if not file_name.endswith('.json'):
+        import corpus
+        with corpus.CorpusWriter(file_name) as writer:
+            writer.write_all(get_dicts(player_name, num_games, time_type, SINGLE_PGN))
+        return
     with open(file_name, 'w') as f:
         json.dump(get_dicts(player_name, num_games, time_type, SINGLE_PGN), f)
 
+### Streaming games
+### The functions below read games one at a time, so memory stays constant no matter how many games there are.
+### This lets us run over the monthly lichess database dumps (https://database.lichess.org) and not just
+### the ~1000 games per player that fit in a single api response.
+###
+### ex. for game_dict in iter_gameDicts(read_pgn_games('lichess_db_standard_rated_2020-05.pgn.zst')): ...
+###     for game_dict in iter_gameDicts(stream_user_games('Konevlad', 1000, 'blitz')): ...
+
+## Opens a local pgn file as a text stream, decompressing .bz2 and .zst files on the fly
+def open_pgn(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.zst'):
+        # zstandard is only needed for the .zst dumps, so we only import it here
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    else:
+        return open(path, encoding='utf-8')
+
+## Splits a stream of lines into pgn strings, yielding one game at a time
+## A new game starts at the first tag line ('[...') after some movetext
+def split_pgn_lines(lines):
+    buffer = []
+    in_moves = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('['):
+            if in_moves:
+                yield '\n'.join(buffer).strip()
+                buffer = []
+                in_moves = False
+        elif line.strip():
+            in_moves = True
+        buffer.append(line)
+    # The last game in the stream
+    if in_moves:
+        yield '\n'.join(buffer).strip()
+
+## Generator of pgn strings, one per game
+## source can be a path to a .pgn, .pgn.bz2 or .pgn.zst file, or any iterable of lines (such as an open file)
+def read_pgn_games(source):
+    if isinstance(source, str):
+        with open_pgn(source) as f:
+            yield from split_pgn_lines(f)
+    else:
+        yield from split_pgn_lines(source)
+
+## Generator of pgn strings for a player's games, streamed from the lichess api as they download
+def stream_user_games(player_name, num_games, time_type, **kwargs):
+    return lichess.api.user_games(player_name, max=num_games, perfType=time_type, format=PGN, **kwargs)
+
+## Generator of game dictionaries from an iterable of pgn strings (ex. read_pgn_games or stream_user_games)
+## If a GameCache is given, games already in it are read from it instead of being parsed again
+def iter_gameDicts(pgns, cache=None):
+    for gamepgn in pgns:
+        if cache is not None:
+            yield cache.get_gameDict(gamepgn)
+        else:
+            yield get_gameDict(gamepgn)
+
+## Generator of feature dictionaries from an iterable of pgn strings
+## Like the loop in Summary.ipynb, only games that make it to the middle game are kept
+## With both_colors, each game also gives black's row (see mirror_game), right after white's
+## only : the feature columns to compute (see get_features)
+def iter_features(pgns, cache=None, both_colors=False, only=None):
+    for game_dict in iter_gameDicts(pgns, cache):
+        yield from game_features(game_dict, both_colors, only)
+
+## The feature rows of a game dictionary: white's (if it reaches the middle game), and black's too with both_colors
+## (raises ValueError for a row that doesn't fit FEATURE_SCHEMA, see check_features)
+def game_features(game_dict, both_colors=False, only=None):
+    rows = []
+    if game_dict['middle_game_index']:
+        rows.append(check_features(get_features(game_dict, only)))
+    if both_colors:
+        mirrored = mirror_game(game_dict)
+        if mirrored is not None and mirrored['middle_game_index']:
+            rows.append(check_features(get_features(mirrored, only)))
+    return rows
+
 ########################################
 ### Processing Data
 ########################################        
 
+### tokenize_pgn(gamepgn)
+### input: pgn string of one game
+### output: (headers, moves)
+###	headers: dict of the tag pairs, ex. {'White': 'DrNykterstein', 'Site': 'https://lichess.org/abc12345', ...}
+###	moves: list of the SAN strings of the main line, ex. ['e4', 'e5', 'Nf3', ...]
+### Everything is found in one pass over the string: move numbers ("1." and "1..."), results, comments ({...} and ;...),
+### NAGs ($1), move annotations (!, ?, !?) and variations ((...), which can nest) are all left out of moves.
+
+PGN_TAG_REGEX = re.compile(r'\s*\[\s*([A-Za-z0-9_]+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+PGN_COMMENT_REGEX = re.compile(r'\{[^}]*\}|;[^\n]*|^%[^\n]*', re.MULTILINE)
+PGN_VARIATION_REGEX = re.compile(r'([()])')
+### a SAN move starts with a piece, a pawn's file or O (castling), which no move number, result or NAG does
+PGN_SAN_REGEX = re.compile(r'[NBRQKOa-h][^\s{}();$!?]*')
+
+def tokenize_pgn(gamepgn):
+	#reads the tag pairs at the top of the pgn
+	headers = {}
+	position = 0
+	tag = PGN_TAG_REGEX.match(gamepgn)
+	while tag:
+		value = tag.group(2)
+		if '\\' in value: value = re.sub(r'\\(.)', r'\1', value)
+		headers[tag.group(1)] = value
+		position = tag.end()
+		tag = PGN_TAG_REGEX.match(gamepgn, position)
+	movetext = gamepgn[position:]
+
+	#takes out the comments, then the variations
+	if '{' in movetext or ';' in movetext or '%' in movetext:
+		movetext = PGN_COMMENT_REGEX.sub(' ', movetext)
+	if '(' in movetext:
+		main_line = []
+		depth = 0
+		for piece in PGN_VARIATION_REGEX.split(movetext):
+			if piece == '(': depth += 1
+			elif piece == ')': depth = max(depth - 1, 0)
+			elif depth == 0: main_line.append(piece)
+		movetext = ' '.join(main_line)
+
+	moves = PGN_SAN_REGEX.findall(movetext)
+	return headers, moves
+
 
 ### The get_gameDict function reads in a lichess pgn string and returns a game dictionary
 
@@ -65,10 +207,11 @@ def make_test_data(file_name, player_name, num_games, time_type):
 ###     ex. The first entry is {'P': [(rank,file),...], 'N': [...], ...}
 ### 'black_pieces': same as white_pieces, but for black's pieces
 ### middle_game_index: returns an int corresponding to the first half move of the mid-game. The middle game is defined to start when there are 10 or fewer minor/major pieces, or 
-###	when the back rank of each player has four or fewer pieces. 
+###	when the back rank of each player has three or fewer minor/major pieces. 
 ###	If the game is too short to reach mid-game, the index is None.
 ### end_game_index: returns an int corresponding to the first half move of the endgame. The end game is defined to start when there are 6 or fewer minor/major pieces on the board.
 ###	If the game is too short to reach endgame, the index in None.
+###	(the limits are PHASE_THRESHOLDS, see segment_phases to split games with other ones)
 
 ### move dictionary
 ### the move dictionary has the following keys
@@ -85,45 +228,36 @@ def make_test_data(file_name, player_name, num_games, time_type):
 ### board_states
 ### 8x8 array of strings. board_state[file][rank] gives piece, uppercase for white, lowercase for black
 
-def get_gameDict(gamepgn):
+### compact game dictionary
+### get_gameDict(gamepgn, compact=True) stores the positions once, in a GamePositions object under the key 'positions'
+### (documentation below), and 'board_states', 'board_states_FEN', 'white_pieces' and 'black_pieces' are read-only views
+### that build each entry from it on demand. The feature functions work on either kind of game dictionary, but
+### a compact one can't be written out with json.dump.
+
+def get_gameDict(gamepgn, compact=False):
 	#creates the game dictionary
 	gameDict = {'white_moves' : [], 'black_moves' :[], 'board_states' :[], 'board_states_FEN' :[], 'white_pieces': [], 'black_pieces': [],'middle_game_index' : None, 'end_game_index' : None }
 
 	try:
+		# splits the pgn into the header tags and the SAN moves of the main line
+		headers, move_list = tokenize_pgn(gamepgn)
+
 		# reads in url
-		url_start = gamepgn.find('Site') +6
-		url_end = gamepgn.find('"', url_start)
-		gameDict['game_id'] = gamepgn[url_start: url_end]
+		gameDict['game_id'] = headers.get('Site', '')
 
 		#reads in white_player
-		name_start = gamepgn.find('White "') +7
-		name_end = gamepgn.find('"', name_start)
-		gameDict["white_player"] = gamepgn[name_start :name_end]
+		gameDict["white_player"] = headers.get('White', '')
 		
 		#reads in black_player
-		name_start = gamepgn.find('Black "') +7
-		name_end = gamepgn.find('"', name_start)
-		gameDict["black_player"] = gamepgn[name_start :name_end]
+		gameDict["black_player"] = headers.get('Black', '')
 
 		#reads in opening
-		name_start = gamepgn.find('ECO') + 5
-		name_end = gamepgn.find('"', name_start)
-		gameDict["opening"] = gamepgn[name_start:name_end]
+		gameDict["opening"] = headers.get('ECO', '')
 		
 		#reads in time_control
-		name_start = gamepgn.find('TimeControl') +13
-		name_end = gamepgn.find('"', name_start)
-		gameDict["time_control"] = gamepgn[name_start:name_end]
-
-		### The following iterates strips the pgn to the moves only then iterates through
-		### the moves and creates board states and move dictionary
-		# strips pgn to moves
-		end_header = gamepgn.rfind("]")
-		move_begin = gamepgn.find('1.', end_header)
-		moves  = gamepgn[move_begin:]
-		move_list = moves.split()
-		for move in move_list:
-			 if move[0].isdigit(): move_list.remove(move)
+		gameDict["time_control"] = headers.get('TimeControl', '')
+
+		### The following iterates through the moves and creates board states and move dictionary
 
 		# runs through each move and creates the move dictionary and board states
 		# creates a counter for half moves
@@ -136,38 +270,12 @@ def get_gameDict(gamepgn):
 		#writes the first FEN
 		#gameDict["board_states_FEN"].append(current_board.fen())
 
+		# creates the compact arrays that the board states are recorded in
+		positions = GamePositions(len(move_list))
+
 		for move in move_list:
-			move_dict = {"move_number": move_counter, "capture" : '', "check" : '', "special": ''}
-			#checks what piece was moved
-			if move[0].isupper():
-				move_dict["piece"] = move[0]
-			else:
-				move_dict["piece"] = "P"
-
-			#parses the next move
-			current_move = current_board.parse_san(move)
-
-			#writes the to and from squares
-			move_dict["to"] = [current_move.to_square % 8, current_move.to_square // 8]
-			move_dict["from"] = [current_move.from_square % 8 , current_move.from_square // 8]
-			#checks if there was en passant
-			if current_board.is_en_passant(current_move):
-				move_dict["special"] = "p"
-				move_dict["capture"] = "P"
-			#if not checks if capture and of what kind
-			elif current_board.is_capture(current_move):	
-				captured_piece = current_board.remove_piece_at(current_move.to_square)
-				current_board.set_piece_at(current_move.to_square, captured_piece)
-				move_dict["capture"] = captured_piece.symbol().upper()		
-
-			#checks if promotion and writes it
-			if move.find("=") != -1:
-				move_dict["special"] = move[move.find("=") + 1]
-
-			#checks if castle and wrtes it
-			if move.find("-") != -1:
-				move_dict["special"] = move 
-			
+			#parses the next move and makes its move dictionary
+			move_dict, current_move = parse_move(current_board, move, move_counter)
 		
 			#writes the move dict to game dict
 			if move_counter % 2:
@@ -175,59 +283,81 @@ def get_gameDict(gamepgn):
 			else: 
 				gameDict["white_moves"].append(move_dict) 
 
-			#pushes the move and writes the new FEN
+			#pushes the move and records the new position
 			current_board.push(current_move)
-			gameDict["board_states_FEN"].append(current_board.fen())
+			positions.set_ply(move_counter, current_board)
 
-			#writes the array state
-			board_copy = current_board.copy()
-			board_state =  [['' for i in range(0,8)] for j in range(0,8)]
-			for rank in range(0,8):
-				for column in range(0,8):
-					piece = board_copy.remove_piece_at(chess.SQUARES[8*rank + column ])
-					if piece: board_state[column][rank] = piece.symbol()
-
-			gameDict['board_states'].append(board_state)
-        
-			white_pieces, black_pieces = get_piece_locations(board_state)
-			gameDict['white_pieces'].append(white_pieces)
-			gameDict['black_pieces'].append(black_pieces)
-
-			#checks if midgame 
-			#counts numbers of minor/major pieces
-			major_minor_piece_count = len(gameDict['white_pieces'][move_counter]['N']) +len(gameDict['white_pieces'][move_counter]['B'])+len(gameDict['white_pieces'][move_counter]['R'])+len(gameDict['white_pieces'][move_counter]['Q']) +len(gameDict['black_pieces'][move_counter]['N'])+ len(gameDict['black_pieces'][move_counter]['R']) + len(gameDict['black_pieces'][move_counter]['B']) + len(gameDict['black_pieces'][move_counter]['Q'])
-			if not gameDict['middle_game_index']:
-				#gets the number of pieces on the back ranks
-				back_rank_pieces_white = 0
-				back_rank_pieces_black = 0
-				for pieces_list in [gameDict['white_pieces'][move_counter]['N'],	gameDict['white_pieces'][move_counter]['B'], gameDict['white_pieces'][move_counter]['R'], gameDict['white_pieces'][move_counter]['Q']]: 
-					for piece in pieces_list:
-						if piece[1] == 0: back_rank_pieces_white += 1
-				for pieces_list in [gameDict['black_pieces'][move_counter]['N'],	gameDict['black_pieces'][move_counter]['B'], gameDict['black_pieces'][move_counter]['R'], gameDict['black_pieces'][move_counter]['Q']]: 
-					for piece in pieces_list:
-						if  piece[1] == 7: back_rank_pieces_black += 1
-
-
-				#set the counter if major_minor_piece_count <= 10 or back_rank_pieces <= 3 for each of black and white
-				if (major_minor_piece_count <= 10) or (back_rank_pieces_white <= 3 and back_rank_pieces_black <= 3): 
-					gameDict['middle_game_index'] = move_counter
-			
-			#checks if endgame
-			if not (gameDict['end_game_index'])  and major_minor_piece_count <= 6:
-				gameDict['end_game_index'] = move_counter
-        
 			#check is mate or checkmate
-			if current_board.is_check(): move_dict["check"] = "+"
-			elif current_board.is_checkmate(): move_dict["check"] = "#"
+			set_check(move_dict, current_board)
 					
 			move_counter += 1
 
+		positions.finish()
+		set_positions(gameDict, positions, compact)
+
+		#finds the first half moves of the middle game and the end game
+		gameDict['middle_game_index'], gameDict['end_game_index'] = segment_phases(positions)
+
 	except:
 		# If something went wrong, return the empty game
 		gameDict = {'white_moves' : [], 'black_moves' :[], 'board_states' :[], 'board_states_FEN' :[], 'white_pieces': [], 'black_pieces': [],'middle_game_index' : None, 'end_game_index' : None }
 
 	return gameDict  
 
+## Helper functions for the above
+## parse_move parses the SAN move on board (before it is pushed), and returns (move dictionary, chess.Move)
+## set_check fills in the 'check' of the move dictionary, from the board after the move
+def parse_move(current_board, move, move_counter):
+	move_dict = {"move_number": move_counter, "capture" : '', "check" : '', "special": ''}
+	#checks what piece was moved
+	if move[0].isupper():
+		move_dict["piece"] = move[0]
+	else:
+		move_dict["piece"] = "P"
+
+	#parses the next move
+	current_move = current_board.parse_san(move)
+
+	#writes the to and from squares
+	move_dict["to"] = [current_move.to_square % 8, current_move.to_square // 8]
+	move_dict["from"] = [current_move.from_square % 8 , current_move.from_square // 8]
+	#checks if there was en passant
+	if current_board.is_en_passant(current_move):
+		move_dict["special"] = "p"
+		move_dict["capture"] = "P"
+	#if not checks if capture and of what kind
+	elif current_board.is_capture(current_move):	
+		captured_piece = current_board.remove_piece_at(current_move.to_square)
+		current_board.set_piece_at(current_move.to_square, captured_piece)
+		move_dict["capture"] = captured_piece.symbol().upper()		
+
+	#checks if promotion and writes it
+	if move.find("=") != -1:
+		move_dict["special"] = move[move.find("=") + 1]
+
+	#checks if castle and wrtes it
+	if move.find("-") != -1:
+		move_dict["special"] = move 
+	return move_dict, current_move
+
+def set_check(move_dict, current_board):
+	if current_board.is_check(): move_dict["check"] = "+"
+	elif current_board.is_checkmate(): move_dict["check"] = "#"
+
+## Writes the positions into the game dictionary as views (compact) or lists
+def set_positions(gameDict, positions, compact):
+	if compact:
+		gameDict['positions'] = positions
+		gameDict['board_states'] = positions.board_states
+		gameDict['board_states_FEN'] = positions.board_states_FEN
+		gameDict['white_pieces'] = positions.white_pieces
+		gameDict['black_pieces'] = positions.black_pieces
+	else:
+		gameDict['board_states'] = list(positions.board_states)
+		gameDict['board_states_FEN'] = list(positions.board_states_FEN)
+		gameDict['white_pieces'] = list(positions.white_pieces)
+		gameDict['black_pieces'] = list(positions.black_pieces)
+
 
 ## Helper function for the above
 ## Takes in a 2D array for a board state and returns (white_dict,black_dict)
@@ -249,6 +379,457 @@ def get_piece_locations(board):
     return white_dict, black_dict
 
 
+### GamePositions
+### Compact storage for the positions of a game, one row per half move (same indexing as 'board_states')
+### pieces : (n_plies x 64) int8 array indexed by python-chess square (8*rank + file)
+###          0 for an empty square, 1-6 for a white P, N, B, R, Q, K and -1 to -6 for the black pieces
+### bitboards : (n_plies x 2 x 6) uint64 array, bitboards[ply, color, piece_type - 1] is the python-chess
+###             square mask of that piece (color is chess.BLACK = 0 or chess.WHITE = 1)
+### turn, castling, ep_square, halfmove, fullmove : the rest of the FEN for each ply
+###             (castling is a 4 bit mask KQkq, ep_square is -1 if there is no legal en passant)
+###
+### The old game dictionary layout is available through the views
+### board_states, board_states_FEN, white_pieces, black_pieces
+### which give exactly the entries get_gameDict used to store, built one at a time when they are indexed.
+
+PIECE_SYMBOLS = ['', 'P', 'N', 'B', 'R', 'Q', 'K']
+CASTLING_SQUARES = [(chess.BB_H1, 'K'), (chess.BB_A1, 'Q'), (chess.BB_H8, 'k'), (chess.BB_A8, 'q')]
+FILE_RANK_SQUARES = [(file, rank) for file in range(8) for rank in range(8)]
+
+class GamePositions:
+    def __init__(self, n_plies):
+        self.bitboards = np.zeros((n_plies, 2, 6), dtype=np.uint64)
+        self.turn = np.zeros(n_plies, dtype=np.bool_)
+        self.castling = np.zeros(n_plies, dtype=np.int8)
+        self.ep_square = np.full(n_plies, -1, dtype=np.int8)
+        self.halfmove = np.zeros(n_plies, dtype=np.int16)
+        self.fullmove = np.zeros(n_plies, dtype=np.int16)
+        self.pieces = np.zeros((n_plies, 64), dtype=np.int8)
+
+    def __len__(self):
+        return len(self.pieces)
+
+    ## Builds the positions from a list of FEN strings (ex. the 'board_states_FEN' of an old game dictionary)
+    @classmethod
+    def from_fens(cls, fens):
+        positions = cls(len(fens))
+        for i in range(len(fens)):
+            positions.set_ply(i, chess.Board(fens[i]))
+        positions.finish()
+        return positions
+
+    ## Builds the positions from arrays that were already recorded (ex. read back from a GameCache)
+    @classmethod
+    def from_arrays(cls, bitboards, turn, castling, ep_square, halfmove, fullmove):
+        positions = cls(len(bitboards))
+        positions.bitboards[:] = bitboards
+        positions.turn[:] = turn
+        positions.castling[:] = castling
+        positions.ep_square[:] = ep_square
+        positions.halfmove[:] = halfmove
+        positions.fullmove[:] = fullmove
+        positions.finish()
+        return positions
+
+    ## Records the position of a chess.Board as ply i
+    def set_ply(self, i, board):
+        for color in chess.COLORS:
+            for piece_type in chess.PIECE_TYPES:
+                self.bitboards[i, int(color), piece_type - 1] = board.pieces_mask(piece_type, color)
+        self.turn[i] = board.turn
+        castling = 0
+        for bit in range(4):
+            if board.castling_rights & CASTLING_SQUARES[bit][0]:
+                castling |= 1 << bit
+        self.castling[i] = castling
+        if board.has_legal_en_passant():
+            self.ep_square[i] = board.ep_square
+        self.halfmove[i] = board.halfmove_clock
+        self.fullmove[i] = board.fullmove_number
+
+    ## Fills in the piece array from the bitboards, call this once every ply has been set
+    def finish(self):
+        # Unpack every bitboard into 64 booleans at once, then weight them by their piece code
+        bits = np.unpackbits(self.bitboards.reshape(len(self), 12, 1).view(np.uint8), axis=2, bitorder='little')
+        codes = np.array([-1, -2, -3, -4, -5, -6, 1, 2, 3, 4, 5, 6], dtype=np.int8)
+        self.pieces = np.einsum('pkq,k->pq', bits.astype(np.int8), codes).astype(np.int8)
+
+    ## 8x8 list of strings for ply i, board_state[file][rank] (same as the old 'board_states' entries)
+    def board_state(self, i):
+        board_state = [['' for rank in range(8)] for file in range(8)]
+        codes = self.pieces[i].tolist()
+        for square in range(64):
+            code = codes[square]
+            if code == 0:
+                continue
+            symbol = PIECE_SYMBOLS[abs(code)]
+            board_state[square % 8][square // 8] = symbol if code > 0 else symbol.lower()
+        return board_state
+
+    ## Dict of lists of (file, rank) tuples for one color at ply i (same as the old 'white_pieces'/'black_pieces' entries)
+    ## The tuples are sorted by file then rank, just like get_piece_locations
+    def piece_locations(self, i, color):
+        # the squares in (file, rank) order
+        codes = self.pieces[i].reshape(8, 8).T.ravel().tolist()
+        sign = 1 if color else -1
+        pieces = {'P': [], 'N': [], 'B': [], 'R': [], 'Q': [], 'K': []}
+        for index, code in enumerate(codes):
+            if code and (code > 0) == (sign > 0):
+                pieces[PIECE_SYMBOLS[sign * code]].append(FILE_RANK_SQUARES[index])
+        return pieces
+
+    ## FEN string for ply i
+    def fen(self, i):
+        rows = []
+        codes = self.pieces[i].tolist()
+        for rank in range(7, -1, -1):
+            row = ''
+            empty = 0
+            for code in codes[8 * rank: 8 * rank + 8]:
+                if code == 0:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                symbol = PIECE_SYMBOLS[abs(code)]
+                row += symbol if code > 0 else symbol.lower()
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = ''.join(CASTLING_SQUARES[bit][1] for bit in range(4) if self.castling[i] & (1 << bit))
+        if self.ep_square[i] >= 0:
+            ep = chess.SQUARE_NAMES[self.ep_square[i]]
+        else:
+            ep = '-'
+        return '%s %s %s %s %d %d' % ('/'.join(rows), 'w' if self.turn[i] else 'b', castling or '-', ep, self.halfmove[i], self.fullmove[i])
+
+    ## chess.Board for ply i
+    def board(self, i):
+        return chess.Board(self.fen(i))
+
+    ## The positions from ply start on, seen from the other side: every bitboard flipped top to bottom (a byte swap,
+    ## rank 1 is the low byte) and given to the other color, with the turn, castling rights and en passant square to match
+    ## Ply i of the mirror is ply start + i here. The move numbers are those of a game starting at the first of them.
+    def mirror(self, start=0):
+        positions = GamePositions(len(self) - start)
+        positions.bitboards[:] = self.bitboards[start:, ::-1, :].byteswap()
+        positions.turn[:] = ~self.turn[start:]
+        castling = self.castling[start:]
+        positions.castling[:] = ((castling & 3) << 2) | ((castling >> 2) & 3)
+        positions.ep_square[:] = np.where(self.ep_square[start:] >= 0, self.ep_square[start:] ^ 56, -1)
+        positions.halfmove[:] = self.halfmove[start:]
+        positions.fullmove[:] = (np.arange(len(positions)) + 1) // 2 + 1
+        positions.finish()
+        return positions
+
+    @property
+    def board_states(self):
+        return PlyView(self.board_state, len(self))
+
+    @property
+    def board_states_FEN(self):
+        return PlyView(self.fen, len(self))
+
+    @property
+    def white_pieces(self):
+        return PlyView(lambda i: self.piece_locations(i, chess.WHITE), len(self))
+
+    @property
+    def black_pieces(self):
+        return PlyView(lambda i: self.piece_locations(i, chess.BLACK), len(self))
+
+## Read-only list-like view, view[i] is get_item(i), computed when it is asked for
+## Slicing gives a plain list, so game_dict['white_pieces'][start:end:2] works as before
+## The last entry is kept around, since the features usually index the same ply several times in a row
+class PlyView:
+    def __init__(self, get_item, length):
+        self.get_item = get_item
+        self.length = length
+        self.last = (None, None)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.get_item(j) for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('ply index out of range')
+        if self.last[0] != i:
+            self.last = (i, self.get_item(i))
+        return self.last[1]
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.get_item(i)
+
+## Returns the GamePositions of a game dictionary, building it from the FENs for the old (non-compact) layout
+def game_positions(game_dict):
+    if 'positions' in game_dict:
+        return game_dict['positions']
+    return GamePositions.from_fens(game_dict['board_states_FEN'])
+
+########################################
+### Game phases
+########################################
+
+### segment_phases(positions, middle_pieces=10, back_rank_pieces=3, end_pieces=6)
+### Finds (middle_game_index, end_game_index) of a game from its GamePositions, the way get_gameDict does:
+### the middle game starts at the first half move with middle_pieces or fewer minor/major pieces on the board,
+### or with back_rank_pieces or fewer minor/major pieces on each player's back rank,
+### and the end game at the first half move with end_pieces or fewer minor/major pieces. None if the game never gets there.
+###
+### It works on the counts of every ply at once (phase_counts), so a corpus can be split again under other limits
+### without replaying any games, ex.
+###     resegment(game_dict, end_pieces=8)
+###     cache.phase_indices(middle_pieces=12)     # {game_id: (middle_game_index, end_game_index)} of a whole GameCache
+
+PHASE_THRESHOLDS = {'middle_pieces': 10, 'back_rank_pieces': 3, 'end_pieces': 6}
+
+## Returns int arrays with one entry per ply: the number of minor/major pieces on the board,
+## and on white's first rank (white's pieces) and black's eighth rank (black's pieces)
+def phase_counts(positions):
+    # piece codes 2-5 are the knights, bishops, rooks and queens (white positive, black negative)
+    codes = positions.pieces
+    minor_major = (np.abs(codes) >= 2) & (np.abs(codes) <= 5)
+    pieces = minor_major.sum(axis=1)
+    white_back_rank = (minor_major[:, :8] & (codes[:, :8] > 0)).sum(axis=1)
+    black_back_rank = (minor_major[:, 56:] & (codes[:, 56:] < 0)).sum(axis=1)
+    return pieces, white_back_rank, black_back_rank
+
+def segment_phases(positions, middle_pieces=PHASE_THRESHOLDS['middle_pieces'], back_rank_pieces=PHASE_THRESHOLDS['back_rank_pieces'],
+                   end_pieces=PHASE_THRESHOLDS['end_pieces']):
+    pieces, white_back_rank, black_back_rank = phase_counts(positions)
+    middle = (pieces <= middle_pieces) | ((white_back_rank <= back_rank_pieces) & (black_back_rank <= back_rank_pieces))
+    return _first_ply(middle), _first_ply(pieces <= end_pieces)
+
+## The first ply where the mask is set, None if it never is
+## (get_gameDict always took an index of 0 as not found yet, so a later ply wins over ply 0)
+def _first_ply(mask):
+    plies = np.flatnonzero(mask)
+    if len(plies) == 0:
+        return None
+    if plies[0] == 0 and len(plies) > 1:
+        return int(plies[1])
+    return int(plies[0])
+
+## Sets the phase indices of a game dictionary from the given limits (see segment_phases)
+## The derived indices of the game are thrown away, since they depend on the phases
+def resegment(game_dict, **thresholds):
+    if not len(game_dict['board_states_FEN']):
+        return game_dict
+    game_dict['middle_game_index'], game_dict['end_game_index'] = segment_phases(game_positions(game_dict), **thresholds)
+    game_dict.pop('_derived', None)
+    return game_dict
+
+########################################
+### Black's perspective
+########################################
+
+### mirror_game(game_dict)
+### The features are all written for white, so a game only gives one row, the white player's. mirror_game turns a
+### parsed game around so that black's side of it reads as white's, and get_features of it gives black's row:
+### the board is flipped top to bottom and the colors are swapped (see GamePositions.mirror, no re-parsing), black's
+### moves become white_moves, and the players swap.
+###
+### Since white moves first in a game dictionary, the mirrored game starts from the position after white's first move
+### (mirrored, under 'starting_fen', which replay_game starts from), so it has one half move less than the game.
+### The phase indices are found again on the mirrored positions (see segment_phases).
+### Returns None for a game with less than two half moves.
+###
+### ex. rows = [get_features(game_dict), get_features(mirror_game(game_dict))]   # white's row and black's row
+###     df = extract_features('games.pgn', both_colors=True)
+###
+### A mirrored game isn't added to a GameCache (pack_game skips it), it is quick to make again from the game.
+
+def mirror_game(game_dict):
+    if len(game_dict['board_states_FEN']) < 2:
+        return None
+    positions = game_positions(game_dict)
+    mirrored = positions.mirror(start=1)
+
+    gameDict = {'white_moves': [mirror_move(move) for move in game_dict['black_moves']],
+                'black_moves': [mirror_move(move) for move in game_dict['white_moves'][1:]],
+                'starting_fen': positions.board(0).mirror().fen()}
+    for key in ['game_id', 'opening', 'time_control']:
+        if key in game_dict:
+            gameDict[key] = game_dict[key]
+    gameDict['white_player'] = game_dict.get('black_player', '')
+    gameDict['black_player'] = game_dict.get('white_player', '')
+
+    set_positions(gameDict, mirrored, 'positions' in game_dict)
+    gameDict['middle_game_index'], gameDict['end_game_index'] = segment_phases(mirrored)
+    return gameDict
+
+## A move dictionary seen from the other side, one half move earlier
+def mirror_move(move_dict):
+    move = dict(move_dict)
+    move['move_number'] = move_dict['move_number'] - 1
+    move['from'] = [move_dict['from'][0], 7 - move_dict['from'][1]]
+    move['to'] = [move_dict['to'][0], 7 - move_dict['to'][1]]
+    return move
+
+### GameCache
+### On-disk cache of parsed games, keyed by game_id (the lichess url), so a game only has to go through
+### get_gameDict (SAN parsing and board replay) once.
+###
+### ex. cache = GameCache('game_cache')
+###     game_dict = cache.get_gameDict(gamepgn)   # parses and stores the game the first time, reads it back after that
+###     game_dict = cache['https://lichess.org/abc12345']
+###     phases = cache.phase_indices(end_pieces=8)   # the phase indices of every cached game under other limits
+###
+### The cache is a directory with two files:
+### games.bin : one GAME_CACHE_DTYPE record per half move, the games one after another. Each record has the
+###             position after the move (the GamePositions arrays) and the move itself.
+###             It is read with np.memmap, so only the pages of the games asked for are read from disk.
+### index.jsonl : one line per game with its game_id, where its records start in games.bin, its number of half moves
+###               and the rest of the game dictionary (players, opening, time control, phase indices)
+### Both files are only appended to. A game's index line is written after its records, so a run that dies part way
+### through never leaves an index line pointing at missing records. Only one process should write to a cache at a time.
+
+GAME_CACHE_DTYPE = np.dtype([('bitboards', '<u8', (2, 6)), ('turn', '?'), ('castling', 'i1'), ('ep_square', 'i1'),
+                             ('halfmove', '<i2'), ('fullmove', '<i2'), ('from', 'i1'), ('to', 'i1'), ('piece', 'S1'),
+                             ('capture', 'S1'), ('special', 'S6'), ('check', 'S1')])
+GAME_CACHE_KEYS = ['white_player', 'black_player', 'opening', 'time_control', 'middle_game_index', 'end_game_index']
+
+class GameCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, 'games.bin')
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.index = {}
+        self.n_records = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.index[entry['game_id']] = entry
+                    self.n_records = max(self.n_records, entry['offset'] + entry['n_plies'])
+        self.records = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, game_id):
+        return game_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, game_id):
+        return self.get(game_id)
+
+    ## Adds a game dictionary to the cache (games that are already in it, or that failed to parse, are skipped)
+    def add(self, game_dict):
+        packed = pack_game(game_dict)
+        if packed is not None:
+            self.add_packed(*packed)
+
+    ## Adds a game packed by pack_game
+    def add_packed(self, entry, records):
+        if entry['game_id'] in self.index:
+            return
+        with open(self.data_path, 'ab') as f:
+            f.write(records.tobytes())
+        entry = dict(entry, offset=self.n_records)
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.index[entry['game_id']] = entry
+        self.n_records += len(records)
+
+    ## Reads a game dictionary back from the cache, see get_gameDict for compact
+    def get(self, game_id, compact=False):
+        entry = self.index[game_id]
+        start, end = entry['offset'], entry['offset'] + entry['n_plies']
+        # (re)opens the memory map if the game was added after it was opened
+        if self.records is None or len(self.records) < end:
+            self.records = np.memmap(self.data_path, dtype=GAME_CACHE_DTYPE, mode='r')
+        gameDict = {'game_id': game_id}
+        for key in GAME_CACHE_KEYS:
+            gameDict[key] = entry[key]
+        gameDict.update(unpack_moves(self.records[start:end]))
+        set_positions(gameDict, record_positions(self.records[start:end]), compact)
+        return gameDict
+
+    ## {game_id: (middle_game_index, end_game_index)} of every game in the cache, under the given limits (see segment_phases)
+    ## Only the bitboards of the records are read, no game is replayed
+    def phase_indices(self, **thresholds):
+        if len(self.index) and (self.records is None or len(self.records) < self.n_records):
+            self.records = np.memmap(self.data_path, dtype=GAME_CACHE_DTYPE, mode='r')
+        phases = {}
+        for game_id, entry in self.index.items():
+            records = self.records[entry['offset']:entry['offset'] + entry['n_plies']]
+            phases[game_id] = segment_phases(record_positions(records), **thresholds)
+        return phases
+
+    ## Same as get_gameDict(gamepgn), but only parses games that aren't in the cache yet (and then adds them)
+    def get_gameDict(self, gamepgn, compact=False):
+        game_id = tokenize_pgn(gamepgn)[0].get('Site', '')
+        if game_id in self.index:
+            return self.get(game_id, compact)
+        game_dict = parse_and_pack(gamepgn, compact)
+        if game_dict.get('packed'):
+            self.add_packed(*game_dict.pop('packed'))
+        return game_dict
+
+## get_gameDict(gamepgn, compact), with the pack_game of the game under the key 'packed'
+## (parsing compact then packing saves building the positions again from the FENs)
+def parse_and_pack(gamepgn, compact=False):
+    game_dict = get_gameDict(gamepgn, compact=True)
+    packed = pack_game(game_dict)
+    if not compact and 'positions' in game_dict:
+        set_positions(game_dict, game_dict.pop('positions'), False)
+    game_dict['packed'] = packed
+    return game_dict
+
+## Packs a game dictionary into (index entry, GAME_CACHE_DTYPE records) for GameCache.add_packed
+## Returns None for games that can't be cached (no game_id, the game failed to parse, or it doesn't start from the
+## starting position, like a mirror_game)
+## The packed game is small and picklable, so worker processes can pack games for the process that owns the cache
+def pack_game(game_dict):
+    game_id = game_dict.get('game_id')
+    if not game_id or not len(game_dict['board_states_FEN']) or 'starting_fen' in game_dict:
+        return None
+    records = pack_records(game_dict)
+    entry = {'game_id': game_id, 'n_plies': len(records)}
+    entry.update((key, game_dict[key]) for key in GAME_CACHE_KEYS)
+    return entry, records
+
+## The GAME_CACHE_DTYPE records of a game dictionary, one per half move: the position after the move and the move
+def pack_records(game_dict):
+    positions = game_positions(game_dict)
+    records = np.zeros(len(positions), dtype=GAME_CACHE_DTYPE)
+    for field in ['bitboards', 'turn', 'castling', 'ep_square', 'halfmove', 'fullmove']:
+        records[field] = getattr(positions, field)
+    moves = move_table(game_dict)
+    for key in ['from', 'to', 'piece', 'capture', 'special', 'check']:
+        records[key][moves['ply']] = moves[key]
+    return records
+
+## The GamePositions of packed records
+def record_positions(records):
+    return GamePositions.from_arrays(records['bitboards'], records['turn'], records['castling'],
+                                     records['ep_square'], records['halfmove'], records['fullmove'])
+
+## {'white_moves': [...], 'black_moves': [...]}, the move dictionaries of packed records
+def unpack_moves(records):
+    moves = {'white_moves' : [], 'black_moves' :[]}
+    for move_counter in range(len(records)):
+        record = records[move_counter]
+        move_dict = {"move_number": move_counter, "capture": record['capture'].decode(), "check": record['check'].decode(),
+                     "special": record['special'].decode(), "piece": record['piece'].decode(),
+                     "to": [int(record['to']) % 8, int(record['to']) // 8], "from": [int(record['from']) % 8, int(record['from']) // 8]}
+        if move_counter % 2:
+            moves["black_moves"].append(move_dict)
+        else:
+            moves["white_moves"].append(move_dict)
+    return moves
+
+
 
 ########################################
 ### Testing
@@ -278,6 +859,351 @@ def feature_test(game_dict, feature_list):
         print(feature.__name__,'->', feature(game_dict))
 
         
+########################################
+### Position cache
+########################################
+
+### PositionCache
+### A size-bounded (least recently used) cache of positions, with hit/miss counters.
+### cache.get(position) takes a FEN string or a chess.Board and returns a PositionEntry for it, which has
+### entry.board : a ready chess.Board of the position (the same as chess.Board(fen), don't change it!)
+### and the data derived from the board, computed the first time it is asked for and then kept with the entry:
+### entry.attack_map() : AttackMap of the board (see below)
+### entry.pinned() : pinned_pieces(entry.board), the pinned pieces of each color
+### entry.mobility() : Mobility of the board (see below)
+###
+### The helpers (is_pinned, gives_fork, attack_map) go through POSITION_CACHE, so asking them about several pieces
+### of the same position only parses the FEN and works out the attacks and pins once.
+
+class PositionCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, position):
+        if isinstance(position, str):
+            key = position
+        else:
+            key = position_key(position)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        if isinstance(position, str):
+            entry = PositionEntry(chess.Board(position))
+        else:
+            entry = PositionEntry(fen_board(position))
+        self.entries[key] = entry
+        # Throw out the least recently used position if we're full
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+## A position in the cache, see PositionCache
+class PositionEntry:
+    def __init__(self, board):
+        self.board = board
+        self.attacks = None
+        self.pinned_masks = None
+        self.moves = None
+
+    def attack_map(self):
+        if self.attacks is None:
+            self.attacks = AttackMap(self.board)
+        return self.attacks
+
+    def pinned(self):
+        if self.pinned_masks is None:
+            self.pinned_masks = pinned_pieces(self.board)
+        return self.pinned_masks
+
+    def mobility(self):
+        if self.moves is None:
+            self.moves = Mobility(self.board)
+        return self.moves
+
+## Key for a chess.Board in the cache, two boards have the same key when their FENs would only differ in the move counters
+def position_key(board):
+    if board.has_legal_en_passant():
+        ep_square = board.ep_square
+    else:
+        ep_square = None
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+            board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK], board.turn, board.clean_castling_rights(), ep_square)
+
+## The cache used by the feature helpers
+POSITION_CACHE = PositionCache()
+
+## Returns the PositionEntry of a FEN string or chess.Board from POSITION_CACHE
+def position_entry(position):
+    return POSITION_CACHE.get(position)
+
+## Returns the AttackMap of a FEN string or chess.Board (worked out once per position, see POSITION_CACHE)
+def attack_map(position):
+    return position_entry(position).attack_map()
+
+## Returns the Mobility of a FEN string or chess.Board (worked out once per position, see POSITION_CACHE)
+def mobility(position):
+    return position_entry(position).mobility()
+
+### AttackMap
+### Who attacks what in one position, worked out for every square at once:
+### attacks[square] : bitmask of the squares attacked by the piece on square (0 for an empty square)
+### attacked[color] : bitmask of the squares attacked by at least one piece of color
+### attack_counts[color] : int8 array of 64, the number of pieces of color attacking each square
+### defender_counts[color] : int8 array of 64, the number of pieces of color guarding each of color's own pieces
+###                          (attack_counts[color] on the squares of color's pieces, 0 elsewhere)
+### lowest_attacker[color] : int16 array of 64, the PIECE_VALUES value of the cheapest piece of color attacking each
+###                          square (0 when color doesn't attack it)
+### value_masks[color][value] : bitmask of the pieces of color worth value (ex. value_masks[chess.BLACK][3] is black's knights and bishops)
+### Squares are python-chess squares (8*rank + file), and [color] is indexed by chess.WHITE / chess.BLACK.
+
+class AttackMap:
+    def __init__(self, board):
+        self.attacks = [0] * 64
+        self.attacked = [0, 0]
+        self.value_masks = [{}, {}]
+        squares = []
+        colors = []
+        values = []
+        for square in chess.scan_forward(board.occupied):
+            mask = board.attacks_mask(square)
+            color = bool(board.occupied_co[chess.WHITE] & chess.BB_SQUARES[square])
+            value = PIECE_VALUES[chess.piece_symbol(board.piece_type_at(square)).upper()]
+            self.attacks[square] = mask
+            self.attacked[color] |= mask
+            self.value_masks[color][value] = self.value_masks[color].get(value, 0) | chess.BB_SQUARES[square]
+            squares.append(mask)
+            colors.append(color)
+            values.append(value)
+
+        # one row of 64 booleans per piece, the squares it attacks
+        bits = np.unpackbits(np.array(squares, dtype='<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little').astype(bool)
+        colors = np.array(colors, dtype=bool)
+        values = np.array(values, dtype=np.int16)
+        occupied_by = [np.zeros(64, dtype=bool), np.zeros(64, dtype=bool)]
+        # (lists rather than 2 x 64 arrays, so that [chess.WHITE] isn't taken as a boolean mask by numpy)
+        self.attack_counts = [None, None]
+        self.defender_counts = [None, None]
+        self.lowest_attacker = [np.zeros(64, dtype=np.int16), np.zeros(64, dtype=np.int16)]
+        for color in chess.COLORS:
+            rows = bits[colors == color]
+            self.attack_counts[color] = rows.sum(axis=0).astype(np.int8)
+            occupied_by[color][list(chess.scan_forward(board.occupied_co[color]))] = True
+            self.defender_counts[color] = np.where(occupied_by[color], self.attack_counts[color], 0).astype(np.int8)
+            if len(rows):
+                cheapest = np.where(rows, values[colors == color][:, None], np.iinfo(np.int16).max).min(axis=0)
+                self.lowest_attacker[color] = np.where(self.attack_counts[color] > 0, cheapest, 0).astype(np.int16)
+
+    ## Bitmask of the pieces of color that nothing of color guards
+    def unguarded(self, board, color):
+        return board.occupied_co[color] & ~self.attacked[color]
+
+### Mobility
+### The number of legal moves of every piece, for both colors, worked out from the attack masks in one go over the pieces
+### rather than by going through board.legal_moves for each piece type:
+### counts[color][piece_type] : number of legal moves of color's pieces of that type (ex. counts[chess.WHITE][chess.KNIGHT])
+### square_counts : int16 array of 64, the number of legal moves of the piece on each square (0 for an empty square)
+### The side to move gets exactly the moves of board.legal_moves (a promotion counts 4 times, castling is a king move).
+### The other side is counted as if it were its turn, with no en passant.
+
+class Mobility:
+    def __init__(self, board):
+        self.counts = [np.zeros(7, dtype=np.int16), np.zeros(7, dtype=np.int16)]
+        self.square_counts = np.zeros(64, dtype=np.int16)
+        for color in chess.COLORS:
+            self._count(board, color)
+
+    def _count(self, board, color):
+        king = board.king(color)
+        if king is None: return
+        own = board.occupied_co[color]
+        enemy = board.occupied_co[not color]
+        occupied = board.occupied
+        forward = 8 if color == chess.WHITE else -8
+        start_rank = chess.BB_RANK_2 if color == chess.WHITE else chess.BB_RANK_7
+        last_rank = chess.BB_RANK_8 if color == chess.WHITE else chess.BB_RANK_1
+
+        # in check, the pieces other than the king have to block or take the (single) checker
+        checkers = board.attackers_mask(not color, king)
+        if not checkers:
+            evasions = chess.BB_ALL
+        elif checkers & (checkers - 1):
+            evasions = 0
+        else:
+            evasions = chess.between(king, chess.lsb(checkers)) | checkers
+
+        for square in chess.scan_forward(own):
+            piece_type = board.piece_type_at(square)
+            if piece_type == chess.KING:
+                n = sum(1 for to_square in chess.scan_forward(chess.BB_KING_ATTACKS[square] & ~own)
+                        if not board.attackers_mask(not color, to_square, occupied & ~chess.BB_SQUARES[square]))
+                if not checkers:
+                    n += self._castling_moves(board, color, king)
+            else:
+                if piece_type == chess.PAWN:
+                    targets = chess.BB_PAWN_ATTACKS[color][square] & enemy
+                    push = square + forward
+                    if not chess.BB_SQUARES[push] & occupied:
+                        targets |= chess.BB_SQUARES[push]
+                        if chess.BB_SQUARES[square] & start_rank and not chess.BB_SQUARES[push + forward] & occupied:
+                            targets |= chess.BB_SQUARES[push + forward]
+                else:
+                    targets = board.attacks_mask(square) & ~own
+                targets &= evasions & board.pin_mask(color, square)
+                n = chess.popcount(targets)
+                if piece_type == chess.PAWN:
+                    # four promotions for every move to the last rank
+                    n += 3 * chess.popcount(targets & last_rank)
+                    if color == board.turn and board.ep_square is not None and chess.BB_PAWN_ATTACKS[color][square] & chess.BB_SQUARES[board.ep_square]:
+                        n += board.is_legal(chess.Move(square, board.ep_square))
+            self.square_counts[square] = n
+            self.counts[color][piece_type] += n
+
+    ## Number of legal castling moves of color (who isn't in check), the same conditions as python-chess
+    @staticmethod
+    def _castling_moves(board, color, king):
+        back_rank = chess.BB_RANK_1 if color == chess.WHITE else chess.BB_RANK_8
+        if not chess.BB_SQUARES[king] & back_rank: return 0
+        n = 0
+        for rook in chess.scan_forward(board.clean_castling_rights() & back_rank & board.rooks & board.occupied_co[color]):
+            king_to = chess.square(2 if rook < king else 6, chess.square_rank(king))
+            rook_to = chess.square(3 if rook < king else 5, chess.square_rank(king))
+            path = chess.between(king, king_to) | chess.between(rook, rook_to) | chess.BB_SQUARES[king_to] | chess.BB_SQUARES[rook_to]
+            if (board.occupied & ~chess.BB_SQUARES[king] & ~chess.BB_SQUARES[rook]) & path:
+                continue
+            # the squares the king passes through can't be attacked, nor can the one it lands on once the rook has moved
+            without_king = board.occupied & ~chess.BB_SQUARES[king]
+            if any(board.attackers_mask(not color, square, without_king) for square in chess.scan_forward(chess.between(king, king_to))):
+                continue
+            if board.attackers_mask(not color, king_to, without_king & ~chess.BB_SQUARES[rook] | chess.BB_SQUARES[rook_to]):
+                continue
+            n += 1
+        return n
+
+########################################
+### Derived game indices
+########################################
+
+### GameIndices
+### The indices several features work out from a whole game (the phase boundaries, when each side first had two minor
+### pieces, when and how each side castled) and the material of both sides at every ply.
+### Each is computed the first time a feature asks for it and then kept, in game_dict['_derived'], so the features of one
+### game share them instead of each going over every board state again.
+### The helpers (two_minor_pieces_turns, castle_index, mid_earlygame, mid_midgame, middle_game_range, material) read from it.
+###
+### indices = game_indices(game_dict)
+### indices.phase_range() : (mid_game_turn, end_game_turn), see middle_game_range
+### indices.mid_earlygame(), indices.mid_midgame() : see mid_earlygame and mid_midgame
+### indices.two_minor_pieces_turns() : see two_minor_pieces_turns
+### indices.castle_index(player) : see castle_index
+### indices.material(color) : int16 array, the material of color at each ply (see material)
+### indices.moves() : the move table of the game (see move_table)
+###
+### The indices assume the game dictionary doesn't change once features have been asked for
+### (and a game dictionary with '_derived' in it can't be written out with json.dump until it is deleted).
+
+class GameIndices:
+    def __init__(self, game_dict):
+        self.game_dict = game_dict
+        self.values = {}
+
+    def _memo(self, key, compute, *args):
+        if key not in self.values:
+            self.values[key] = compute(self.game_dict, *args)
+        return self.values[key]
+
+    def phase_range(self):
+        return self._memo('phase_range', _middle_game_range)
+
+    def mid_earlygame(self):
+        return self._memo('mid_earlygame', _mid_earlygame)
+
+    def mid_midgame(self):
+        return self._memo('mid_midgame', _mid_midgame)
+
+    def two_minor_pieces_turns(self):
+        return self._memo('two_minor_pieces_turns', _two_minor_pieces_turns)
+
+    def castle_index(self, player):
+        return self._memo(('castle_index', bool(player)), _castle_index, player)
+
+    def material(self, color):
+        return self._memo(('material', bool(color)), _ply_material, color)
+
+    def moves(self):
+        return self._memo('moves', _move_table)
+
+## Returns the GameIndices of a game dictionary, made the first time it is asked for
+def game_indices(game_dict):
+    indices = game_dict.get('_derived')
+    if indices is None:
+        indices = game_dict['_derived'] = GameIndices(game_dict)
+    return indices
+
+## Material of color at every ply, in one go over the game
+MATERIAL_VALUES = np.array([0, 1, 3, 3, 5, 9, 0], dtype=np.int16)
+
+def _ply_material(game_dict, color):
+    if 'positions' in game_dict:
+        # a compact game dictionary has the pieces of every ply in one array, white's codes positive and black's negative
+        codes = game_dict['positions'].pieces
+        if not color: codes = -codes
+        return MATERIAL_VALUES[np.clip(codes, 0, 6)].sum(axis=1).astype(np.int16)
+
+    if color: pieces = game_dict['white_pieces']
+    else: pieces = game_dict['black_pieces']
+    return np.array([sum(PIECE_VALUES[piece] * len(ply_pieces[piece]) for piece in ['P', 'B', 'N', 'R', 'Q']) for ply_pieces in pieces],
+                    dtype=np.int16)
+
+########################################
+### Move table
+########################################
+
+### move_table(game_dict)
+### The moves of a game as one structured numpy array of MOVE_TABLE_DTYPE, a record per half move in order, so that the
+### features over the moves can work on whole columns instead of looping over the move dictionaries:
+### ply : the move_number of the move dictionary (white's moves are the even plies)
+### piece, capture, special, check : the same strings as the move dictionary, as bytes (ex. b'N', b'' for no capture)
+### from, to : the squares (8*rank + file)
+### table[0::2] are white's moves and table[1::2] black's. The table is made once per game (see GameIndices).
+###
+### piece_values(column) gives the PIECE_VALUES of a piece or capture column (0 for no piece, and for 'O' of the castles).
+
+MOVE_TABLE_DTYPE = np.dtype([('ply', '<i2'), ('piece', 'S1'), ('from', 'i1'), ('to', 'i1'), ('capture', 'S1'),
+                             ('special', 'S6'), ('check', 'S1')])
+
+## PIECE_VALUES by the byte of the piece letter
+PIECE_VALUE_BYTES = np.zeros(256, dtype=np.int16)
+for piece, value in PIECE_VALUES.items():
+    PIECE_VALUE_BYTES[ord(piece)] = value
+
+def move_table(game_dict):
+    return game_indices(game_dict).moves()
+
+def _move_table(game_dict):
+    rows = [(move['move_number'], move['piece'], move['from'][0] + 8 * move['from'][1], move['to'][0] + 8 * move['to'][1],
+             move['capture'], move['special'], move['check']) for move in game_dict['white_moves'] + game_dict['black_moves']]
+    table = np.array(rows, dtype=MOVE_TABLE_DTYPE)
+    return table[np.argsort(table['ply'], kind='stable')]
+
+def piece_values(column):
+    return PIECE_VALUE_BYTES[column.view(np.uint8)]
+
 ########################################
 ### Features helper functions
 ########################################
@@ -290,6 +1216,9 @@ def feature_test(game_dict, feature_list):
 ## black_turn_index : same for black bringing white down to 2
 
 def two_minor_pieces_turns(game_dict):
+    return game_indices(game_dict).two_minor_pieces_turns()
+
+def _two_minor_pieces_turns(game_dict):
     # Get the indices for board states
     white_board_index = -1
     black_board_index = -1
@@ -328,13 +1257,14 @@ def two_minor_pieces_turns(game_dict):
 
 ### is_guarded function
 ### INPUT: reads in a tuple of integers [file, rank] corresponding to position in question and the FEN of the current board state
+###        (a chess.Board of the position works too, and saves parsing the FEN)
 ### OUTPUT: returns a list of tuples corresponding to the squares of the pieces guarding the piece
 def is_guarded(p_sq, board_state_FEN):
-	# converts FEN to only the board part of the FEN
-	fen = board_state_FEN.split()[0]
-
-	#creates a baseboard object in python chess
-	board = chess.BaseBoard(fen)
+	if isinstance(board_state_FEN, chess.BaseBoard):
+		board = board_state_FEN
+	else:
+		#gets the board for the FEN from the position cache
+		board = position_entry(board_state_FEN).board
 
 	#converts the piece_square tuple to a chess.SQUARE
 	sq = chess.square(p_sq[0],p_sq[1])
@@ -353,16 +1283,14 @@ def is_guarded(p_sq, board_state_FEN):
 
 ### is_pinned function
 ### 
-### INPUT: takes tuple of integers [file, rank] corresponding to position and FEN of the board
-### OUTPUT: boolean True if pinned
+### INPUT: takes tuple of integers [file, rank] corresponding to position and FEN of the board (or a chess.Board, which isn't changed)
+### OUTPUT: boolean True if pinned (see pinned_pieces)
 ### EXCEPTIONS: if not a piece on the square, or if it isn't the piece's turn to move
 
 def is_pinned(p_sq, board_state_FEN):
-	is_pinned_flag = False
-
-	#creates a baseboard object in python chess
-	board = chess.Board(board_state_FEN)
-
+	#gets the board from the position cache
+	entry = position_entry(board_state_FEN)
+	board = entry.board
 
 	#converts the piece_square tuple to a chess.SQUARE
 	sq = chess.square(p_sq[0],p_sq[1])
@@ -371,48 +1299,47 @@ def is_pinned(p_sq, board_state_FEN):
 	piece = board.piece_at(sq)
 	if piece == None:
 		raise Exception("no piece here")
-	# looks at the piece on the square
-	piece_type = piece.symbol().upper()
-	color = board.piece_at(sq).color
+	color = piece.color
 	
 	#checks if correct color to move
 	if color != board.turn: raise Exception("not right turn to move")
-	
-	
-	
-	#checks	if pinned to king
-	if board.is_pinned(color, sq): return True
-      
-	 
-	#because not pinned, removing the piece is valid, so we will look at all the possible moves with the piece on the board, and then all the moves when the piece is off the board
-	#change the color of the move
-	board.turn = 1- color 
-	moves_before = [ move for move in board.pseudo_legal_moves]
-	count = 0 
-	board1 = board.copy()
-	board1.remove_piece_at(sq)
-	moves_after = [move for move in board1.pseudo_legal_moves]
-
-	# looks at the difference between the two sets
-	for move in moves_before:
-		if move in moves_after: moves_after.remove(move)
-
-	# looks at all the captures
-	for move in moves_after:
-		if board1.is_capture(move) == False:
-			moves_after.remove(move)
-
-	for move in moves_after:
-		if not board1.piece_at(move.to_square):
-			break
-		piece_attacked = board1.piece_at(move.to_square).symbol().upper()
-		#calculates if material is higher
-		if PIECE_VALUES[piece_attacked] > PIECE_VALUES[piece_type]: 
-			p_sq = [chess.square_file(move.to_square), chess.square_rank(move.to_square)]
-			if len(is_guarded(p_sq, board1.fen())) == 0 : return True
-			if PIECE_VALUES[piece_attacked] > PIECE_VALUES[board1.piece_at(move.from_square).symbol().upper()]: return True
-
-	return is_pinned_flag
+
+	return bool(entry.pinned()[color] & chess.BB_SQUARES[sq])
+
+### pinned_pieces function
+###
+### INPUT: chess.Board
+### OUTPUT: dict {chess.WHITE: bitmask, chess.BLACK: bitmask} of the pinned pieces of each color
+### A piece is pinned when it is the only piece between an enemy slider (a bishop or queen on a diagonal, a rook or queen
+### on a rank or file) and a piece of its own color worth more than it, and moving away would lose that piece:
+###	it is the king (absolute pin), or it is worth more than the slider, or nothing guards it once the pinned piece is gone.
+### Everything is worked out from the rays of the sliders, without generating any moves.
+
+def pinned_pieces(board):
+	occupied = board.occupied
+	pinned = {chess.WHITE: 0, chess.BLACK: 0}
+	for color in chess.COLORS:
+		own = board.occupied_co[color]
+		enemy = board.occupied_co[not color]
+		for slider_square in chess.scan_forward(enemy & (board.bishops | board.rooks | board.queens)):
+			slider_type = board.piece_type_at(slider_square)
+			# the squares the slider could reach on an empty board
+			lines = 0
+			if slider_type != chess.ROOK: lines |= chess.BB_DIAG_ATTACKS[slider_square][0]
+			if slider_type != chess.BISHOP: lines |= chess.BB_RANK_ATTACKS[slider_square][0] | chess.BB_FILE_ATTACKS[slider_square][0]
+			for target_square in chess.scan_forward(own & lines):
+				blockers = chess.between(slider_square, target_square) & occupied
+				# exactly one piece in between, and it's ours
+				if not blockers or blockers & (blockers - 1) or not blockers & own:
+					continue
+				pinned_square = chess.lsb(blockers)
+				target_value = PIECE_VALUES[chess.piece_symbol(board.piece_type_at(target_square)).upper()]
+				if target_value <= PIECE_VALUES[chess.piece_symbol(board.piece_type_at(pinned_square)).upper()]:
+					continue
+				if target_value > PIECE_VALUES[chess.piece_symbol(slider_type).upper()] or not (
+						board.attackers_mask(color, target_square, occupied & ~blockers) & ~blockers):
+					pinned[color] |= blockers
+	return pinned
 
 	
 ### material(gameDict, move_number, chess.COLOR)
@@ -422,25 +1349,19 @@ def is_pinned(p_sq, board_state_FEN):
 def material(gameDict, move_number, color):
 	if move_number >= len(gameDict['board_states']): raise Exception('move_number out of index')
 
-	if color : color_name = 'white_pieces'
-	else: color_name = 'black_pieces'
-
-	material_sum = 0
-
-	for piece in ['P', 'B', 'N', 'R', 'Q']:
-		material_sum += PIECE_VALUES[piece] * len(gameDict[color_name][move_number][piece])
-
-	return material_sum
+	# the material of every ply is worked out once per game (see GameIndices)
+	return int(game_indices(gameDict).material(color)[move_number])
 	
 
 ### gives_fork 
 ### 
-### input: piece square (in format [file, rank]) and FEN
+### input: piece square (in format [file, rank]) and FEN (or a chess.Board)
 ### output: boolean: 1 if the piece gives a fork, and zero if not
 
 def gives_fork(piece, fen):
-	# creates board
-	board = chess.Board(fen)
+	# gets the board from the position cache
+	entry = position_entry(fen)
+	board = entry.board
 
 	# converts piece to square
 	square = chess.square(piece[0], piece[1])
@@ -449,19 +1370,16 @@ def gives_fork(piece, fen):
 	piece_type = board.piece_at(square).symbol().upper()
 	color = board.piece_at(square).color
 
-	# gets list of attacks from the square
-	attack_squares = board.attacks(square)
+	# gets the attacks of every piece on the board
+	attacks = entry.attack_map()
 
-	#creates a counter of pieces of greater value or unguarded the piece attacks
-	attack_count = 0
+	# the opposite color's pieces of greater value, or unguarded
+	targets = attacks.unguarded(board, not color)
+	for value, mask in attacks.value_masks[not color].items():
+		if value > PIECE_VALUES[piece_type]: targets |= mask
 
-	for sq in attack_squares:
-		if board.piece_at(sq):
-			#checks that piece attacked is of opposite color
-			if color != board.piece_at(sq).color:
-				# checks if greater value or unguarded and if so adds 1 
-				if PIECE_VALUES[board.piece_at(sq).symbol().upper()] > PIECE_VALUES	[piece_type] or  len(is_guarded([chess.square_file(sq), chess.square_rank(sq)], fen))==0:
-					attack_count +=1
+	#counts the pieces of greater value or unguarded the piece attacks
+	attack_count = chess.popcount(attacks.attacks[square] & targets)
 
 	return attack_count > 1
 
@@ -469,6 +1387,9 @@ def gives_fork(piece, fen):
 ## Input: game_dict
 ## Output: index for board_states
 def mid_earlygame(game_dict):
+    return game_indices(game_dict).mid_earlygame()
+
+def _mid_earlygame(game_dict):
     if game_dict['middle_game_index']:
         index = int(game_dict['middle_game_index'] / 2)
     else:
@@ -479,6 +1400,9 @@ def mid_earlygame(game_dict):
 ## Same I/O as mid_earlygame
 ## If we didn't reach the midgame at all, returns None (so that list[:index] takes a slice to the end)
 def mid_midgame(game_dict):
+    return game_indices(game_dict).mid_midgame()
+
+def _mid_midgame(game_dict):
     if game_dict['end_game_index']:
         # If we got to the end game
         index = int((game_dict['middle_game_index'] + game_dict['end_game_index'])/2)
@@ -498,6 +1422,21 @@ def cap_index(i, game_dict):
     else:
         return i
 
+## Helper function for the middle and end game indices, each set to the last index of the game if we never got there
+## Returns (mid_game_turn, end_game_turn)
+def middle_game_range(game_dict):
+    return game_indices(game_dict).phase_range()
+
+def _middle_game_range(game_dict):
+    mid_game_turn = game_dict['middle_game_index']
+    if (mid_game_turn == None):
+        mid_game_turn = len(game_dict['board_states']) - 1
+
+    end_game_turn = game_dict['end_game_index']
+    if (end_game_turn == None):
+        end_game_turn = len(game_dict['board_states']) - 1
+    return mid_game_turn, end_game_turn
+
 ## Helper function to find castles
 ## Pass it the game_dict and a boolean for which player to check: True = white, False = black
 ##
@@ -514,6 +1453,9 @@ def cap_index(i, game_dict):
 ## - King to the left/right of all its rooks
 ##
 def castle_index(game_dict,player):
+    return game_indices(game_dict).castle_index(player)
+
+def _castle_index(game_dict,player):
     
     # Find out if they did a real castle, which side, and which turn
     castled = False
@@ -655,180 +1597,276 @@ def detect_outpost(game_dict, turn, player):
                 outpost_counter += 1
     return outpost_counter
         
+########################################
+### Replaying games
+########################################
+
+### replay_game
+### input: game dictionary and a list of FeatureVisitors
+### output: list of the visitors' results, in the same order as the visitors
+###
+### The game is replayed once on a single chess.Board. After half move i is pushed, every visitor's visit(board, move, i)
+### is called, so board is the position board_states_FEN[i] and move is the chess.Move that was just played.
+### This way the board is built once per ply for all of the features together, instead of once per ply for each feature.
+### Visitors must not change the board (make a copy if you need to push moves on it).
+
+def replay_game(game_dict, visitors):
+    board = chess.Board(game_dict.get('starting_fen', chess.STARTING_FEN))
+    for ply in range(len(game_dict['board_states_FEN'])):
+        move = game_move(game_dict, ply)
+        board.push(move)
+        for visitor in visitors:
+            visitor.visit(board, move, ply)
+    return [visitor.result() for visitor in visitors]
+
+## Base class for the feature visitors
+## visit is called for every ply of the game, and result returns the dictionary of features at the end
+## columns is the set of the visitor's features that are wanted (None for all of them, see get_features(game, only)),
+## a visitor can skip the work of the ones that aren't (they are then left at 0)
+class FeatureVisitor:
+    columns = None
+
+    def __init__(self, game_dict):
+        self.game_dict = game_dict
+
+    def wants(self, column):
+        return self.columns is None or column in self.columns
+
+    def visit(self, board, move, ply):
+        pass
+
+    def result(self):
+        return {}
+
+## Returns the chess.Move for half move ply, from the move dictionaries of the game
+def game_move(game_dict, ply):
+    if ply % 2:
+        move_dict = game_dict['black_moves'][ply // 2]
+    else:
+        move_dict = game_dict['white_moves'][ply // 2]
+    from_square = chess.square(move_dict['from'][0], move_dict['from'][1])
+    to_square = chess.square(move_dict['to'][0], move_dict['to'][1])
+    # 'special' is the promotion piece for promotions
+    promotion = None
+    if move_dict['special'] in ['N', 'B', 'R', 'Q']:
+        promotion = chess.PIECE_SYMBOLS.index(move_dict['special'].lower())
+    return chess.Move(from_square, to_square, promotion)
+
+## Returns a copy of the board which is the same as chess.Board(board.fen()), without going through the FEN
+## (a FEN only keeps the en passant square when the capture is legal, and only the valid castling rights)
+def fen_board(board):
+    board = board.copy(stack=False)
+    if not board.has_legal_en_passant():
+        board.ep_square = None
+    board.castling_rights = board.clean_castling_rights()
+    return board
+
 ########################################
 ### Features
 ########################################
 
 ### Knight Features function, will return a dictionary of the form [Knight pair, knight outposts, knight repositioning, number of squares controlled].
 def knight_features(game_dict):
-    ## I try to do my best to only consider the player generally, so that if we later want to implement this for the black player too, we simply change player to be an input
-    player = 'white'
-    ## Initalize the features to be returned:
-    knight_pair = 0
-    knight_outpost_turns = 0
-    knight_repo_counter = 0
-    knight_attack_counter = 0
-    num_knights = 0
+    return replay_game(game_dict, [KnightVisitor(game_dict)])[0]
 
+## The visitor behind knight_features, the board is only needed to count the knight moves on white's turns in the middle game
+class KnightVisitor(FeatureVisitor):
+    def __init__(self, game_dict):
+        FeatureVisitor.__init__(self, game_dict)
+        ## Number of legal knight moves at each of white's turns in the middle game
+        self.knight_moves = {}
 
-    ## Check whether when there are only two minor pieces in play, those pieces are knights.
+        if (game_dict['end_game_index'] == None):
+            end_game_index = int(len(game_dict['board_states']) - 1)
+        else:
+            end_game_index = game_dict['end_game_index']
+        if (game_dict['middle_game_index'] == None):
+            self.mobility_plies = range(0)
+        else:
+            self.mobility_plies = range(int(game_dict['middle_game_index']/2)*2 + 1, int(end_game_index/2)*2 + 1, 2)
+
+    def visit(self, board, move, ply):
+        if ply in self.mobility_plies:
+            # The legal moves of the knights of the side to move. To change this to work for black, use the other color's counts
+            self.knight_moves[ply] = int(mobility(board).counts[board.turn][chess.KNIGHT])
+
+    def result(self):
+        game_dict = self.game_dict
+        ## I try to do my best to only consider the player generally, so that if we later want to implement this for the black player too, we simply change player to be an input
+        player = 'white'
+        ## Initalize the features to be returned:
+        knight_pair = 0
+        knight_outpost_turns = 0
+        knight_repo_counter = 0
+        knight_attack_counter = 0
+        num_knights = 0
+
+
+        ## Check whether when there are only two minor pieces in play, those pieces are knights.
+
+        white_board_index = two_minor_pieces_turns(game_dict)[0]
+        if (white_board_index > 0):
+            if ((len(game_dict['white_pieces'][white_board_index]['N']) == 2) and (white_board_index != -1)):
+                knight_pair = 1
+        
+        ## The following will iterate through midgame turns to check each board state for various features:
+        # First check that we make it to the middle game:
+        end_game_index = 0 ## This line shouldn't be necessary, just here in case we somehow get to the second if without hitting the first
+        if (game_dict['end_game_index'] == None):
+            end_game_index = int(len(game_dict['board_states']) - 1)
+            ## In case the game ends before the endgame, this sets the endgame to be the last move in the game.
+        else:
+            end_game_index = game_dict['end_game_index']
 
-    if (two_minor_pieces_turns(game_dict)[0] > 0):
-        if ((len(game_dict['white_pieces'][two_minor_pieces_turns(game_dict)[0]]['N']) == 2) and (two_minor_pieces_turns(game_dict)[0] != -1)):
-            knight_pair = 1
-    
-    ## The following will iterate through midgame turns to check each board state for various features:
-    # First check that we make it to the middle game:
-    end_game_index = 0 ## This line shouldn't be necessary, just here in case we somehow get to the second if without hitting the first
-    if (game_dict['end_game_index'] == None):
-        end_game_index = int(len(game_dict['board_states']) - 1)
-        ## In case the game ends before the endgame, this sets the endgame to be the last move in the game.
-    else:
-        end_game_index = game_dict['end_game_index']
-
-    if (not (game_dict['middle_game_index'] == None)):
-        for turn in range(int(game_dict['middle_game_index']/2), int(end_game_index/2)):
-        ## turn iterates over white's moves ( game_dict['white_moves'] ) particularly, so to get the associated board states, we multiply turn by 2
-            white_half_turn = turn*2 + 1
-            num_knights = len(game_dict['white_pieces'][white_half_turn]['N'])
-            ## The knight outpost code has been shunted off to the detect_outpost code below:
-            knight_outpost_turns += detect_outpost(game_dict, white_half_turn, player)
-
-            ## The following counts the knight repositioning
-            if (game_dict[player+'_moves'][turn]['piece'] == 'N'): 
-                ## the above checks if the player moved a knight this turn, then:
-                for move in game_dict[player+'_moves']:
-                    ## sums over all other knight moves in the game, scaling by distance
-                    if ((move['piece'] == 'N') and (move['move_number']/2 != turn)):
-                        knight_repo_counter += 1 / abs(move['move_number']/2 - turn)
-
-            ## Now, we count the number of squares attacked by the knights at a given turn:
-            # We get the FEN for white: (remove the +1 to get the FEN for black)
-            board = chess.Board(game_dict['board_states_FEN'][white_half_turn])
-            # We then check every legal move to see if the piece that can be moved is a knight, if so, we add one to the move counter. To change this to work for black, we need to make the 'N' lowercase or apply .toUpper() both so that we don't need the strings to match case
-            for move in board.legal_moves:
-                if (str(board.piece_at(move.from_square)).upper() == 'N'):
-                    knight_attack_counter += 1 / num_knights
-    
-        ## Scale the repositioning, attack, and outpost counters by the total number of moves in the mid-game, so longer mid-games don't get overbiased.
-        if (end_game_index - game_dict['middle_game_index'] > 0):
-            knight_outpost_turns = knight_outpost_turns / (end_game_index - game_dict['middle_game_index'])
+        if (not (game_dict['middle_game_index'] == None)):
+            for turn in range(int(game_dict['middle_game_index']/2), int(end_game_index/2)):
+            ## turn iterates over white's moves ( game_dict['white_moves'] ) particularly, so to get the associated board states, we multiply turn by 2
+                white_half_turn = turn*2 + 1
+                num_knights = len(game_dict['white_pieces'][white_half_turn]['N'])
+                ## The knight outpost code has been shunted off to the detect_outpost code below:
+                knight_outpost_turns += detect_outpost(game_dict, white_half_turn, player)
 
-            knight_repo_counter = knight_repo_counter / (end_game_index - game_dict['middle_game_index'])
-            knight_attack_counter = knight_attack_counter / (end_game_index - game_dict['middle_game_index']) 
 
-    result_dict = {'wn_pair' : knight_pair, 'wn_outpost' : knight_outpost_turns, 'wn_repositioning': knight_repo_counter, 'wn_mobility' : knight_attack_counter}
-    return result_dict
+                ## Now, we add the number of squares attacked by the knights at this turn (counted in visit)
+                if (self.knight_moves[white_half_turn] > 0):
+                    knight_attack_counter += self.knight_moves[white_half_turn] / num_knights
+        
+            ## The following counts the knight repositioning:
+            ## for each turn of the mid-game that the player moved a knight, sums over all other knight moves in the game, scaling by distance
+            knight_turns = np.flatnonzero(move_table(game_dict)['piece'][0::2] == b'N')
+            mid_game_knight_turns = knight_turns[(knight_turns >= int(game_dict['middle_game_index']/2)) & (knight_turns < int(end_game_index/2))]
+            distances = np.abs(knight_turns[None, :] - mid_game_knight_turns[:, None])
+            knight_repo_counter = float(np.sum(1 / distances[distances > 0]))
 
-## Bishop Features are:
-# Bishop Pair (1 for yes, 0 for no)
-# King side Fianchetto
-# Queen side Fianchetto
-# Number of Squares controlled (sum/turns) of controlled squares by bishops in the middle game
-# Opp color bishop (1 if yes, -1 if no, 0 if there is never one bishop for each player)
-# Bishop_pawns: once white has only one bishop, adds +1 for each pawn on the opposite color, -1 for each on the same color of the opponents. Averages over number of turns that white has only one bishop
-# Taking long diagonals (number of midgame turns in which a bishop is on a long diagonal/total number of midgame turns.
+            ## Scale the repositioning, attack, and outpost counters by the total number of moves in the mid-game, so longer mid-games don't get overbiased.
+            if (end_game_index - game_dict['middle_game_index'] > 0):
+                knight_outpost_turns = knight_outpost_turns / (end_game_index - game_dict['middle_game_index'])
 
+                knight_repo_counter = knight_repo_counter / (end_game_index - game_dict['middle_game_index'])
+                knight_attack_counter = knight_attack_counter / (end_game_index - game_dict['middle_game_index']) 
 
-def bishop_features(game_dict):
-    ## I try to do my best to only consider the player generally, so that if we later want to implement this for the black player too, we simply change player to be an input
-    player = 'white'
-    ## Initalize the features to be returned:
-    bishop_pair = 0
-    k_side_fianchetto = 0
-    q_side_fianchetto = 0
-    bishop_attack_counter = 0
-    bishop_pawns = 0
-    one_bishop_turn_counter = 0
-    opp_color = 0
-    long_diag_turns = 0
-    long_diag_squares = [0, 9, 18, 27, 36, 45, 54, 63, 7, 14, 21, 28, 35, 42, 49, 56]
-    
-    ## Check whether when there are only two minor pieces in play, those pieces are bishops.
-    if (two_minor_pieces_turns(game_dict)[0] > 0):
-        if ((len(game_dict['white_pieces'][two_minor_pieces_turns(game_dict)[0]]['B']) == 2) and (two_minor_pieces_turns(game_dict)[0] != -1)):
-            bishop_pair = 1
+        result_dict = {'wn_pair' : knight_pair, 'wn_outpost' : knight_outpost_turns, 'wn_repositioning': knight_repo_counter, 'wn_mobility' : knight_attack_counter}
+        return result_dict
 
-    ## The following method takes advantage of the fact that the sum of squares mod 2 returns the color of the square.
-    for i in range(len(game_dict['board_states'])):
-        # Get the board state:
-        board_state = game_dict['board_states'][i]
-        
-        # Get the pieces
-        white_pieces, black_pieces = get_piece_locations(board_state)
+def bishop_features(game_dict):
+    return replay_game(game_dict, [BishopVisitor(game_dict)])[0]
 
-        # Check: we haven't already set opp_color, and both players each have one bishop
-        if ((opp_color == 0) and ((len(white_pieces['B']) == 1) and (len(black_pieces['B']) == 1))):
-            # Check if square parities match
-            if ( (sum(white_pieces['B'][0]) % 2) == (sum(black_pieces['B'][0]) % 2)):
-                opp_color = -1
-            else:
-                opp_color = 1
-        # Add for coherent pawns, subtract for incoherent pawns 
-        if (len(white_pieces['B']) == 1):
-            one_bishop_turn_counter += 1
-            white_parity = sum(white_pieces['B'][0]) % 2
-            for j in range(len(black_pieces['P'])):
-                if (sum(black_pieces['P'][j]) % 2 == white_parity):
-                    bishop_pawns += -1
-                else:
-                    bishop_pawns += 1
-    if (one_bishop_turn_counter != 0):
-        # If the players ever had one bishop, normalize by number of turns when they had one bishop
-        bishop_pawns = bishop_pawns / one_bishop_turn_counter
+## The visitor behind bishop_features, the board is used for the fianchettos on white's turns in the early game,
+## and for the bishop mobility and long diagonals on white's turns in the middle game
+class BishopVisitor(FeatureVisitor):
+    long_diag_squares = [0, 9, 18, 27, 36, 45, 54, 63, 7, 14, 21, 28, 35, 42, 49, 56]
 
+    def __init__(self, game_dict):
+        FeatureVisitor.__init__(self, game_dict)
+        self.k_side_fianchetto = 0
+        self.q_side_fianchetto = 0
+        ## Number of legal bishop moves and of bishops on the long diagonals at each of white's turns in the middle game
+        self.bishop_moves = {}
+        self.long_diag_bishops = {}
 
-    ## The following will iterate through game turns to check each board state for various features (which may be present in various parts of the game):
-    # First check that we make it to the middle game:
-    if (game_dict['end_game_index'] == None):
-        end_game_index = int(len(game_dict['board_states']) - 1)
-        ## In case the game ends before the endgame, this sets the endgame to be the last move in the game. Otherwise, the end_game_index is what it should be
-    else:
-        end_game_index = game_dict['end_game_index']
+        if (game_dict['end_game_index'] == None):
+            end_game_index = int(len(game_dict['board_states']) - 1)
+        else:
+            end_game_index = game_dict['end_game_index']
+        if (game_dict['middle_game_index'] == None):
+            self.early_plies = range(0)
+            self.mobility_plies = range(0)
+        else:
+            self.early_plies = range(0, int(game_dict['middle_game_index']/2)*2, 2)
+            self.mobility_plies = range(int(game_dict['middle_game_index']/2)*2 + 1, int(end_game_index/2)*2 + 1, 2)
 
-    if (not (game_dict['middle_game_index'] == None)):
-        ## Early game features tested here:
-        for turn in range(int(game_dict['middle_game_index']/2)):
-            white_half_turn = turn * 2
-            
-            board = chess.Board(game_dict['board_states_FEN'][white_half_turn])
+    def visit(self, board, move, ply):
+        if ply in self.early_plies:
             ## Check for fianchettos
             if (str(board.piece_at(9)).upper() == 'B'):
-                k_side_fianchetto = 1
+                self.k_side_fianchetto = 1
             if (str(board.piece_at(14)).upper() == 'B'):
-                q_side_fianchetto = 1
-
-
-        ## Middle game features tested here:
-        for turn in range(int(game_dict['middle_game_index']/2), int(end_game_index/2)):
-        ## turn iterates over white's moves ( game_dict['white_moves'] ) particularly, so to get the associated board states, we multiply turn by 2
-            white_half_turn = turn*2 + 1
-            num_bishops = len(game_dict['white_pieces'][white_half_turn]['B'])
-
-            ## Now, we count the number of squares attacked by the bishop at a given turn:
-            # We get the FEN for white: (remove the +1 to get the FEN for black)
-            board = chess.Board(game_dict['board_states_FEN'][white_half_turn])
-            # We then check every legal move to see if the piece that can be moved is a bishop, if so, we add one to the move counter. To change this to work for black, we need to make the 'N' lowercase or apply .upper() both so that we don't need the strings to match case
-            for move in board.legal_moves:
-                if (str(board.piece_at(move.from_square)).upper() == 'B'):
-                    bishop_attack_counter += 1 / num_bishops
-
-            for square in long_diag_squares:
-                if (str(board.piece_at(square)) == 'B'):
-                    long_diag_turns += 1/num_bishops
-        ## Scale the attack and long_diag counters by the total number of moves in the mid-game, so longer mid-games don't get overbiased.
-        if (end_game_index - game_dict['middle_game_index'] > 0):
-            bishop_attack_counter = bishop_attack_counter / abs(end_game_index - game_dict['middle_game_index'])
-            long_diag_turns = 2 * long_diag_turns / abs(end_game_index - game_dict['middle_game_index'])
-            ## The 2 * is so that a score of one would be all bishops on their long diagonals for the entire midgame, since we are dividing by the total number of half-turns, while the counted turns are only those of white
-    return_dict = {'wb_pair' : bishop_pair, 'wk_side_fianchetto' : k_side_fianchetto, 'wq_side_fianchetto' : q_side_fianchetto, 'wb_mobility' : bishop_attack_counter, 'wlong_diagonal_control' : long_diag_turns, 'wopposite_color_b': opp_color, 'b_p_coherency' : bishop_pawns}
-
-    return return_dict
-
-
-## Returns floats,
-# nb_pref -- The preference in minor piece trades, favoring knights is positive, bishops is negative
-# nb_develop -- The preference in which minor pieces are developed first, favoring knights is positive, bishops is negative
+                self.q_side_fianchetto = 1
+
+        if ply in self.mobility_plies:
+            # The legal moves of the bishops of the side to move. To change this to work for black, use the other color's counts
+            self.bishop_moves[ply] = int(mobility(board).counts[board.turn][chess.BISHOP])
+            self.long_diag_bishops[ply] = sum(1 for square in self.long_diag_squares if str(board.piece_at(square)) == 'B')
+
+    def result(self):
+        game_dict = self.game_dict
+        ## I try to do my best to only consider the player generally, so that if we later want to implement this for the black player too, we simply change player to be an input
+        player = 'white'
+        ## Initalize the features to be returned:
+        bishop_pair = 0
+        k_side_fianchetto = self.k_side_fianchetto
+        q_side_fianchetto = self.q_side_fianchetto
+        bishop_attack_counter = 0
+        bishop_pawns = 0
+        one_bishop_turn_counter = 0
+        opp_color = 0
+        long_diag_turns = 0
+        
+        ## Check whether when there are only two minor pieces in play, those pieces are bishops.
+        white_board_index = two_minor_pieces_turns(game_dict)[0]
+        if (white_board_index > 0):
+            if ((len(game_dict['white_pieces'][white_board_index]['B']) == 2) and (white_board_index != -1)):
+                bishop_pair = 1
+
+        ## The following method takes advantage of the fact that the sum of squares mod 2 returns the color of the square.
+        for i in range(len(game_dict['board_states'])):
+            # Get the board state:
+            board_state = game_dict['board_states'][i]
+            
+            # Get the pieces
+            white_pieces, black_pieces = get_piece_locations(board_state)
+
+            # Check: we haven't already set opp_color, and both players each have one bishop
+            if ((opp_color == 0) and ((len(white_pieces['B']) == 1) and (len(black_pieces['B']) == 1))):
+                # Check if square parities match
+                if ( (sum(white_pieces['B'][0]) % 2) == (sum(black_pieces['B'][0]) % 2)):
+                    opp_color = -1
+                else:
+                    opp_color = 1
+            # Add for coherent pawns, subtract for incoherent pawns 
+            if (len(white_pieces['B']) == 1):
+                one_bishop_turn_counter += 1
+                white_parity = sum(white_pieces['B'][0]) % 2
+                for j in range(len(black_pieces['P'])):
+                    if (sum(black_pieces['P'][j]) % 2 == white_parity):
+                        bishop_pawns += -1
+                    else:
+                        bishop_pawns += 1
+        if (one_bishop_turn_counter != 0):
+            # If the players ever had one bishop, normalize by number of turns when they had one bishop
+            bishop_pawns = bishop_pawns / one_bishop_turn_counter
+
+
+        ## The following will iterate through game turns to check each board state for various features (which may be present in various parts of the game):
+        # First check that we make it to the middle game:
+        if (game_dict['end_game_index'] == None):
+            end_game_index = int(len(game_dict['board_states']) - 1)
+            ## In case the game ends before the endgame, this sets the endgame to be the last move in the game. Otherwise, the end_game_index is what it should be
+        else:
+            end_game_index = game_dict['end_game_index']
+
+        if (not (game_dict['middle_game_index'] == None)):
+            ## Early game features (the fianchettos) are checked in visit
+
+            ## Middle game features tested here:
+            for turn in range(int(game_dict['middle_game_index']/2), int(end_game_index/2)):
+            ## turn iterates over white's moves ( game_dict['white_moves'] ) particularly, so to get the associated board states, we multiply turn by 2
+                white_half_turn = turn*2 + 1
+                num_bishops = len(game_dict['white_pieces'][white_half_turn]['B'])
+
+                ## Now, we add the number of squares attacked by the bishops at this turn, and the bishops on long diagonals (counted in visit)
+                if (self.bishop_moves[white_half_turn] > 0):
+                    bishop_attack_counter += self.bishop_moves[white_half_turn] / num_bishops
+                if (self.long_diag_bishops[white_half_turn] > 0):
+                    long_diag_turns += self.long_diag_bishops[white_half_turn] / num_bishops
+            ## Scale the attack and long_diag counters by the total number of moves in the mid-game, so longer mid-games don't get overbiased.
+            if (end_game_index - game_dict['middle_game_index'] > 0):
+                bishop_attack_counter = bishop_attack_counter / abs(end_game_index - game_dict['middle_game_index'])
+                long_diag_turns = 2 * long_diag_turns / abs(end_game_index - game_dict['middle_game_index'])
+                ## The 2 * is so that a score of one would be all bishops on their long diagonals for the entire midgame, since we are dividing by the total number of half-turns, while the counted turns are only those of white
+        return_dict = {'wb_pair' : bishop_pair, 'wk_side_fianchetto' : k_side_fianchetto, 'wq_side_fianchetto' : q_side_fianchetto, 'wb_mobility' : bishop_attack_counter, 'wlong_diagonal_control' : long_diag_turns, 'wopposite_color_b': opp_color, 'b_p_coherency' : bishop_pawns}
+
+        return return_dict
 
 def minor_features(game_dict):
     ## Various combined minor piece features:
@@ -879,162 +1917,166 @@ def minor_features(game_dict):
     return return_dict
 
 def rook_features(game_dict):
-    ## Some helpful variables
-    open_files = 0          # Measured in (mid_game_turn, end_game_turn)
-    semi_open_files = 0     # Measured in (mid_game_turn, end_game_turn)
-    back_rank_rook = 0      # Measured in (0, end_game_turn)
-    doubled_rooks = 0       # Measured in (mid_game_turn, end_game_turn)
-    doubled_with_queen = 0  # Measured in (mid_game_turn, end_game_turn)
-    rook_mobility = 0       # Measured in (mid_game_turn, end_game_turn)
-
-    back_rank = 6
-
-    rook_turns = 0
-    
-    ## Get middle and end game indices if they exist
-    # Set them to the end of the game if they do not
-    mid_game_turn = game_dict['middle_game_index']
-    if (mid_game_turn == None):
-        mid_game_turn = len(game_dict['board_states']) - 1
-
-    end_game_turn = game_dict['end_game_index']
-    if (end_game_turn == None):
-        end_game_turn = len(game_dict['board_states']) - 1
-
-    ## Iterate through the early game
-    # back_rank_rook is the only feature to be detected here 
-    for i in range(mid_game_turn):
-        board = game_dict['board_states'][i]
-
-        white_pieces, black_pieces = get_piece_locations(board)
-        rooks = white_pieces['R']
-        ## For each rook, check if its on the opponents back pawn rank
-        # (change the back_rank variable to test for black)
-        for rook in rooks:
-            if (rook[1] == back_rank):
-                back_rank_rook += 1
-
-    ## Iterate through the middle game
-    # All rook features get tested here
-    for i in range(mid_game_turn, end_game_turn):
-        board = game_dict['board_states'][i]
-
-        white_pieces, black_pieces = get_piece_locations(board)
-        rooks = white_pieces['R']
-        queens = white_pieces['Q']
-        if (len(rooks) > 0):
-            rook_turns += 1
-        ## Check individual rook properties
-        for rook in rooks:
-            if (rook[1] == back_rank):
-                back_rank_rook += 1
-            ## My favorite line of python to date
-            if all([rook[0] != pawn[0] for pawn in white_pieces['P']]):
-                if all([rook[0] != pawn[0] for pawn in black_pieces['P']]):
-                    open_files += 1
-                else:
-                    semi_open_files += 1
-            for rook2 in rooks:
-                ## Check if the rooks are on the same file
-                if ((rook[0] == rook2[0]) and (rooks.index(rook) < rooks.index(rook2))):
-                    doubled_rooks += 1
-
-            for queen in queens:
-                if (rook[0] == queen[0]):
-                    doubled_with_queen += 1
-        ## We load in the FEN, and make it a pychess Board object to calculate legal moves more quickly
-        fen_board = chess.Board(game_dict['board_states_FEN'][i])
-        for move in fen_board.legal_moves:
-            if (str(fen_board.piece_at(move.from_square)) == 'R'):
-                rook_mobility += 1
-
-
-        ## Normalize all the metrics by game length:
-        # But don't want to divide by zero:
-    if (end_game_turn - mid_game_turn > 0):
-        open_files = open_files/ (end_game_turn - mid_game_turn)
-        semi_open_files = semi_open_files / (end_game_turn - mid_game_turn)
-        doubled_rooks = doubled_rooks / (end_game_turn - mid_game_turn)
-        doubled_with_queen = doubled_with_queen / (end_game_turn - mid_game_turn)
-    if rook_turns > 0:
-        rook_mobility = rook_mobility / rook_turns
-    if (end_game_turn > 0):
-        back_rank_rook = back_rank_rook / end_game_turn
-    return_dict = {'wopen_files' : open_files, 'wsemi_open_files' : semi_open_files, 'wback_rank_r' : back_rank_rook, 'wdoubled_r' : doubled_rooks, 'wdoubled_with_q' : doubled_with_queen, 'wr_mobility' : rook_mobility}
-
-    return return_dict
+    return replay_game(game_dict, [RookVisitor(game_dict)])[0]
+
+## The visitor behind rook_features, the board is only needed for the rook mobility in the middle game
+class RookVisitor(FeatureVisitor):
+    def __init__(self, game_dict):
+        FeatureVisitor.__init__(self, game_dict)
+        self.rook_mobility = 0
+        self.mobility_plies = range(*middle_game_range(game_dict))
+
+    def visit(self, board, move, ply):
+        # (only white's rooks, which can only move on white's turns)
+        if ply in self.mobility_plies and board.turn == chess.WHITE:
+            self.rook_mobility += int(mobility(board).counts[chess.WHITE][chess.ROOK])
+
+    def result(self):
+        game_dict = self.game_dict
+        ## Some helpful variables
+        open_files = 0          # Measured in (mid_game_turn, end_game_turn)
+        semi_open_files = 0     # Measured in (mid_game_turn, end_game_turn)
+        back_rank_rook = 0      # Measured in (0, end_game_turn)
+        doubled_rooks = 0       # Measured in (mid_game_turn, end_game_turn)
+        doubled_with_queen = 0  # Measured in (mid_game_turn, end_game_turn)
+        rook_mobility = self.rook_mobility       # Measured in (mid_game_turn, end_game_turn), counted in visit
+
+        back_rank = 6
+
+        rook_turns = 0
+        
+        ## Get middle and end game indices if they exist
+        # Set them to the end of the game if they do not
+        mid_game_turn, end_game_turn = middle_game_range(game_dict)
+
+        ## Iterate through the early game
+        # back_rank_rook is the only feature to be detected here 
+        for i in range(mid_game_turn):
+            board = game_dict['board_states'][i]
+
+            white_pieces, black_pieces = get_piece_locations(board)
+            rooks = white_pieces['R']
+            ## For each rook, check if its on the opponents back pawn rank
+            # (change the back_rank variable to test for black)
+            for rook in rooks:
+                if (rook[1] == back_rank):
+                    back_rank_rook += 1
+
+        ## Iterate through the middle game
+        # All rook features get tested here
+        for i in range(mid_game_turn, end_game_turn):
+            board = game_dict['board_states'][i]
+
+            white_pieces, black_pieces = get_piece_locations(board)
+            rooks = white_pieces['R']
+            queens = white_pieces['Q']
+            if (len(rooks) > 0):
+                rook_turns += 1
+            ## Check individual rook properties
+            for rook in rooks:
+                if (rook[1] == back_rank):
+                    back_rank_rook += 1
+                ## My favorite line of python to date
+                if all([rook[0] != pawn[0] for pawn in white_pieces['P']]):
+                    if all([rook[0] != pawn[0] for pawn in black_pieces['P']]):
+                        open_files += 1
+                    else:
+                        semi_open_files += 1
+                for rook2 in rooks:
+                    ## Check if the rooks are on the same file
+                    if ((rook[0] == rook2[0]) and (rooks.index(rook) < rooks.index(rook2))):
+                        doubled_rooks += 1
+
+                for queen in queens:
+                    if (rook[0] == queen[0]):
+                        doubled_with_queen += 1
+
+
+            ## Normalize all the metrics by game length:
+            # But don't want to divide by zero:
+        if (end_game_turn - mid_game_turn > 0):
+            open_files = open_files/ (end_game_turn - mid_game_turn)
+            semi_open_files = semi_open_files / (end_game_turn - mid_game_turn)
+            doubled_rooks = doubled_rooks / (end_game_turn - mid_game_turn)
+            doubled_with_queen = doubled_with_queen / (end_game_turn - mid_game_turn)
+        if rook_turns > 0:
+            rook_mobility = rook_mobility / rook_turns
+        if (end_game_turn > 0):
+            back_rank_rook = back_rank_rook / end_game_turn
+        return_dict = {'wopen_files' : open_files, 'wsemi_open_files' : semi_open_files, 'wback_rank_r' : back_rank_rook, 'wdoubled_r' : doubled_rooks, 'wdoubled_with_q' : doubled_with_queen, 'wr_mobility' : rook_mobility}
+
+        return return_dict
 
 def queen_features(game_dict):
-    ## Some helpful variables
-    queen_aggression = 0     # Measured in (0, mid_game_turn)
-    queeinchetto = 0        # Measured in (0, mid_game_turn)
-    queenvasion = 0         # Measured in (0, end_game_turn)
-    queen_mobility = 0       # Measured in (0, end_game_turn)
-
-    back_rank = 6
-    queen_turns = 0
-
-    ## Get middle and end game indices if they exist
-    # Set them to the end of the game if they do not
-    mid_game_turn = game_dict['middle_game_index']
-    if (mid_game_turn == None):
-        mid_game_turn = len(game_dict['board_states']) - 1
-
-    end_game_turn = game_dict['end_game_index']
-    if (end_game_turn == None):
-        end_game_turn = len(game_dict['board_states']) - 1
-
-    for i in range(mid_game_turn):
-        board = game_dict['board_states'][i]
-
-        white_pieces, black_pieces = get_piece_locations(board)
-        queens = white_pieces['Q']
-        if (len(queens) > 0):
-            queen_turns += 1
-        for queen in queens:
-            ## For black, turn this into 7 - queen[1]
-            queen_aggression += queen[1]
-            
-            ## Check for queeinchettos
-            if ((queen == (1,1)) or (queen == (6,1))):
-                queeinchetto = 1
-
-            if (queen[1] == back_rank):
-                queenvasion += 1
-
-        fen_board = chess.Board(game_dict['board_states_FEN'][i])
-        ## Sum up all possible queen moves
-        for move in fen_board.legal_moves:
-            if (str(fen_board.piece_at(move.from_square)) == 'Q'):
-                queen_mobility += 1
+    return replay_game(game_dict, [QueenVisitor(game_dict)])[0]
+
+## The visitor behind queen_features, the board is only needed for the queen mobility up to the end game
+class QueenVisitor(FeatureVisitor):
+    def __init__(self, game_dict):
+        FeatureVisitor.__init__(self, game_dict)
+        self.queen_mobility = 0
+        self.mobility_plies = range(max(middle_game_range(game_dict)))
+
+    def visit(self, board, move, ply):
+        if ply in self.mobility_plies and board.turn == chess.WHITE:
+            ## Sum up all possible queen moves (white's, on white's turns)
+            self.queen_mobility += int(mobility(board).counts[chess.WHITE][chess.QUEEN])
+
+    def result(self):
+        game_dict = self.game_dict
+        ## Some helpful variables
+        queen_aggression = 0     # Measured in (0, mid_game_turn)
+        queeinchetto = 0        # Measured in (0, mid_game_turn)
+        queenvasion = 0         # Measured in (0, end_game_turn)
+        queen_mobility = self.queen_mobility       # Measured in (0, end_game_turn), counted in visit
+
+        back_rank = 6
+        queen_turns = 0
+
+        ## Get middle and end game indices if they exist
+        # Set them to the end of the game if they do not
+        mid_game_turn, end_game_turn = middle_game_range(game_dict)
+
+        for i in range(mid_game_turn):
+            board = game_dict['board_states'][i]
+
+            white_pieces, black_pieces = get_piece_locations(board)
+            queens = white_pieces['Q']
+            if (len(queens) > 0):
+                queen_turns += 1
+            for queen in queens:
+                ## For black, turn this into 7 - queen[1]
+                queen_aggression += queen[1]
+                
+                ## Check for queeinchettos
+                if ((queen == (1,1)) or (queen == (6,1))):
+                    queeinchetto = 1
 
-    for i in range(mid_game_turn, end_game_turn):
-        board = game_dict['board_states'][i]
+                if (queen[1] == back_rank):
+                    queenvasion += 1
 
-        white_pieces, black_pieces = get_piece_locations(board)
-        queens = white_pieces['Q']
+        for i in range(mid_game_turn, end_game_turn):
+            board = game_dict['board_states'][i]
 
-        for queen in queens:
-            if (queen[1] == back_rank):
-                queenvasion += 1
+            white_pieces, black_pieces = get_piece_locations(board)
+            queens = white_pieces['Q']
 
-        fen_board = chess.Board(game_dict['board_states_FEN'][i])
+            for queen in queens:
+                if (queen[1] == back_rank):
+                    queenvasion += 1
 
-        for move in fen_board.legal_moves:
-            if (str(fen_board.piece_at(move.from_square)) == 'Q'):
-                queen_mobility += 1
+        ## As always, the normalization:
+        if (mid_game_turn > 0):
+            queeinchetto = queeinchetto / mid_game_turn
+        if (end_game_turn > 0):
+            queenvasion = queenvasion / end_game_turn
+            queen_mobility = queen_mobility / end_game_turn
+        if (queen_turns > 0):
+            queen_aggression = queen_aggression / queen_turns 
+        return_dict = {'wq_aggression' : queen_aggression, 'wq_fianchetto' : queeinchetto, 'wq_invasion' : queenvasion, 'wq_mobility' : queen_mobility}
 
-    ## As always, the normalization:
-    if (mid_game_turn > 0):
-        queeinchetto = queeinchetto / mid_game_turn
-    if (end_game_turn > 0):
-        queenvasion = queenvasion / end_game_turn
-        queen_mobility = queen_mobility / end_game_turn
-    if (queen_turns > 0):
-        queen_aggression = queen_aggression / queen_turns 
-    return_dict = {'wq_aggression' : queen_aggression, 'wq_fianchetto' : queeinchetto, 'wq_invasion' : queenvasion, 'wq_mobility' : queen_mobility}
+        return return_dict
 
-    return return_dict
 ### White development
 ### Outputs a list [A,B,C,D,E,A#,B#,C#,D#,E#,side] where
 ### A,B,C,D,E : one-hots for ECO codes (include E for now, can simplify stratifying by opening later)
@@ -1073,7 +2115,8 @@ def white_development(game_dict):
             if pieces[i][j] != starting_board[i][j]:
                 pieces_moved = pieces_moved + 1
                 weight = weight + i
-    output[-1] = (weight / pieces_moved) / 3.5 - 1
+    # (missing if no piece has moved yet, see FEATURE_SCHEMA)
+    output[-1] = (weight / pieces_moved) / 3.5 - 1 if pieces_moved else np.nan
     
     return {'A': output[0],'B': output[1],'C': output[2],'D': output[3], 'E': output[4],
             'A#': output[5],'B#': output[6],'C#': output[7],'D#': output[8],'E#': output[9],'w_development_side': output[10]}
@@ -1151,99 +2194,38 @@ def white_castling(game_dict):
 ###
 ### If the midgame had length 0, pretend it had length 1
 def white_pawns(game_dict):
-    
-    # First get all the relevant indices for board_states
-    midgame_index = game_dict['middle_game_index']
-    mid_midgame_index = mid_midgame(game_dict)
-    endgame_index = game_dict['end_game_index']
-    
-    # If any of these are None then that could mess with computations
-    # So replace None with the maximum index
-    midgame_index = cap_index(midgame_index, game_dict)
-    mid_midgame_index = cap_index(mid_midgame_index, game_dict)
-    endgame_index = cap_index(endgame_index, game_dict)
-    
-    ## First calculate the stats that aren't averaged over the midgame
-    
-    ## King protection
-    # Only consider pawns within 2 horizontally and 3 vertically from our king
-    # Pawns within 1 horizontally from king get weight 1
-    # Pawns 2 horizontally from king get weight 0.5
-    # When P is n units from K vertically, I'll assign some float [0,1] of 'protection' it gives to K
-    king = game_dict['white_pieces'][mid_midgame_index]['K'][0]
-    pawns = game_dict['white_pieces'][mid_midgame_index]['P']
-    king_protection = 0
-    for pawn in pawns:
-        m = abs(pawn[0]-king[0])
-        n = abs(pawn[1]-king[1])
-        # Check we're not too far from the king
-        if (m > 2) | (n > 3): continue
-        # Assign weight to the pawn
-        protection = 0
-        if n == 1:
-            protection = 1
-        elif n == 2:
-            protection = 0.8
-        elif n == 3:
-            protection = 0.4
-        # If it's 2 horitontally from the king,
-        if m == 2:
-            protection = protection / 2
-        king_protection = king_protection + protection
-    
-    ## Color
-    pawns = game_dict['white_pieces'][endgame_index]['P']
-    # If the sum of the coords is even it is dark square, if it is odd it is light square
-    # So this next array has 1 for light square, 0 for dark square; the mean is the fraction light square
-    color = np.mean([(pawn[0] + pawn[1]) % 2 for pawn in pawns])
-    
-    # Next, scale so that it is in the range [-1,1], 0 if there were no pawns
-    if np.isnan(color):
-        color = 0
-    else:
-        color = (color * 2) - 1
-    
-    # In case there was no midgame, pretend there was a midgame of length 1
-    # Doing this now instead of at the start to avoid the indexing arrow in the "color =" line
-    if endgame_index == midgame_index:
-        endgame_index = midgame_index + 1
-    
-    ## En passant
-    # We have indices for board states, so the indices for white's moves will be (roughly) the same but divided by 2
-    # Almost issue: if midgame_index is the last index of board_states and is odd,
-    #  taking ceil() will give an index out of range for white_moves
-    # But in that case, endgame_index will also be that maximal value (+1)
-    # So ceil(midgame_index) > floor(endgame_index), thus there's no indexing issue because we get the empty list
-    moves = game_dict['white_moves'][int(np.ceil(midgame_index / 2)) : int(np.floor(endgame_index / 2))]
-    pawn_moves = [move for move in moves if move['piece'] == 'P']
-    en_passant_moves = [1 for move in pawn_moves if move['special'] == 'p']
-    en_passant = len(en_passant_moves) / max(len(pawn_moves),1)
-    
-    
-    ## Non-queen
-    moves = game_dict['white_moves']
-    promotions = [move for move in moves if ((move['piece'] == 'P') & (move['to'][1] == 7))]
-    if len(promotions) == 0:
-        non_queen = 0
-    else:
-        non_queen_promotions = [1 for move in promotions if move['special'] != 'Q']
-        non_queen = len(non_queen_promotions) / len(promotions)
-    
-    ## Now calculate the stats that are averaged over the midgame
-    # So have a list of running totals to be averaged at the end
-    
-    # For each board state, calculate the stats and add to the running totals
-    # totals = [center, doubled, isolated, backwards, forward, guarded_forward, storming, chains, long_chains]
-    # At the end, take the averages
-    totals = np.zeros(10)
-    
-    for i in range(midgame_index,endgame_index):
+    return replay_game(game_dict, [PawnVisitor(game_dict)])[0]
+
+## The visitor behind white_pawns, the board is used for the stats that are averaged over the midgame
+class PawnVisitor(FeatureVisitor):
+    def __init__(self, game_dict):
+        FeatureVisitor.__init__(self, game_dict)
+        ## The running totals for each board state of the midgame (see ply_totals)
+        self.totals = {}
+        self.out_of_pawns = False
+
+        midgame_index = cap_index(game_dict['middle_game_index'], game_dict)
+        endgame_index = cap_index(game_dict['end_game_index'], game_dict)
+        if endgame_index == midgame_index:
+            endgame_index = midgame_index + 1
+        self.midgame_plies = range(midgame_index, endgame_index)
+
+    def visit(self, board, move, ply):
+        # Once we're out of pawns nothing more is added to the running totals
+        if (ply in self.midgame_plies) and (not self.out_of_pawns):
+            self.totals[ply] = self.ply_totals(board, ply)
+            self.out_of_pawns = self.totals[ply] is None
+
+    ## The midgame stats for board state i, or None if white has no pawns left
+    ## [center, doubled, isolated, backwards, tension, forward, guarded_forward, storming, chains, long_chains]
+    def ply_totals(self, board, i):
+        game_dict = self.game_dict
         # Things from the dictionary
-        FEN = game_dict['board_states_FEN'][i]
         pawns = game_dict['white_pieces'][i]['P']
         
-        # If we're out of pawns nothing will be added to the running totals, so we're done
-        if len(pawns) == 0: break
+        # If we're out of pawns nothing will be added to the running totals
+        if len(pawns) == 0: return None
+        attacks = attack_map(board)
         
         ## Center strength
         center_strength = 0
@@ -1251,7 +2233,7 @@ def white_pawns(game_dict):
             x = pawn[0]
             y = pawn[1]
             # Only look at c,d,e,f file pawns that are guarded
-            if (x > 1) & (x < 6) & (len(is_guarded(pawn,FEN)) > 0):
+            if (x > 1) & (x < 6) & (attacks.defender_counts[chess.WHITE][chess.square(x, y)] > 0):
                 # The center presence of the pawn is 1 / (its Euclidean distance to the center of the board)
                 center_strength = center_strength + 1 / np.sqrt((x-3.5)**2 + (y-3.5)**2)
         
@@ -1311,22 +2293,19 @@ def white_pawns(game_dict):
         
         
         ## Pawn tension
-        board = chess.Board(FEN)
-        
         # Find squares black pawns occupy
-        black = set([chess.square(pawn[0],pawn[1]) for pawn in game_dict['black_pieces'][i]['P']])
+        black = board.pieces_mask(chess.PAWN, chess.BLACK)
         
         # Now for each of our pawns, count how many black pawns it is attacking to get the pawn tension
         tension = 0
         for pawn in pawns:
-            attacks = set(board.attacks(chess.square(pawn[0],pawn[1])))
-            tension = tension + len(attacks & black)
+            tension = tension + chess.popcount(attacks.attacks[chess.square(pawn[0],pawn[1])] & black)
         
         
         ## Forwardness and guarded_forwardness
         forwardness = np.mean([pawn[1] for pawn in pawns])
         # Find the ranks of the guarded forward pawns
-        gf_pawns = [pawn[1] for pawn in pawns if ((pawn[1] > 3) & (len(is_guarded(pawn,FEN)) > 0))]
+        gf_pawns = [pawn[1] for pawn in pawns if ((pawn[1] > 3) & (attacks.defender_counts[chess.WHITE][chess.square(pawn[0], pawn[1])] > 0))]
         guarded_forwardness = sum(gf_pawns) - len(gf_pawns) * 3
         
         
@@ -1367,20 +2346,113 @@ def white_pawns(game_dict):
             longest_chain = max(d_longest,u_longest,longest_chain)
         
         
-        ## Add these values to our running totals
-        totals = totals + [center_strength, doubled, isolated, backward, tension,
-                           forwardness, guarded_forwardness, storming, chain_count, longest_chain]
+        ## These values get added to our running totals
+        return [center_strength, doubled, isolated, backward, tension,
+                forwardness, guarded_forwardness, storming, chain_count, longest_chain]
+
+    def result(self):
+        game_dict = self.game_dict
+    
+        # First get all the relevant indices for board_states
+        midgame_index = game_dict['middle_game_index']
+        mid_midgame_index = mid_midgame(game_dict)
+        endgame_index = game_dict['end_game_index']
     
-    # Take that average and give things names
-    [center_strength, doubled, isolated, backward, tension,
-     forwardness, guarded_forwardness, storming, chain_count, longest_chain] = totals / (endgame_index - midgame_index)
+        # If any of these are None then that could mess with computations
+        # So replace None with the maximum index
+        midgame_index = cap_index(midgame_index, game_dict)
+        mid_midgame_index = cap_index(mid_midgame_index, game_dict)
+        endgame_index = cap_index(endgame_index, game_dict)
     
-    # Le return
-    return {'wp_king_protection': king_protection, 'wp_center_strength': center_strength,
-            'wp_doubled': doubled, 'wp_isolated': isolated, 'wp_backward': backward,
-            'wp_tension': tension, 'wp_color': color, 'wp_forwardness': forwardness, 'wp_guarded_forwardness': guarded_forwardness,
-            'wp_en_passant': en_passant, 'wp_storming': storming,
-            'wp_chain_count': chain_count, 'wp_longest_chain': longest_chain, 'wp_non_queen': non_queen}
+        ## First calculate the stats that aren't averaged over the midgame
+    
+        ## King protection
+        # Only consider pawns within 2 horizontally and 3 vertically from our king
+        # Pawns within 1 horizontally from king get weight 1
+        # Pawns 2 horizontally from king get weight 0.5
+        # When P is n units from K vertically, I'll assign some float [0,1] of 'protection' it gives to K
+        king = game_dict['white_pieces'][mid_midgame_index]['K'][0]
+        pawns = game_dict['white_pieces'][mid_midgame_index]['P']
+        king_protection = 0
+        for pawn in pawns:
+            m = abs(pawn[0]-king[0])
+            n = abs(pawn[1]-king[1])
+            # Check we're not too far from the king
+            if (m > 2) | (n > 3): continue
+            # Assign weight to the pawn
+            protection = 0
+            if n == 1:
+                protection = 1
+            elif n == 2:
+                protection = 0.8
+            elif n == 3:
+                protection = 0.4
+            # If it's 2 horitontally from the king,
+            if m == 2:
+                protection = protection / 2
+            king_protection = king_protection + protection
+    
+        ## Color
+        pawns = game_dict['white_pieces'][endgame_index]['P']
+        # If the sum of the coords is even it is dark square, if it is odd it is light square
+        # So this next array has 1 for light square, 0 for dark square; the mean is the fraction light square
+        color = np.mean([(pawn[0] + pawn[1]) % 2 for pawn in pawns])
+    
+        # Next, scale so that it is in the range [-1,1], 0 if there were no pawns
+        if np.isnan(color):
+            color = 0
+        else:
+            color = (color * 2) - 1
+    
+        # In case there was no midgame, pretend there was a midgame of length 1
+        # Doing this now instead of at the start to avoid the indexing arrow in the "color =" line
+        if endgame_index == midgame_index:
+            endgame_index = midgame_index + 1
+    
+        ## En passant
+        # We have indices for board states, so the indices for white's moves will be (roughly) the same but divided by 2
+        # Almost issue: if midgame_index is the last index of board_states and is odd,
+        #  taking ceil() will give an index out of range for white_moves
+        # But in that case, endgame_index will also be that maximal value (+1)
+        # So ceil(midgame_index) > floor(endgame_index), thus there's no indexing issue because we get the empty list
+        moves = game_dict['white_moves'][int(np.ceil(midgame_index / 2)) : int(np.floor(endgame_index / 2))]
+        pawn_moves = [move for move in moves if move['piece'] == 'P']
+        en_passant_moves = [1 for move in pawn_moves if move['special'] == 'p']
+        en_passant = len(en_passant_moves) / max(len(pawn_moves),1)
+    
+    
+        ## Non-queen
+        moves = game_dict['white_moves']
+        promotions = [move for move in moves if ((move['piece'] == 'P') & (move['to'][1] == 7))]
+        if len(promotions) == 0:
+            non_queen = 0
+        else:
+            non_queen_promotions = [1 for move in promotions if move['special'] != 'Q']
+            non_queen = len(non_queen_promotions) / len(promotions)
+    
+        ## Now calculate the stats that are averaged over the midgame
+        # So have a list of running totals to be averaged at the end
+    
+        # For each board state, calculate the stats and add to the running totals
+        # totals = [center, doubled, isolated, backwards, forward, guarded_forward, storming, chains, long_chains]
+        # At the end, take the averages
+        totals = np.zeros(10)
+    
+        for i in range(midgame_index,endgame_index):
+            # If we're out of pawns nothing will be added to the running totals, so we're done
+            if self.totals.get(i) is None: break
+            totals = totals + self.totals[i]
+    
+        # Take that average and give things names
+        [center_strength, doubled, isolated, backward, tension,
+         forwardness, guarded_forwardness, storming, chain_count, longest_chain] = totals / (endgame_index - midgame_index)
+    
+        # Le return
+        return {'wp_king_protection': king_protection, 'wp_center_strength': center_strength,
+                'wp_doubled': doubled, 'wp_isolated': isolated, 'wp_backward': backward,
+                'wp_tension': tension, 'wp_color': color, 'wp_forwardness': forwardness, 'wp_guarded_forwardness': guarded_forwardness,
+                'wp_en_passant': en_passant, 'wp_storming': storming,
+                'wp_chain_count': chain_count, 'wp_longest_chain': longest_chain, 'wp_non_queen': non_queen}
 
 
 ### White board
@@ -1399,26 +2471,34 @@ def white_pawns(game_dict):
 ###
 ### If the midgame has length 0, just take their value at the index of the midgame
 def white_board(game_dict):
-    # First get all the relevant indices for board_states
-    midgame_index = game_dict['middle_game_index']
-    endgame_index = game_dict['end_game_index']
-    midgame_index = cap_index(midgame_index, game_dict)
-    endgame_index = cap_index(endgame_index, game_dict)
-    
-    # In case there was no midgame, pretend there was a midgame of length 1
-    if endgame_index == midgame_index:
-        endgame_index = midgame_index + 1
-    
-    # For each board state, calculate the stats and add to the running totals
-    # At the end, take the averages
-    
-    output = np.zeros(8)
-    
-    for i in range(midgame_index,endgame_index):
+    return replay_game(game_dict, [BoardVisitor(game_dict)])[0]
+
+## The visitor behind white_board, the board is used for the squares attacked by white in the midgame
+class BoardVisitor(FeatureVisitor):
+    # This board of all kings makes it easy to determine the adjacent squares, since that would be the squares a king attacks
+    adjacency_object = chess.Board(('K'*8+'/')*7+'K'*8)
+
+    def __init__(self, game_dict):
+        FeatureVisitor.__init__(self, game_dict)
+        ## The running totals for each board state of the midgame (see ply_totals)
+        self.totals = {}
+
+        midgame_index = cap_index(game_dict['middle_game_index'], game_dict)
+        endgame_index = cap_index(game_dict['end_game_index'], game_dict)
+        if endgame_index == midgame_index:
+            endgame_index = midgame_index + 1
+        self.midgame_plies = range(midgame_index, endgame_index)
+
+    def visit(self, board, move, ply):
+        if ply in self.midgame_plies:
+            self.totals[ply] = self.ply_totals(board, ply)
+
+    ## The stats for board state i, [rank, file, density, attack, pawn_pref, minor_pref, rook_pref, queen_pref]
+    def ply_totals(self, board, i):
+        game_dict = self.game_dict
         # Things from the dictionary
         white_pieces = game_dict['white_pieces'][i]
         black_pieces = game_dict['black_pieces'][i]
-        board_object = chess.Board(game_dict['board_states_FEN'][i])
 
         # Formats the dictionaries as lists of coordinates of spaces occupied
         white_coordinates = [coords for piece in white_pieces.values() for coords in piece]
@@ -1436,19 +2516,16 @@ def white_board(game_dict):
         file = np.mean([coords[0] for coords in white_coordinates]) - 3.5
         
         ## Density
-        # This board of all kings makes it easy to determine the adjacent squares, since that would be the squares a king attacks
-        K = 'K'*8
-        adjacency_object = chess.Board((K+'/')*7+K)
-        
+        # (adjacency_object makes it easy to determine the adjacent squares, see above)
         # Divide the number of pieces adjacent to our pieces by the number of squares adjacent to our pieces
         adjacent_squares = white_locations
         for loc in white_locations:
-            adjacent_squares = adjacent_squares | set([square for square in adjacency_object.attacks(loc)])
+            adjacent_squares = adjacent_squares | set([square for square in self.adjacency_object.attacks(loc)])
         density = len(adjacent_squares & all_locations) / len(adjacent_squares)
         
         ## Attack
         # Some nice job security code
-        num_attacked = len(set([square for loc in white_locations for square in board_object.attacks(loc)]))
+        num_attacked = len(set([square for loc in white_locations for square in board.attacks(loc)]))
         
         ## Pref
         
@@ -1485,13 +2562,33 @@ def white_board(game_dict):
         else:
             queen_pref = white / (white+black)
         
-        # Add to our running totals for the output
-        output = output + [rank,file,density,num_attacked,pawn_pref,minor_pref,rook_pref,queen_pref]
+        # These get added to our running totals for the output
+        return [rank,file,density,num_attacked,pawn_pref,minor_pref,rook_pref,queen_pref]
+
+    def result(self):
+        game_dict = self.game_dict
+        # First get all the relevant indices for board_states
+        midgame_index = game_dict['middle_game_index']
+        endgame_index = game_dict['end_game_index']
+        midgame_index = cap_index(midgame_index, game_dict)
+        endgame_index = cap_index(endgame_index, game_dict)
     
-    output = output / (endgame_index - midgame_index)
+        # In case there was no midgame, pretend there was a midgame of length 1
+        if endgame_index == midgame_index:
+            endgame_index = midgame_index + 1
     
-    return {'wb_rank': output[0], 'wb_file': output[1], 'wb_density': output[2], 'wb_attack': output[3],
-            'wb_pawn_pref': output[4], 'wb_minor_pref': output[5], 'wb_rook_pref': output[6], 'wb_queen_pref': output[7]}
+        # For each board state, calculate the stats and add to the running totals
+        # At the end, take the averages
+    
+        output = np.zeros(8)
+    
+        for i in range(midgame_index,endgame_index):
+            output = output + self.totals[i]
+    
+        output = output / (endgame_index - midgame_index)
+    
+        return {'wb_rank': output[0], 'wb_file': output[1], 'wb_density': output[2], 'wb_attack': output[3],
+                'wb_pawn_pref': output[4], 'wb_minor_pref': output[5], 'wb_rook_pref': output[6], 'wb_queen_pref': output[7]}
 
 ### White clusters
 ### Outputs a list
@@ -1563,86 +2660,129 @@ def white_clusters(game_dict):
 ### black king with another piece
 
 def discovered_checks(gameDict):
-	discovered_checks_set_up = 0
-	discovered_checks_chances = 0
-	discovered_checks_given = 0
-
-	#looks at where there was a discovered check given
-	# goes through white moves and see where there was a check
-	check_list = []
-	for i in range(0, len(gameDict['white_moves'])):
-		if gameDict['white_moves'][i]['check'] != '':
-			check_list.append(i)
-	
-	# goes through the list of checks and sees if the check was a discovered check
-	for i in check_list:	
-		#loads board_state_FEN corresponding to after the move
-		fen = gameDict["board_states_FEN"][2*i]
-		board = chess.Board(fen)
-		
-		#gets list of attackers on the black king
-		attackers = board.attackers(chess.WHITE, board.king(chess.BLACK))
-	
-		#checks if there is an attacker that is not the piece moved
-		move_square = chess.square(gameDict['white_moves'][i]['to'][0], gameDict['white_moves'][i]['to'][1])
-		if move_square in attackers: attackers.remove(move_square)
-		if len(attackers) > 0:
-			discovered_checks_given  += 1
-
-	#goes through to see list of where a discovered check could be given
-	for i in range(1, len(gameDict['white_moves'])):
-		# create board state before white's move
-		board = chess.Board(gameDict['board_states_FEN'][2*i -1])
-		check_chance_flag = 0	
-
-		for move in board.legal_moves:
-			if board.gives_check(move):
-				board1 = board.copy()
-				board1.push(move)
-				
-								
+	return replay_game(gameDict, [DiscoveredCheckVisitor(gameDict)])[0]
+
+## The visitor behind discovered_checks
+class DiscoveredCheckVisitor(FeatureVisitor):
+	def __init__(self, gameDict):
+		FeatureVisitor.__init__(self, gameDict)
+		self.discovered_checks_set_up = 0
+		self.discovered_checks_chances = 0
+		self.discovered_checks_given = 0
+
+	def visit(self, board, move, ply):
+		gameDict = self.game_dict
+		i = ply // 2
+
+		if ply % 2 == 0:
+			#looks at where there was a discovered check given
+			# (the board is after white's move i, and there was a check)
+			if gameDict['white_moves'][i]['check'] != '' and self.wants('discovered_checks_given'):
 				#gets list of attackers on the black king
-				attackers = board1.attackers(chess.WHITE, board1.king(chess.BLACK))
+				attackers = board.attackers(chess.WHITE, board.king(chess.BLACK))
+			
 				#checks if there is an attacker that is not the piece moved
-				move_square = 	move.to_square
+				move_square = chess.square(gameDict['white_moves'][i]['to'][0], gameDict['white_moves'][i]['to'][1])
 				if move_square in attackers: attackers.remove(move_square)
 				if len(attackers) > 0:
-					check_chance_flag  = 1
-		discovered_checks_chances += check_chance_flag
-
-	# check where a discovered check is set up. We define this to be move where, if black
-	# didn't move, there would be a discovered check chance, note this doesn't apply when
-	# there is a check
-	for i in range(1, len(gameDict['white_moves'])):
-		#checks if the move didn't just give check
-		if gameDict['white_moves'][i]['check'] == '':
-	
-			# get move for after  white's move and sets the move to white again
-			fen1  = gameDict['board_states_FEN'][2*i]
-			fen = fen1[: fen1.find(" b ") +1] + "w" + fen1[fen1.find(" b ") +2:]
-
-			# creates board and checks if there is a discovered check possible
-			board = chess.Board(fen)		
-			check_chance_flag = 0	
-
-			for move in board.legal_moves:
-				if board.gives_check(move):
-					board1 = board.copy()
-					board1.push(move)
-								
-					#gets list of attackers on the black king
-					attackers = board1.attackers(chess.WHITE, board1.king(chess.BLACK))
-	
-					#checks if there is an attacker that is not the piece moved
-					move_square = move.to_square
-					if move_square in attackers: 
-						attackers.remove(move_square)
-					if len(attackers) > 0:
-						check_chance_flag  = 1
-			discovered_checks_set_up += check_chance_flag
-
-	return {'discovered_checks_set_up' : discovered_checks_set_up, 'discovered_checks_given' :discovered_checks_given, 'discovered_checks_chances' :discovered_checks_chances}
-
+					self.discovered_checks_given  += 1
+
+			# check where a discovered check is set up. We define this to be move where, if black
+			# didn't move, there would be a discovered check chance, note this doesn't apply when
+			# there is a check
+			if i >= 1 and gameDict['white_moves'][i]['check'] == '' and self.wants('discovered_checks_set_up'):
+				# sets the move to white again after white's move
+				board1 = fen_board(board)
+				board1.turn = chess.WHITE
+				self.discovered_checks_set_up += has_discovered_check(board1)
+		else:
+			#looks at whether a discovered check could be given on white's next move (i + 1)
+			if i + 1 < len(gameDict['white_moves']) and self.wants('discovered_checks_chances'):
+				self.discovered_checks_chances += has_discovered_check(board)
+
+	def result(self):
+		return {'discovered_checks_set_up' : self.discovered_checks_set_up, 'discovered_checks_given' :self.discovered_checks_given, 'discovered_checks_chances' :self.discovered_checks_chances}
+
+## Helper function for discovered_checks
+## Returns 1 if white (to move) has a legal move giving check with a piece other than the one moved, 0 otherwise
+##
+## This is worked out from the lines to the black king instead of playing out every legal move: a move checks with
+## another piece when it takes the only piece between one of our sliders and the king off that line, when an en passant
+## capture removes the piece in the way, or when castling puts the rook on the king's line.
+## So for every slider lined up with the king with exactly one of our pieces in between, we look for a square that piece
+## can legally go to off the line (along its pin line if it is pinned, blocking or taking the checker if we are in check).
+## En passant and castling are checked with is_legal on the one move.
+def has_discovered_check(board):
+	color = board.turn
+	king = board.king(not color)
+	own_king = board.king(color)
+	if king is None or own_king is None: return 0
+	own = board.occupied_co[color]
+	enemy = board.occupied_co[not color]
+	occupied = board.occupied
+	forward = 8 if color == chess.WHITE else -8
+
+	# in check, a piece other than the king has to block or take the (single) checker
+	checkers = board.checkers_mask()
+	if not checkers:
+		evasions = chess.BB_ALL
+	elif checkers & (checkers - 1):
+		evasions = 0
+	else:
+		evasions = chess.between(own_king, chess.lsb(checkers)) | checkers
+
+	for slider in chess.scan_forward(own & (board.bishops | board.rooks | board.queens)):
+		slider_type = board.piece_type_at(slider)
+		file_distance = abs(chess.square_file(slider) - chess.square_file(king))
+		rank_distance = abs(chess.square_rank(slider) - chess.square_rank(king))
+		diagonal = file_distance == rank_distance and slider_type != chess.ROOK
+		straight = (file_distance == 0 or rank_distance == 0) and slider_type != chess.BISHOP
+		if not (diagonal or straight): continue
+
+		# exactly one piece in between, and it's ours
+		line = chess.between(slider, king)
+		blockers = line & occupied
+		if not blockers or blockers & (blockers - 1) or not blockers & own: continue
+		blocker = chess.lsb(blockers)
+
+		if blocker == own_king:
+			# any square off the line that isn't attacked once the king has left its square
+			for square in chess.scan_forward(chess.BB_KING_ATTACKS[blocker] & ~own & ~line):
+				if not board.attackers_mask(not color, square, occupied & ~blockers):
+					return 1
+			continue
+
+		if board.piece_type_at(blocker) == chess.PAWN:
+			targets = chess.BB_PAWN_ATTACKS[color][blocker] & enemy
+			push = blocker + forward
+			if not chess.BB_SQUARES[push] & occupied:
+				targets |= chess.BB_SQUARES[push]
+				if chess.BB_SQUARES[blocker] & (chess.BB_RANK_2 if color == chess.WHITE else chess.BB_RANK_7) and not chess.BB_SQUARES[push + forward] & occupied:
+					targets |= chess.BB_SQUARES[push + forward]
+		else:
+			targets = board.attacks_mask(blocker) & ~own
+		if targets & ~line & evasions & board.pin_mask(color, blocker):
+			return 1
+
+	# en passant also takes the captured pawn off its square
+	if board.ep_square is not None:
+		captured = board.ep_square - forward
+		for pawn in chess.scan_forward(board.pawns & own & chess.BB_PAWN_ATTACKS[not color][board.ep_square]):
+			if board.is_legal(chess.Move(pawn, board.ep_square)):
+				after = (occupied & ~chess.BB_SQUARES[pawn] & ~chess.BB_SQUARES[captured]) | chess.BB_SQUARES[board.ep_square]
+				if board.attackers_mask(color, king, after) & ~chess.BB_SQUARES[pawn]:
+					return 1
+
+	# castling, the rook gives check or the king uncovers a line
+	back_rank = 0 if color == chess.WHITE else 56
+	for rook_from, king_to, rook_to in [(back_rank + 7, back_rank + 6, back_rank + 5), (back_rank, back_rank + 2, back_rank + 3)]:
+		if own_king != back_rank + 4 or not board.castling_rights & chess.BB_SQUARES[rook_from]: continue
+		if not board.is_legal(chess.Move(own_king, king_to)): continue
+		after = (occupied & ~chess.BB_SQUARES[own_king] & ~chess.BB_SQUARES[rook_from]) | chess.BB_SQUARES[king_to] | chess.BB_SQUARES[rook_to]
+		rook_attacks = chess.BB_RANK_ATTACKS[rook_to][after & chess.BB_RANK_MASKS[rook_to]] | chess.BB_FILE_ATTACKS[rook_to][after & chess.BB_FILE_MASKS[rook_to]]
+		if rook_attacks & chess.BB_SQUARES[king] or board.attackers_mask(color, king, after) & ~chess.BB_SQUARES[own_king] & ~chess.BB_SQUARES[rook_from]:
+			return 1
+	return 0
 
 ### distribution_piece_moves function
 ###
@@ -1652,14 +2792,15 @@ def discovered_checks(gameDict):
 def distribution_piece_moves(gameDict):
 	dict = {'P_moves':0, 'N_moves':0, 'B_moves':0, 'R_moves':0, 'Q_moves':0, 'K_moves':0}
 
-	for i in range(0, len(gameDict['white_moves'])):
-		piece = gameDict['white_moves'][i]['piece']
-		if piece == 'O':
-			dict['K_moves'] +=1/len(gameDict['white_moves'])
-			dict['R_moves'] +=1/len(gameDict['white_moves'])
-		else: 
-			piece_code = piece + "_moves"
-			dict[piece_code] +=1/len(gameDict['white_moves'])
+	pieces = move_table(gameDict)['piece'][0::2]
+	if len(pieces) == 0: return dict
+
+	# castling counts as a king move and a rook move
+	castles = np.count_nonzero(pieces == b'O')
+	for piece in ['P', 'N', 'B', 'R', 'Q', 'K']:
+		count = np.count_nonzero(pieces == piece.encode())
+		if piece in ['R', 'K']: count += castles
+		dict[piece + '_moves'] = count / len(pieces)
 	return dict
 
 ### pins function
@@ -1670,121 +2811,146 @@ def distribution_piece_moves(gameDict):
 ### time_pinned : arrary of turns for continuous pins
 
 def pins(gameDict):
-	#creates a list of current pins
-	current_pins = {}	
+	return replay_game(gameDict, [PinVisitor(gameDict)])[0]
 
-	#creates a list of total pin and length
-	total_pins = []
+## The visitor behind pins
+class PinVisitor(FeatureVisitor):
+	def __init__(self, gameDict):
+		FeatureVisitor.__init__(self, gameDict)
+		#creates a list of current pins
+		self.current_pins = {}	
 
-	#counter for number of turns with black pinned
-	pins_given = 0
+		#creates a list of total pin and length
+		self.total_pins = []
 
-	#counts number of times black is pinned
-	for i in range(0, len(gameDict["black_pieces"])):
+		#counter for number of turns with black pinned
+		self.pins_given = 0
+
+	def visit(self, board, move, ply):
+		gameDict = self.game_dict
+		i = ply
+		# (white's plies are only needed for pins_given, black's for time_pinned)
+		if not self.wants('time_pinned' if i%2 else 'pins_given'): return
+
+		#finds every pinned piece at once
+		pinned = pinned_pieces(board)
+
+		#counts number of times black is pinned
 		if not i%2:
 			for pieces in gameDict["black_pieces"][i].values():
 				if len(pieces) == 0: break
 				for piece in pieces:
-					if is_pinned(piece, gameDict["board_states_FEN"][i]):
-						pins_given +=1
+					if pinned[chess.BLACK] & chess.BB_SQUARES[chess.square(piece[0], piece[1])]:
+						self.pins_given +=1
 	
-	#counts pins for white
-	for i in range(0, len(gameDict["white_pieces"])):
-		if i %2:
+		#counts pins for white
+		else:
+			current_pins = self.current_pins
 			#removes any pieces which are not pinned
 			for piece_str in current_pins.copy().keys():
 				#converts to piece integer tuple
 				piece = [int(piece_str[1]), int(piece_str[4])]
-				board = chess.Board(gameDict['board_states_FEN'][i])
-				if (not board.piece_at(chess.square(piece[0],piece[1]))) or board.piece_at(chess.square(piece[0],piece[1])).color == chess.BLACK or is_pinned(piece, gameDict["board_states_FEN"][i]) == False:
-					total_pins.append(current_pins.pop(piece_str))
+				if (not board.piece_at(chess.square(piece[0],piece[1]))) or board.piece_at(chess.square(piece[0],piece[1])).color == chess.BLACK or not pinned[chess.WHITE] & chess.BB_SQUARES[chess.square(piece[0],piece[1])]:
+					self.total_pins.append(current_pins.pop(piece_str))
 			for pieces in gameDict["white_pieces"][i].values():
 				if len(pieces) == 0:break
 				for piece in pieces:	
-					if is_pinned(piece, gameDict["board_states_FEN"][i]):
+					if pinned[chess.WHITE] & chess.BB_SQUARES[chess.square(piece[0], piece[1])]:
 						if str(piece) in current_pins:
 							current_pins[str(piece)] +=1
 						else: current_pins[str(piece)] =1
-	if len(total_pins):
-		pin_avg = np.mean(total_pins)
 
-	else: pin_avg = 0
-
-	#pops of all elements at the end
-	for key in current_pins.copy().keys():
-		total_pins.append(current_pins.pop(key))
-	return {"pins_given":pins_given, "time_pinned":	pin_avg}
+	def result(self):
+		total_pins = self.total_pins
+		# (only the pins that are over count, the ones still on at the end of the game are left out)
+		if len(total_pins):
+			pin_avg = np.mean(total_pins)
 
+		else: pin_avg = 0
+		return {"pins_given":self.pins_given, "time_pinned":	pin_avg}
 
 ### forks
 ### input: game dictionary
 ### output: number of forks given
 
 def forks(gameDict):
-	fork_counter = 0
+	return replay_game(gameDict, [ForkVisitor(gameDict)])[0]
 
-	for i in range(len(gameDict['white_pieces'])):
-		if i %2:
-			for pieces in gameDict["white_pieces"][i].values():
+## The visitor behind forks
+class ForkVisitor(FeatureVisitor):
+	def __init__(self, gameDict):
+		FeatureVisitor.__init__(self, gameDict)
+		self.fork_counter = 0
+
+	def visit(self, board, move, ply):
+		if ply %2:
+			for pieces in self.game_dict["white_pieces"][ply].values():
 				if len(pieces) == 0: break
 				for piece in pieces:
-					if gives_fork(piece, gameDict["board_states_FEN"][i]):
-						fork_counter += 1
-					
-	return {'fork_counter' : fork_counter}
+					if gives_fork(piece, board):
+						self.fork_counter += 1
 
+	def result(self):
+		return {'fork_counter' : self.fork_counter}
 
 ### pieces_guarded
 ### input: game dictionary
 ### output: average (over the mid-game) of number of pieces guarding attacked pieces divided by the number of attacked pieces times the number of pieces for white
 
 def pieces_guarded(gameDict):
-	# counters for number of pieces attacked, number of pieces guarding, and number of pieces for white
-	pieces_attacked = []
-	pieces_guarding = []
-	pieces_white = []
-	mean = 0
-
-	if gameDict["middle_game_index"] : mid_game = gameDict["middle_game_index"]
-	else: mid_game = len(gameDict['board_states']) -1
+	return replay_game(gameDict, [PiecesGuardedVisitor(gameDict)])[0]
+
+## The visitor behind pieces_guarded
+class PiecesGuardedVisitor(FeatureVisitor):
+	def __init__(self, gameDict):
+		FeatureVisitor.__init__(self, gameDict)
+		# counters for number of pieces attacked, number of pieces guarding, and number of pieces for white
+		self.pieces_attacked = []
+		self.pieces_guarding = []
+		self.pieces_white = []
+
+		if gameDict["middle_game_index"] : self.mid_game = gameDict["middle_game_index"]
+		else: self.mid_game = len(gameDict['board_states']) -1
+
+		if gameDict["end_game_index"] : self.end_game = gameDict["end_game_index"]
+		else: self.end_game = len(gameDict['board_states']) -1
+
+	# looks at the moves in the midgame
+	def visit(self, board, move, ply):
+		if not (self.mid_game <= ply < self.end_game): return
+		pieces_attacked, pieces_guarding, pieces_white = self.ply_totals(board)
+		self.pieces_attacked.append(pieces_attacked)
+		self.pieces_guarding.append(pieces_guarding)
+		self.pieces_white.append(pieces_white)
+
+	## (white pieces attacked by black, white pieces defending them, white pieces) on the board
+	@staticmethod
+	def ply_totals(board):
+		attacks = attack_map(board)
 
-	if gameDict["end_game_index"] : end_game = gameDict["end_game_index"]
-	else: end_game = len(gameDict['board_states']) -1
-
-	# loops through moves in the midgame
-	for i in range(mid_game, end_game):
 		# counter for number of white pieces
-		white_pieces_turn = 0
-		# finds all white pieces attacked by black and puts them in a list
-		board = chess.Board(gameDict["board_states_FEN"][i])
-		piece_attacked_turn = []
-		
-		for pieces in gameDict["white_pieces"][i].values():
-			for piece in pieces:
-				white_pieces_turn +=  1 
-				if board.is_attacked_by(chess.BLACK, chess.square(piece[0],piece[1])): piece_attacked_turn.append(piece)
+		white_pieces_turn = chess.popcount(board.occupied_co[chess.WHITE])
+		# finds all white pieces attacked by black
+		piece_attacked_turn = board.occupied_co[chess.WHITE] & attacks.attacked[chess.BLACK]
 
-		# checks which white pieces are defending them (stored as a chess square)
-		piece_defending_turn = set()
-		
-		for piece in piece_attacked_turn:
-			for sq in board.attackers(chess.WHITE, chess.square(piece[0], piece[1])): 
-				piece_defending_turn.add(sq)
+		# counts the white pieces defending them
+		piece_defending_turn = 0
+		for sq in chess.scan_forward(board.occupied_co[chess.WHITE]):
+			if attacks.attacks[sq] & piece_attacked_turn: piece_defending_turn += 1
 
-		pieces_attacked.append(len(piece_attacked_turn))
-		pieces_guarding.append(len(piece_defending_turn))
-		pieces_white.append(white_pieces_turn)
+		return chess.popcount(piece_attacked_turn), piece_defending_turn, white_pieces_turn
 
-		p_a = np.array(pieces_attacked)		
-		p_g = np.array(pieces_guarding)
-		p_w = np.array(pieces_white)
+	def result(self):
+		p_a = np.array(self.pieces_attacked)		
+		p_g = np.array(self.pieces_guarding)
+		p_w = np.array(self.pieces_white)
 
 		cum_sum = 0
 		for i in range(len(p_a)):
 			cum_sum += p_a[i] / max(1, p_g[i] * p_w[i])	
 
 		mean = cum_sum / max(1, len(p_a))
-	return {'pieces_guarded' : mean / max(1, (end_game - mid_game))}
+		return {'pieces_guarded' : mean / max(1, (self.end_game - self.mid_game))}
 
 ### trades
 ### input: game dictionary
@@ -1793,7 +2959,8 @@ def pieces_guarded(gameDict):
 ###			'avg_time_between_direct_trade' :number of white moves between black capturing on a direct trade and white recapturing divided by number of such trades
 def trades(gameDict):
 	trades_list = []
-	trade_moves = []
+	# the plies that are already part of a trade
+	trade_moves = set()
 
 	if gameDict["middle_game_index"] : mid_game = gameDict["middle_game_index"]
 	else: mid_game = len(gameDict['board_states']) -1
@@ -1801,82 +2968,80 @@ def trades(gameDict):
 	if gameDict["end_game_index"] : end_game = gameDict["end_game_index"]
 	else: end_game = len(gameDict['board_states']) -1
 
-	
-	#looks first for direct trades
-	for i in range(min(len(gameDict['black_moves']), end_game //2 + 1)):
-
-		#checks if there is a white capture and that the move has not already been added to a trade
-		if gameDict['white_moves'][i]['capture'] != '' and 2*i not in trade_moves:
-
-			# if piece values are the same, we check first for a direct trade
-			if PIECE_VALUES[gameDict['white_moves'][i]['piece']] == PIECE_VALUES[gameDict['white_moves'][i]['capture']]:
-				square = gameDict['white_moves'][i]['to']
-				for j in range(0,3):
-					if i+j >= len(gameDict['black_moves']): break
-
-					#checks that white hasn't moved away and if so changes the square
-					if j >0 and gameDict['white_moves'][i+j]['from'] == square: square = gameDict['white_moves'][i+j]['to']
-	
-					#checks if black takes and creates trade data if it does along with marking the move number
-					if gameDict['black_moves'][i+j]['to'] == square:
-						trade_temp = {
-								'initiated' :'white', 
-								'white_traded' : gameDict['white_moves'][i]['piece'], 
-								'black_traded' : gameDict['white_moves'][i]['capture'], 
-								'move_number' : 2*i, 
-								'time_to_trade' : j +1 , 
-								'type' : 'direct'
-						}
-						trades_list.append(trade_temp) 
-						trade_moves.append(2*(i+j) +1)
-						trade_moves.append(2*i)
-						break
+	# the columns of the move table for each side
+	table = move_table(gameDict)
+	white, black = table[0::2], table[1::2]
+	white_to, white_from, black_to, black_from = white['to'].tolist(), white['from'].tolist(), black['to'].tolist(), black['from'].tolist()
+	white_value, black_value = piece_values(white['piece']), piece_values(black['piece'])
+	white_captured, black_captured = piece_values(white['capture']), piece_values(black['capture'])
+
+	#looks first for direct trades, starting from the captures of a piece of the same value
+	n = min(len(black), end_game //2 + 1)
+	white_even = (white_captured[:n] > 0) & (white_captured[:n] == white_value[:n])
+	black_even = (black_captured[:n] > 0) & (black_captured[:n] == black_value[:n])
+	for i in np.flatnonzero(white_even | black_even).tolist():
+
+		#checks if there is a white capture that has not already been added to a trade
+		if white_even[i] and 2*i not in trade_moves:
+			square = white_to[i]
+			for j in range(0,3):
+				if i+j >= len(black): break
+
+				#checks that white hasn't moved away and if so changes the square
+				if j >0 and white_from[i+j] == square: square = white_to[i+j]
+
+				#checks if black takes and creates trade data if it does along with marking the move number
+				if black_to[i+j] == square:
+					trade_temp = {
+							'initiated' :'white', 
+							'white_traded' : gameDict['white_moves'][i]['piece'], 
+							'black_traded' : gameDict['white_moves'][i]['capture'], 
+							'move_number' : 2*i, 
+							'time_to_trade' : j +1 , 
+							'type' : 'direct'
+					}
+					trades_list.append(trade_temp) 
+					trade_moves.add(2*(i+j) +1)
+					trade_moves.add(2*i)
+					break
 
 		#now goes to black moves and checks if there is a direct trade
-		if gameDict['black_moves'][i]['capture'] != '' and 2*i +1 not in trade_moves:
-
-			#check if piece values are the same
-			if PIECE_VALUES[gameDict['black_moves'][i]['piece']] == PIECE_VALUES[gameDict['black_moves'][i]['capture']]:
-				square = gameDict['black_moves'][i]['to']
-				for j in range(1,4): 
-					if i+j >=  len(gameDict['white_moves']): break
-					#checks that black hasn't moved away and if so changes the square
-					if j > 1 and i+j < len(gameDict['black_moves']) and gameDict['black_moves'][i+j]['from'] == square: square = gameDict['black_moves'][i+j]['to']
-
-					#checks if white takes and creates trade data if it does along with marking the move number
-					if gameDict['white_moves'][i+j]['to'] == square:
-						trade_temp = {'initiated' :'black', 'white_traded' : gameDict['black_moves'][i]['capture'], 'black_traded' :gameDict['white_moves'][i+j]['capture'], 'move_number' : 2*i+1, 'time_to_trade' : j, 'type' : 'direct'}
-						trades_list.append(trade_temp) 
-						trade_moves.append(2*i +1)
-						trade_moves.append(2*(i+j))
-						break
-
-
-	for i in range(min(end_game,len(gameDict['black_moves'])//2 + 1)):
+		if black_even[i] and 2*i +1 not in trade_moves:
+			square = black_to[i]
+			for j in range(1,4): 
+				if i+j >=  len(white): break
+				#checks that black hasn't moved away and if so changes the square
+				if j > 1 and i+j < len(black) and black_from[i+j] == square: square = black_to[i+j]
+
+				#checks if white takes and creates trade data if it does along with marking the move number
+				if white_to[i+j] == square:
+					trade_temp = {'initiated' :'black', 'white_traded' : gameDict['black_moves'][i]['capture'], 'black_traded' :gameDict['white_moves'][i+j]['capture'], 'move_number' : 2*i+1, 'time_to_trade' : j, 'type' : 'direct'}
+					trades_list.append(trade_temp) 
+					trade_moves.add(2*i +1)
+					trade_moves.add(2*(i+j))
+					break
+
+	#then for indirect trades, a capture answered by the capture of a piece of the same value (only the first one is counted)
+	n = min(end_game,len(black)//2 + 1)
+	for i in np.flatnonzero((white_captured[:n] > 0) | (black_captured[:n] > 0)).tolist():
 		# checks if there is a white capture that is not yet part of a trade
-		if gameDict['white_moves'][i]['capture'] != '' and 2* i not in trade_moves and 2* i + 1 not in trade_moves:
-				piece_value = PIECE_VALUES[gameDict['white_moves'][i]['capture']]
-		
-				#checks next move of black to see if they've taken a piece of the same value
-					#checks if black takes and creates trade data if it does
-				if gameDict['black_moves'][i]['capture'] in PIECE_VALUES and PIECE_VALUES[gameDict['black_moves'][i]['capture']] == piece_value:
+		if white_captured[i] and 2* i not in trade_moves and 2* i + 1 not in trade_moves:
+				#checks if black takes a piece of the same value on the next move and creates trade data if it does
+				if black_captured[i] == white_captured[i]:
 					trade_temp = {'initiated' :'white', 'white_traded' : gameDict['black_moves'][i]['capture'], 'black_traded' :gameDict['white_moves'][i]['capture'], 'move_number' : 2*i, 'time_to_trade' : 1, 'type' : 'indirect'}
 					trades_list.append(trade_temp) 
-					trade_moves.append(2*(i) + 1)
-					trade_moves.append(2*i)
+					trade_moves.add(2*(i) + 1)
+					trade_moves.add(2*i)
 					break 
 	
 		# checks if there is a black capture that is not yet part of a trade
-		if gameDict['black_moves'][i]['capture'] != '' and (2* i +1) not in trade_moves and 2*(i+1) not in trade_moves and 2*(i+1) < len(gameDict['white_moves']):
-				piece_value = PIECE_VALUES[gameDict['black_moves'][i]['capture']]
-		
-				#checks next move of black to see if they've taken a piece of the same value
-					#checks if black takes and creates trade data if it does
-				if gameDict['white_moves'][i+1]['capture'] in PIECE_VALUES and PIECE_VALUES[gameDict['white_moves'][i+1]['capture']] == piece_value:
+		if black_captured[i] and (2* i +1) not in trade_moves and 2*(i+1) not in trade_moves and 2*(i+1) < len(white):
+				#checks if white takes a piece of the same value on the next move and creates trade data if it does
+				if white_captured[i+1] == black_captured[i]:
 					trade_temp = {'initiated' :'black', 'white_traded' : gameDict['black_moves'][i]['capture'], 'black_traded' :gameDict['white_moves'][i+1]['capture'], 'move_number' : 2*i+1, 'time_to_trade' : 1, 'type' : 'indirect'}
 					trades_list.append(trade_temp) 
-					trade_moves.append(2*(i) + 1)
-					trade_moves.append(2*(i+1))
+					trade_moves.add(2*(i) + 1)
+					trade_moves.add(2*(i+1))
 					break 
 	
 	return {
@@ -1894,51 +3059,76 @@ def trades(gameDict):
 ### output: average number of exchanges for white per move in the middle game
 
 def exchanges_possible(gameDict):
-	if gameDict["middle_game_index"] : mid_game = gameDict["middle_game_index"]
-	else: mid_game = len(gameDict['board_states']) -1
-
-	if gameDict["end_game_index"] : end_game = gameDict["end_game_index"]
-	else: end_game = len(gameDict['board_states']) -1
-
-
-	exchange_counter = 0
-	move_counter = 0
-	for i in range(1, end_game, 2):
-		board = chess.Board(gameDict['board_states_FEN'][i])
-		move_counter += 1
-		for pieces in gameDict['white_pieces'][i].values():
-			for piece in pieces:
-				for attacks in board.attacks(chess.square(piece[0], piece[1])):
-					if board.piece_at(attacks) and  board.piece_at(attacks).color == chess.BLACK and PIECE_VALUES[board.piece_at(attacks).symbol().upper()] == PIECE_VALUES[board.piece_at(chess.square(piece[0], piece[1])).symbol().upper()]:
-						exchange_counter += 1
-
-	return {'exchanges_possible' :exchange_counter / move_counter}
+	return replay_game(gameDict, [ExchangeVisitor(gameDict)])[0]
+
+## The visitor behind exchanges_possible
+class ExchangeVisitor(FeatureVisitor):
+	def __init__(self, gameDict):
+		FeatureVisitor.__init__(self, gameDict)
+		if gameDict["end_game_index"] : self.end_game = gameDict["end_game_index"]
+		else: self.end_game = len(gameDict['board_states']) -1
+
+		self.exchange_counter = 0
+		self.move_counter = 0
+
+	# looks at white's turns before the end game
+	def visit(self, board, move, ply):
+		if not (ply % 2 and ply < self.end_game): return
+		self.move_counter += 1
+		self.exchange_counter += self.ply_totals(board)
+
+	## The number of exchanges on the board
+	@staticmethod
+	def ply_totals(board):
+		attacks = attack_map(board)
+		# counts the black pieces of the same value as a white piece attacking them
+		exchanges = 0
+		for value, white_mask in attacks.value_masks[chess.WHITE].items():
+			black_mask = attacks.value_masks[chess.BLACK].get(value, 0)
+			for sq in chess.scan_forward(white_mask):
+				exchanges += chess.popcount(attacks.attacks[sq] & black_mask)
+		return exchanges
+
+	def result(self):
+		# (NaN before white's first move)
+		return {'exchanges_possible' :self.exchange_counter / self.move_counter if self.move_counter else np.nan}
 
 ### king_squares_attacked
 ### input: gameDict
 ### output: average number of squares adjacent to king attacked in the midgame
 
 def king_squares_attacked(gameDict):
-	if gameDict["middle_game_index"] : mid_game = gameDict["middle_game_index"]
-	else: mid_game = len(gameDict['board_states']) -1
+	return replay_game(gameDict, [KingSquaresVisitor(gameDict)])[0]
 
-	if gameDict["end_game_index"] : end_game = gameDict["end_game_index"]
-	else: end_game = len(gameDict['board_states']) -1
+## The visitor behind king_squares_attacked
+class KingSquaresVisitor(FeatureVisitor):
+	def __init__(self, gameDict):
+		FeatureVisitor.__init__(self, gameDict)
+		if gameDict["middle_game_index"] : self.mid_game = gameDict["middle_game_index"]
+		else: self.mid_game = len(gameDict['board_states']) -1
 
+		if gameDict["end_game_index"] : self.end_game = gameDict["end_game_index"]
+		else: self.end_game = len(gameDict['board_states']) -1
 
-	squares_attacked = 0
-	
-	for i in range(mid_game, end_game):
-		board = chess.Board(gameDict['board_states_FEN'][i])
-		
+		self.squares_attacked = 0
+
+	# looks at the moves in the midgame
+	def visit(self, board, move, ply):
+		if not (self.mid_game <= ply < self.end_game): return
+		self.squares_attacked += self.ply_totals(board)
+
+	## The number of squares next to the white king that black attacks
+	@staticmethod
+	def ply_totals(board):
 		#finds white king
 		king = board.king(chess.WHITE)
+		attacks = attack_map(board)
 	
-		# iterates through squares adjacent to king and increments counter if attacked
-		for square in board.attacks(king):
-			if board.is_attacked_by(chess.BLACK, square): squares_attacked +=1
+		# counts the squares adjacent to king that black attacks
+		return chess.popcount(attacks.attacks[king] & attacks.attacked[chess.BLACK])
 
-	return {'king_squares_attacked' :squares_attacked / max(1, (end_game - mid_game))}
+	def result(self):
+		return {'king_squares_attacked' :self.squares_attacked / max(1, (self.end_game - self.mid_game))}
 
 ### king_safety
 ### input: gameDict
@@ -1951,38 +3141,37 @@ def king_safety(gameDict):
 	if gameDict["end_game_index"] : end_game = gameDict["end_game_index"]
 	else: end_game = len(gameDict['board_states']) -1
 
-	# gets the indexes (in 'white_moves') of the king moves
-	move_index = []
-	for i in range(min(end_game,len(gameDict['white_moves']))):
-		if gameDict['white_moves'][i]['piece'] == 'K': move_index.append(2*i-1)
+	# gets the board indexes (2*i-1 for white's move i) of the white king moves
+	king_turns = np.flatnonzero(move_table(gameDict)['piece'][0::2][:end_game] == b'K')
+	move_index = 2 * king_turns - 1
+	move_index = move_index[(move_index >= 0) & (move_index < end_game)]
+
+	# counts the king moves, and weights them by the material of black at that board state
+	king_moves = len(move_index)
+	king_moves_weighted = int(game_indices(gameDict).material(chess.BLACK)[move_index].sum())
 
-	# iterates through the board states and calculates distance_from_king metric when reaches a move that is a white king move, also calculates king_moves and kings_moves_weighted
-	king_moves = 0
-	king_moves_weighted = 0
+	# iterates through the board states and calculates distance_from_king metric
 	distance_from_king_sum = 0
 	for i in range(end_game):
-
-		# checks if a king moves and increments the counters
-		if i in move_index:
-			king_moves +=1
-			#calculates material of black			
-			king_moves_weighted += material(gameDict, i, chess.BLACK)
-
-		# calculates king square
-		king = gameDict['white_pieces'][i]['K'][0]
-		distance_from_king_sum_move = 0 
-		black_pieces = 1
-
-		for piece in ['P', 'N', 'B', 'R', 'Q']:
-			for piece_instance in gameDict['black_pieces'][i][piece]:
-				distance_from_king_sum_move += max(abs(king[0] - piece_instance[0]), abs( king[1] - piece_instance[1])) / PIECE_VALUES[piece]
-				black_pieces += 1
-		
-		distance_from_king_sum += distance_from_king_sum_move / black_pieces
+		distance_from_king_sum += distance_from_king(gameDict, i)
 
 	return {'king_moves': king_moves, 'king_moves_weighted' : king_moves_weighted, 'distance_from_king' : distance_from_king_sum / max(1, end_game)}
 				
 		
+## Helper function for king_safety, the average distance of black's pieces (weighted by 1/value) from the white king at board state i
+def distance_from_king(gameDict, i):
+	# calculates king square
+	king = gameDict['white_pieces'][i]['K'][0]
+	distance_from_king_sum_move = 0 
+	black_pieces = 1
+
+	for piece in ['P', 'N', 'B', 'R', 'Q']:
+		for piece_instance in gameDict['black_pieces'][i][piece]:
+			distance_from_king_sum_move += max(abs(king[0] - piece_instance[0]), abs( king[1] - piece_instance[1])) / PIECE_VALUES[piece]
+			black_pieces += 1
+	
+	return distance_from_king_sum_move / black_pieces
+
 ### get_url
 ### input: gameDict
 ### output: game_id
@@ -2002,9 +3191,321 @@ def get_white(gameDict):
 ##### Processing Game Features
 ######################################################################################
 
+### FEATURE_FAMILIES
+### The feature families in the order get_features returns them. The families that need the board are FeatureVisitors,
+### which all share a single replay of the game, the rest are plain functions of the game dictionary.
+
+FEATURE_FAMILIES = [get_game_id, get_white, KnightVisitor, BishopVisitor, minor_features, RookVisitor, QueenVisitor, white_development, white_castling, PawnVisitor, BoardVisitor, white_clusters, DiscoveredCheckVisitor, distribution_piece_moves, PinVisitor, ForkVisitor, PiecesGuardedVisitor, trades, ExchangeVisitor, KingSquaresVisitor, king_safety]
+
+### FEATURE_COLUMNS
+### The columns each feature family gives, and FEATURE_DEPENDENCIES the shared data they are worked out from:
+### 'replay' : the family is a FeatureVisitor, it needs the game replayed move by move
+### 'attack_map', 'mobility', 'pinned' : per-position data (AttackMap, Mobility, pinned_pieces)
+### 'phase_indices', 'move_table', 'material' : per-game data (see GameIndices)
+### Everything shared is made on first use and kept (POSITION_CACHE, GameIndices), so computing only some families
+### only ever builds what those families use.
+
+FEATURE_COLUMNS = {
+	get_game_id: ['game_id'],
+	get_white: ['white_player'],
+	KnightVisitor: ['wn_pair', 'wn_outpost', 'wn_repositioning', 'wn_mobility'],
+	BishopVisitor: ['wb_pair', 'wk_side_fianchetto', 'wq_side_fianchetto', 'wb_mobility', 'wlong_diagonal_control', 'wopposite_color_b', 'b_p_coherency'],
+	minor_features: ['wn_b_trade_pref', 'wn_b_develop_pref'],
+	RookVisitor: ['wopen_files', 'wsemi_open_files', 'wback_rank_r', 'wdoubled_r', 'wdoubled_with_q', 'wr_mobility'],
+	QueenVisitor: ['wq_aggression', 'wq_fianchetto', 'wq_invasion', 'wq_mobility'],
+	white_development: ['A', 'B', 'C', 'D', 'E', 'A#', 'B#', 'C#', 'D#', 'E#', 'w_development_side'],
+	white_castling: ['wc_earliness', 'wc_side', 'wc_relative', 'wc_artificial', 'wc_development'],
+	PawnVisitor: ['wp_king_protection', 'wp_center_strength', 'wp_doubled', 'wp_isolated', 'wp_backward', 'wp_tension', 'wp_color',
+				  'wp_forwardness', 'wp_guarded_forwardness', 'wp_en_passant', 'wp_storming', 'wp_chain_count', 'wp_longest_chain', 'wp_non_queen'],
+	BoardVisitor: ['wb_rank', 'wb_file', 'wb_density', 'wb_attack', 'wb_pawn_pref', 'wb_minor_pref', 'wb_rook_pref', 'wb_queen_pref'],
+	white_clusters: ['wcl_MLL', 'wcl_ML', 'wcl_MM', 'wcl_MR', 'wcl_MRR', 'wcl_BL', 'wcl_BM', 'wcl_BR'],
+	DiscoveredCheckVisitor: ['discovered_checks_set_up', 'discovered_checks_given', 'discovered_checks_chances'],
+	distribution_piece_moves: ['P_moves', 'N_moves', 'B_moves', 'R_moves', 'Q_moves', 'K_moves'],
+	PinVisitor: ['pins_given', 'time_pinned'],
+	ForkVisitor: ['fork_counter'],
+	PiecesGuardedVisitor: ['pieces_guarded'],
+	trades: ['num_trades', 'num_direct_trades', 'num_indirect_trades', 'num_direct_trades_white', 'num_indirect_trades_white', 'avg_time_between_direct_trade'],
+	ExchangeVisitor: ['exchanges_possible'],
+	KingSquaresVisitor: ['king_squares_attacked'],
+	king_safety: ['king_moves', 'king_moves_weighted', 'distance_from_king'],
+}
+
+FEATURE_DEPENDENCIES = {
+	get_game_id: [],
+	get_white: [],
+	KnightVisitor: ['replay', 'mobility', 'phase_indices', 'move_table'],
+	BishopVisitor: ['replay', 'mobility', 'phase_indices'],
+	minor_features: [],
+	RookVisitor: ['replay', 'mobility', 'phase_indices'],
+	QueenVisitor: ['replay', 'mobility', 'phase_indices'],
+	white_development: ['phase_indices'],
+	white_castling: ['phase_indices'],
+	PawnVisitor: ['replay', 'attack_map', 'phase_indices'],
+	BoardVisitor: ['replay'],
+	white_clusters: [],
+	DiscoveredCheckVisitor: ['replay'],
+	distribution_piece_moves: ['move_table'],
+	PinVisitor: ['replay', 'pinned'],
+	ForkVisitor: ['replay', 'attack_map'],
+	PiecesGuardedVisitor: ['replay', 'attack_map'],
+	trades: ['move_table'],
+	ExchangeVisitor: ['replay', 'attack_map'],
+	KingSquaresVisitor: ['replay', 'attack_map'],
+	king_safety: ['move_table', 'material'],
+}
+
+## The columns that say whose row it is, get_features(game, only) always gives them
+ID_COLUMNS = ['game_id', 'white_player']
+
+### FEATURE_SCHEMA
+### The type of every column of get_features, column : (dtype, low, high, missing)
+### dtype : 'str' (the id columns), 'bool' (0/1 flags), 'int8' (-1/0/1 sides and the ECO numbers), 'int16' (counts) or 'float32'
+### low, high : the range the values are in (None for no bound on that side)
+### missing : 'never' if the column always has a value (a missing one is a bug), 'keep' if it can be missing
+###           (ex. an average over no pieces), in which case it stays missing instead of the row being dropped
+###
+### check_features(features) checks a row of get_features against the schema (extract_features, iter_features and
+### refresh_players do, a game whose row doesn't pass is recorded as a failure)
+### apply_schema(df) gives the columns of a DataFrame their dtypes: pandas 'boolean', 'Int8' and 'Int16', where a missing
+### value is <NA>, and float32, where it is NaN. That is about a quarter of the memory of float64 columns read back with
+### pd.read_csv, and the missing values can be told apart (df['w_development_side'].isna()) rather than lost with dropna().
+
+FLAG = ('bool', 0, 1, 'never')
+SIDE = ('int8', -1, 1, 'never')
+ECO_NUMBER = ('int8', 0, 99, 'never')
+COUNT = ('int16', 0, None, 'never')
+NAME = ('str', None, None, 'never')
+
+## Averages and ratios, which are missing when there is nothing to take them over
+def _average(low=0, high=None):
+	return ('float32', low, high, 'keep')
+
+FEATURE_SCHEMA = {
+	'game_id': NAME, 'white_player': NAME,
+	'wn_pair': FLAG, 'wn_outpost': _average(), 'wn_repositioning': _average(), 'wn_mobility': _average(),
+	'wb_pair': FLAG, 'wk_side_fianchetto': FLAG, 'wq_side_fianchetto': FLAG, 'wb_mobility': _average(),
+	'wlong_diagonal_control': _average(), 'wopposite_color_b': SIDE, 'b_p_coherency': _average(-8, 8),
+	'wn_b_trade_pref': _average(None), 'wn_b_develop_pref': _average(None),
+	'wopen_files': _average(), 'wsemi_open_files': _average(), 'wback_rank_r': _average(), 'wdoubled_r': _average(),
+	'wdoubled_with_q': _average(), 'wr_mobility': _average(),
+	'wq_aggression': _average(), 'wq_fianchetto': _average(), 'wq_invasion': _average(), 'wq_mobility': _average(),
+	'A': FLAG, 'B': FLAG, 'C': FLAG, 'D': FLAG, 'E': FLAG,
+	'A#': ECO_NUMBER, 'B#': ECO_NUMBER, 'C#': ECO_NUMBER, 'D#': ECO_NUMBER, 'E#': ECO_NUMBER,
+	'w_development_side': _average(-1, 1),
+	'wc_earliness': _average(0, 1), 'wc_side': SIDE, 'wc_relative': SIDE, 'wc_artificial': FLAG, 'wc_development': _average(0, 1),
+	'wp_king_protection': _average(), 'wp_center_strength': _average(), 'wp_doubled': _average(), 'wp_isolated': _average(),
+	'wp_backward': _average(), 'wp_tension': _average(), 'wp_color': _average(-1, 1), 'wp_forwardness': _average(0, 7),
+	'wp_guarded_forwardness': _average(), 'wp_en_passant': _average(0, 1), 'wp_storming': _average(),
+	'wp_chain_count': _average(), 'wp_longest_chain': _average(), 'wp_non_queen': _average(0, 1),
+	'wb_rank': _average(0, 7), 'wb_file': _average(-3.5, 3.5), 'wb_density': _average(0, 1), 'wb_attack': _average(),
+	'wb_pawn_pref': _average(0, 1), 'wb_minor_pref': _average(0, 1), 'wb_rook_pref': _average(0, 1), 'wb_queen_pref': _average(0, 1),
+	'wcl_MLL': _average(0, 1), 'wcl_ML': _average(0, 1), 'wcl_MM': _average(0, 1), 'wcl_MR': _average(0, 1),
+	'wcl_MRR': _average(0, 1), 'wcl_BL': _average(0, 1), 'wcl_BM': _average(0, 1), 'wcl_BR': _average(0, 1),
+	'discovered_checks_set_up': COUNT, 'discovered_checks_given': COUNT, 'discovered_checks_chances': COUNT,
+	'P_moves': _average(0, 1), 'N_moves': _average(0, 1), 'B_moves': _average(0, 1), 'R_moves': _average(0, 1),
+	'Q_moves': _average(0, 1), 'K_moves': _average(0, 1),
+	'pins_given': COUNT, 'time_pinned': _average(), 'fork_counter': COUNT, 'pieces_guarded': _average(),
+	'num_trades': COUNT, 'num_direct_trades': COUNT, 'num_indirect_trades': COUNT, 'num_direct_trades_white': COUNT,
+	'num_indirect_trades_white': COUNT, 'avg_time_between_direct_trade': _average(),
+	'exchanges_possible': _average(), 'king_squares_attacked': _average(),
+	'king_moves': COUNT, 'king_moves_weighted': COUNT, 'distance_from_king': _average(),
+}
+
+## The pandas dtype apply_schema gives each dtype of the schema
+SCHEMA_DTYPES = {'str': object, 'bool': 'boolean', 'int8': 'Int8', 'int16': 'Int16', 'float32': 'float32'}
+SCHEMA_LIMITS = {'bool': (0, 1), 'int8': (-127, 127), 'int16': (-32767, 32767)}
+
+## Raises ValueError if a row of get_features doesn't fit FEATURE_SCHEMA, returns the row otherwise
+def check_features(features):
+	for column, value in features.items():
+		if column not in FEATURE_SCHEMA:
+			continue
+		dtype, low, high, missing = FEATURE_SCHEMA[column]
+		if value is None or (dtype != 'str' and value != value):
+			if missing == 'never':
+				raise ValueError('%s is missing' % column)
+			continue
+		if dtype == 'str':
+			continue
+		if dtype in SCHEMA_LIMITS and value != int(value):
+			raise ValueError('%s=%r is not an integer' % (column, value))
+		low = SCHEMA_LIMITS[dtype][0] if low is None and dtype in SCHEMA_LIMITS else low
+		high = SCHEMA_LIMITS[dtype][1] if high is None and dtype in SCHEMA_LIMITS else high
+		if (low is not None and value < low) or (high is not None and value > high):
+			raise ValueError('%s=%r is outside [%s, %s]' % (column, value, low, high))
+	return features
+
+## The DataFrame with its columns in the dtypes of FEATURE_SCHEMA (columns that aren't in it are left as they are)
+def apply_schema(df):
+	return df.astype({column: SCHEMA_DTYPES[FEATURE_SCHEMA[column][0]] for column in df.columns if column in FEATURE_SCHEMA})
+
+### plan_features(only)
+### input: list of feature columns (None for all of them)
+### output: (families, dependencies)
+###	families: the feature families that give those columns (in FEATURE_FAMILIES order)
+###	dependencies: the set of shared data they need (see FEATURE_DEPENDENCIES)
+
+def plan_features(only=None):
+	if only is None:
+		families = list(FEATURE_FAMILIES)
+	else:
+		family_of = {column: family for family in FEATURE_FAMILIES for column in FEATURE_COLUMNS[family]}
+		unknown = [column for column in only if column not in family_of]
+		if unknown:
+			raise ValueError('unknown feature columns: %s' % ', '.join(map(str, unknown)))
+		wanted = set(family_of[column] for column in list(ID_COLUMNS) + list(only))
+		families = [family for family in FEATURE_FAMILIES if family in wanted]
+	dependencies = set()
+	for family in families:
+		dependencies.update(FEATURE_DEPENDENCIES[family])
+	return families, dependencies
+
 ### get_features
-### input: gameDict
+### input: gameDict, and optionally only : a list of feature columns (see FEATURE_COLUMNS)
 ### output: dictionary of all feature dictionaries
-
-def get_features(game):
-	return {**get_game_id(game), **get_white(game), **knight_features(game), **bishop_features(game), **minor_features(game), **rook_features(game), **queen_features(game), **white_development(game), **white_castling(game), **white_pawns(game), **white_board(game), **white_clusters(game), **discovered_checks(game), **distribution_piece_moves(game), **pins(game), **forks(game), **pieces_guarded(game), **trades(game), **exchanges_possible(game), **king_squares_attacked(game), **king_safety(game)}
+###	with only, just the game_id, white_player and the columns asked for; only the families giving them are computed
+###	(and within discovered checks and pins, only the columns asked for)
+
+def get_features(game, only=None):
+	families, dependencies = plan_features(only)
+
+	# replays the game once for all of the visitors
+	visitors = [family(game) for family in families if isinstance(family, type)]
+	if only is not None:
+		for visitor in visitors:
+			visitor.columns = set(only)
+	visitor_results = {}
+	if 'replay' in dependencies:
+		visitor_results = dict(zip([type(visitor) for visitor in visitors], replay_game(game, visitors)))
+
+	features = {}
+	for family in families:
+		if family in visitor_results:
+			features.update(visitor_results[family])
+		else:
+			features.update(family(game))
+	if only is not None:
+		keep = set(ID_COLUMNS) | set(only)
+		features = {column: value for column, value in features.items() if column in keep}
+	return features
+
+
+### extract_features
+### input: pgn_sources : a path to a pgn file (see read_pgn_games), an iterable of pgn strings (ex. stream_user_games),
+###                      or a list of these
+###        workers : number of processes to use (None uses every core, 1 runs everything in this process)
+###        chunk_size : number of games sent to a worker at a time
+###        csv_path : if given, the feature table is also written there in the same layout as data/<player>.csv
+###        cache_path : if given, the directory of a GameCache. Games in it aren't parsed again, and new games are added to it
+###        both_colors : if True, every game also gives a row for black, from the same parse (see mirror_game)
+###        only : if given, the list of feature columns to compute (see get_features), ex. the columns a model was trained on
+### output: DataFrame with one row of get_features per game, in the same order as the games were read,
+###         the columns in the dtypes of FEATURE_SCHEMA (see apply_schema)
+###         (with both_colors, white's row and then black's row, the white_player column being the player of the row)
+###
+### Like the loop in Summary.ipynb, games that never reach the middle game are skipped.
+### A game that raises an error (or whose row doesn't fit FEATURE_SCHEMA) is skipped as well, and (game number, error)
+### is recorded in df.attrs['failures'], so one bad game doesn't kill the whole batch.
+### Only a bounded number of chunks are in flight at a time, so memory doesn't grow with the number of games.
+
+def extract_features(pgn_sources, workers=None, chunk_size=32, csv_path=None, cache_path=None, both_colors=False, only=None):
+    if only is not None:
+        plan_features(only)   # fail on an unknown column before starting any workers
+    chunks = _chunked(_iter_sources(pgn_sources), chunk_size)
+    # only this process writes to the cache, the workers send back the new games packed
+    cache = GameCache(cache_path) if cache_path else None
+    _WORKER_CACHES.clear()
+
+    features = []
+    failures = []
+    game_number = 0
+    for results in _map_chunks(chunks, workers, cache_path, both_colors, only):
+        for rows, error, packed in results:
+            if packed is not None:
+                cache.add_packed(*packed)
+            if error is not None:
+                failures.append((game_number, error))
+            else:
+                features.extend(rows)
+            game_number += 1
+
+    df = apply_schema(pd.DataFrame(features))
+    df.attrs['failures'] = failures
+    if csv_path:
+        df.to_csv(csv_path, index=False)
+    return df
+
+## Helper function for extract_features, flattens the sources into one generator of pgn strings
+def _iter_sources(pgn_sources):
+    if isinstance(pgn_sources, str) or not isinstance(pgn_sources, (list, tuple)):
+        pgn_sources = [pgn_sources]
+    for source in pgn_sources:
+        if isinstance(source, str):
+            # A single pgn string rather than a path
+            if source.lstrip().startswith('['):
+                yield source
+            else:
+                yield from read_pgn_games(source)
+        else:
+            yield from source
+
+## Helper function for extract_features, groups a generator into lists of length chunk_size
+def _chunked(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+## Helper function for extract_features, maps _chunk_features over the chunks and yields the results in order
+## Keeps at most 2 chunks per worker in flight so the pool never reads too far ahead of us
+def _map_chunks(chunks, workers, cache_path=None, both_colors=False, only=None):
+    if workers == 1:
+        for chunk in chunks:
+            yield _chunk_features(chunk, cache_path, both_colors, only)
+        return
+
+    workers = workers or os.cpu_count()
+    with Pool(workers) as pool:
+        max_in_flight = 2 * workers
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.apply_async(_chunk_features, (chunk, cache_path, both_colors, only)))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+
+## Worker for extract_features, returns a list of (rows, error, packed) for each pgn in the chunk
+## rows are the game_features of the game (empty if it didn't reach the middle game), error is None unless something went wrong
+## packed is the pack_game of a game that had to be parsed, for extract_features to add to the cache (None otherwise)
+def _chunk_features(chunk, cache_path=None, both_colors=False, only=None):
+    cache = _worker_cache(cache_path)
+    results = []
+    for gamepgn in chunk:
+        packed = None
+        try:
+            game_id = tokenize_pgn(gamepgn)[0].get('Site', '') if cache is not None else None
+            if cache is not None and game_id in cache:
+                game_dict = cache.get(game_id)
+            elif cache is not None:
+                game_dict = parse_and_pack(gamepgn)
+                packed = game_dict.pop('packed', None)
+            else:
+                game_dict = get_gameDict(gamepgn)
+            results.append((game_features(game_dict, both_colors, only), None, packed))
+        except Exception as e:
+            results.append(([], repr(e), packed))
+    return results
+
+## The GameCache each worker reads from, opened once per process (the games added during the run aren't in it,
+## they are parsed again if they come up twice)
+_WORKER_CACHES = {}
+
+def _worker_cache(cache_path):
+    if not cache_path:
+        return None
+    if cache_path not in _WORKER_CACHES:
+        _WORKER_CACHES[cache_path] = GameCache(cache_path)
+    return _WORKER_CACHES[cache_path]
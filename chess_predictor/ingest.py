@@ -0,0 +1,596 @@
+########################################
+### Async ingestion from the lichess api
+########################################
+
+### The loop in Summary.ipynb downloads one player at a time with lichess.api.user_games, waiting for each.
+### ingest_players downloads many players at once over a small pool of kept-alive connections, parses the games
+### as their lines arrive, and remembers (in a SinceCursors file) the newest game it has seen for each player,
+### so the next run only asks lichess for the games played since then.
+### lichess sends the newest games first, at most max_games per request, so when a player has more than max_games games
+### since their cursor, the older ones are asked for in more requests (with until), back to the cursor. A player with no
+### cursor yet gets their newest max_games games.
+###
+### ex. cursors = SinceCursors('cursors.json')
+###     games = ingest_players(['DrNykterstein', 'Konevlad'], 1000, 'blitz', cursors=cursors)
+###     # games is {player: [game dictionaries]}, and cursors.json now has where to pick up from next time
+###
+### For offline testing, StandInServer serves games from memory on localhost with the same endpoint, formats and
+### rate limiting (429) responses as lichess:
+###     server = StandInServer({'DrNykterstein': read_pgn_games('magnus.pgn')}, rate_limit_every=5)
+###     with server.running():
+###         games = ingest_players(['DrNykterstein'], 100, 'blitz', base_url=server.url)
+###
+### refresh_players keeps a FeatureStore up to date the same way, computing features for the new games only (see below).
+###
+### Only the standard library is used (asyncio streams and a minimal HTTP/1.1 client), so nothing new has to be installed.
+
+import asyncio
+import json
+import os
+import ssl
+import threading
+import time
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urlencode, parse_qs, quote, unquote
+
+import functions
+
+LICHESS_URL = 'https://lichess.org'
+NDJSON = 'application/x-ndjson'
+PGN = 'application/x-chess-pgn'
+
+## How long to wait after a 429 when the response doesn't say (the lichess api asks for a full minute)
+RATE_LIMIT_WAIT = 60
+
+## How much earlier than the UTCDate/UTCTime of a pgn its game may have been created (ms), see SinceCursors
+PGN_TIME_MARGIN = 60 * 1000
+
+
+########################################
+### Since cursors
+########################################
+
+## Per-player timestamps (milliseconds, like the lichess createdAt) of the newest game downloaded so far, and the
+## game ids downloaded at or after that time, stored in a JSON file. cursors[player] is the `since` to ask lichess for
+## on the next run (0 if none yet). since is inclusive, so the games at the cursor come again and are skipped by their
+## ids (cursors.game_ids(player)).
+## The times of the PGN format are the UTCDate/UTCTime tags: the start of the game to the second, not its createdAt,
+## so a cursor from them is put PGN_TIME_MARGIN earlier (the games in between come again, and are skipped by their ids).
+class SinceCursors:
+    def __init__(self, path=None):
+        self.path = path
+        self.cursors = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.cursors = json.load(f)
+
+    def __getitem__(self, player):
+        cursor = self.cursors.get(player, 0)
+        # (older files have just the timestamp)
+        return cursor['since'] if isinstance(cursor, dict) else cursor
+
+    def game_ids(self, player):
+        cursor = self.cursors.get(player)
+        return set(cursor['game_ids']) if isinstance(cursor, dict) else set()
+
+    ## Moves the cursor of player to since (never backwards), game_ids are the ids of the games downloaded at or after it
+    def update(self, player, since, game_ids):
+        if since < self[player]:
+            return
+        if since == self[player]:
+            game_ids = set(game_ids) | self.game_ids(player)
+        self.cursors[player] = {'since': since, 'game_ids': sorted(game_ids)}
+
+    ## Writes the cursors to the file (to a temporary file first, so a crash never leaves half a file)
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.cursors, f)
+        os.replace(self.path + '.tmp', self.path)
+
+## createdAt (ms) of a pgn from its UTCDate and UTCTime tags, or None if it doesn't have them
+def pgn_created_at(headers):
+    try:
+        moment = datetime.strptime(headers['UTCDate'] + ' ' + headers['UTCTime'], '%Y.%m.%d %H:%M:%S')
+    except (KeyError, ValueError):
+        return None
+    return int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+## The game id of a pgn, from its Site tag (https://lichess.org/<id>)
+def pgn_game_id(headers):
+    return headers.get('Site', '').rsplit('/', 1)[-1]
+
+
+########################################
+### HTTP client
+########################################
+
+## Raised for responses that aren't 200 (or 429, which are retried)
+class HTTPError(Exception):
+    def __init__(self, status, reason):
+        Exception.__init__(self, '%d %s' % (status, reason))
+        self.status = status
+
+## A pool of at most size kept-alive connections to one host
+## Requests beyond size wait for a connection to come back, so size is also the number of downloads at a time.
+## After a 429 every request waits until the rate limit is over, since lichess limits all of our requests together.
+class ConnectionPool:
+    def __init__(self, base_url, size=4, max_retries=5, token=None):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self.size = size
+        self.max_retries = max_retries
+        self.token = token
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+        self.resume_at = 0
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+    async def _connect(self):
+        if self.idle:
+            return self.idle.pop()
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    ## Async generator of the lines (bytes) of a GET of path
+    ## Retries after the wait the server asks for (Retry-After, else RATE_LIMIT_WAIT) on a 429
+    async def get_lines(self, path, accept):
+        retries = 0
+        while True:
+            async with self.slots:
+                wait = self.resume_at - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                response = await self._request(path, accept)
+                if response.status == 429:
+                    await response.discard()
+                    self.rate_limited += 1
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise HTTPError(429, response.reason)
+                    self.resume_at = time.monotonic() + float(response.headers.get('retry-after', RATE_LIMIT_WAIT))
+                    continue
+                if response.status != 200:
+                    await response.discard()
+                    raise HTTPError(response.status, response.reason)
+                async for line in response.lines():
+                    yield line
+                return
+
+    async def _request(self, path, accept):
+        headers = {'Host': self.host, 'Accept': accept, 'Connection': 'keep-alive', 'User-Agent': 'chess_predictor'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        request = 'GET %s HTTP/1.1\r\n%s\r\n' % (path, ''.join('%s: %s\r\n' % item for item in headers.items()))
+        self.requests += 1
+
+        # A kept-alive connection may have been closed by the server since we used it, then we retry on a new one
+        for attempt in range(2):
+            reader, writer = await self._connect()
+            try:
+                writer.write(request.encode())
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError('connection closed')
+                break
+            except (ConnectionError, OSError):
+                writer.close()
+                if attempt:
+                    raise
+        version, status, reason = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            key, value = line.split(':', 1)
+            response_headers[key.strip().lower()] = value.strip()
+        return Response(self, reader, writer, int(status), reason, response_headers)
+
+    ## Gives a connection back to the pool once its response has been read to the end
+    def _release(self, reader, writer, keep_alive):
+        if keep_alive and len(self.idle) < self.size:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+## The response to one request. The body is read as it arrives, chunked or with a Content-Length.
+class Response:
+    def __init__(self, pool, reader, writer, status, reason, headers):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    async def chunks(self):
+        finished = False
+        try:
+            if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    size = int((await self.reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        # trailers, up to a blank line
+                        while (await self.reader.readline()).strip():
+                            pass
+                        break
+                    chunk = await self.reader.readexactly(size)
+                    await self.reader.readline()
+                    yield chunk
+                keep_alive = True
+            elif 'content-length' in self.headers:
+                remaining = int(self.headers['content-length'])
+                while remaining:
+                    chunk = await self.reader.read(min(remaining, 65536))
+                    if not chunk:
+                        raise ConnectionResetError('connection closed in the middle of the body')
+                    remaining -= len(chunk)
+                    yield chunk
+                keep_alive = True
+            else:
+                while True:
+                    chunk = await self.reader.read(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+                keep_alive = False
+            finished = True
+        finally:
+            # If the body wasn't read to the end the connection can't be used again
+            keep_alive = finished and keep_alive and self.headers.get('connection', '').lower() != 'close'
+            self.pool._release(self.reader, self.writer, keep_alive)
+
+    async def lines(self):
+        buffer = b''
+        async for chunk in self.chunks():
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                yield line
+        if buffer:
+            yield buffer
+
+    async def discard(self):
+        async for chunk in self.chunks():
+            pass
+
+
+########################################
+### Ingestion
+########################################
+
+## Async generator of (pgn string, createdAt, game id) for a player's games between since and until (inclusive, None
+## for no limit), newest first and at most max_games of them (as lichess sends them)
+## fmt is NDJSON (each line a game, with the pgn in it) or PGN (the raw pgn stream, createdAt is from UTCDate/UTCTime)
+async def player_pgns(pool, player, max_games, perf_type, since=0, fmt=NDJSON, until=None):
+    params = {'max': max_games, 'perfType': perf_type}
+    if since:
+        params['since'] = since
+    if until is not None:
+        params['until'] = until
+    if fmt == NDJSON:
+        params['pgnInJson'] = 'true'
+    path = '/api/games/user/%s?%s' % (quote(player), urlencode(params))
+
+    lines = pool.get_lines(path, fmt)
+    if fmt == NDJSON:
+        async for line in lines:
+            if line.strip():
+                game = json.loads(line)
+                yield game['pgn'], game.get('createdAt'), game.get('id') or pgn_game_id(functions.tokenize_pgn(game['pgn'])[0])
+    else:
+        # The same splitting as functions.split_pgn_lines, as the lines come in
+        buffer = []
+        in_moves = False
+        async for line in lines:
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line.startswith('['):
+                if in_moves:
+                    yield pgn_game('\n'.join(buffer).strip())
+                    buffer = []
+                    in_moves = False
+            elif line.strip():
+                in_moves = True
+            buffer.append(line)
+        if in_moves:
+            yield pgn_game('\n'.join(buffer).strip())
+
+def pgn_game(gamepgn):
+    headers = functions.tokenize_pgn(gamepgn)[0]
+    return gamepgn, pgn_created_at(headers), pgn_game_id(headers)
+
+## Downloads and parses the games of many players at once
+## input: players : list of lichess usernames
+##        max_games, perf_type : as in lichess.api.user_games (max, perfType). max_games is the number of games per
+##                               request: a player with a cursor gets all their games since it (see above)
+##        cursors : SinceCursors, only games since each player's cursor are downloaded, and the cursors are moved
+##                  forward and saved after each player finishes (None gets the newest max_games and remembers nothing)
+##        concurrency : number of connections (and players downloading) at a time
+##        fmt : NDJSON or PGN
+##        parse : function from a pgn string to what is kept for each game (get_gameDict, or ex. a GameCache's get_gameDict)
+##        executor : where parse runs, off the event loop so the other downloads go on meanwhile. None is the loop's
+##                   default thread pool; a concurrent.futures.ProcessPoolExecutor parses on every core (then parse
+##                   has to be picklable, ex. a module level function)
+##        wanted : function from a pgn string to whether to parse it at all (run on the event loop, so it should be cheap)
+##        base_url : LICHESS_URL, or a StandInServer's url
+##        finish : function called with (player, [parsed games]) once a player's download is done, before the player's
+##                 cursor is moved (ex. to store the games, so a cursor never gets past games that weren't stored)
+## output: {player: [parsed games]} (players whose download failed map to the error instead)
+async def ingest_players_async(players, max_games, perf_type, cursors=None, concurrency=4, fmt=NDJSON,
+                               parse=functions.get_gameDict, base_url=LICHESS_URL, token=None, finish=None,
+                               executor=None, wanted=None):
+    pool = ConnectionPool(base_url, concurrency, token=token)
+    loop = asyncio.get_running_loop()
+
+    margin = PGN_TIME_MARGIN if fmt == PGN else 0
+
+    async def ingest(player):
+        since = cursors[player] if cursors is not None else 0
+        seen = cursors.game_ids(player) if cursors is not None else set()
+        games = []
+        times = {}
+        until = None
+        while True:
+            n_games = n_new = 0
+            oldest = None
+            async for gamepgn, created_at, game_id in player_pgns(pool, player, max_games, perf_type, since, fmt, until):
+                n_games += 1
+                if created_at is not None and (oldest is None or created_at < oldest):
+                    oldest = created_at
+                # (the games at the cursor, and at the end of the previous request, come again)
+                if game_id in seen or game_id in times:
+                    continue
+                n_new += 1
+                times[game_id] = created_at
+                if wanted is None or wanted(gamepgn):
+                    games.append(loop.run_in_executor(executor, parse, gamepgn))
+            # A full request may have left games since the cursor behind, they are older than the oldest one it had
+            if not since or n_games < max_games or not n_new or oldest is None:
+                break
+            until = oldest + margin
+        games = list(await asyncio.gather(*games))
+        if finish is not None:
+            finish(player, games)
+        # only move the cursor once the whole download made it, so a failed one is redone next time
+        known = [created_at for created_at in times.values() if created_at is not None]
+        if cursors is not None and times:
+            newest = max(known) - margin if known else since
+            cursors.update(player, newest, [game_id for game_id, created_at in times.items()
+                                            if created_at is None or created_at >= newest])
+            cursors.save()
+        return games
+
+    try:
+        results = await asyncio.gather(*[ingest(player) for player in players], return_exceptions=True)
+    finally:
+        await pool.close()
+    return dict(zip(players, results))
+
+## Same as ingest_players_async, for code that isn't async
+## In a notebook (which already runs an event loop, so asyncio.run can't be used) the download runs on another thread,
+## `await ingest_players_async(...)` does it on the notebook's loop instead.
+def ingest_players(players, max_games, perf_type, **kwargs):
+    return run_blocking(ingest_players_async(players, max_games, perf_type, **kwargs))
+
+## Runs a coroutine to the end, on a thread of its own if this thread is running an event loop already
+def run_blocking(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+########################################
+### Incremental refresh
+########################################
+
+### refresh_players adds the games players have played since the last refresh to a FeatureStore (see feature_table.py),
+### ex. every night:
+###     store = FeatureStore('features.store')
+###     refresh_players(store, players, 1000, 'blitz')
+###
+### Only the games since each player's cursor are downloaded (the cursors are kept in the store's directory by default),
+### games whose rows are in the store already are skipped from their pgn headers, before they are parsed, and the
+### features of the rest are appended to the store. So a run costs about as much as the new games, and running it
+### again (or after a run that failed part way) never adds a game twice.
+### A player's rows are the games they played white, like the data/ csvs, and with both_colors their black games too
+### (see mirror_game). Only the store's columns are computed (see get_features).
+### A player's cursor is only moved once the rows of their download are in the store, and a player with more than
+### max_games new games gets all of them (see ingest_players_async).
+### Games that fail to parse are left out and listed in the result.
+### The features are computed off the event loop (see ingest_players_async), ex. on every core with
+###     refresh_players(store, players, 1000, 'blitz', executor=ProcessPoolExecutor())
+### Each refresh appends a player's new rows after the rest of the store, so after a few of them a player's rows are
+### in several runs and store.select copies them; with compact=True the store is rewritten at the end to put them back
+### together (see FeatureStore.compact, this reads and writes the whole store, so ex. once a week is enough).
+
+## output: {player: number of rows added} (players whose download failed map to the error instead),
+##         and the list of (game_id, error) of the games that failed
+def refresh_players(store, players, max_games, perf_type, cursors=None, both_colors=False, compact=False, **kwargs):
+    if cursors is None:
+        cursors = SinceCursors(os.path.join(store.path, 'cursors.json'))
+    known_columns = {column for columns in functions.FEATURE_COLUMNS.values() for column in columns}
+    only = [column for column in store.columns if column in known_columns]
+    tracked = {player.lower() for player in players}
+    stored = store.row_keys()
+    failures = []
+    added = {}
+
+    def wanted(gamepgn):
+        headers = functions.tokenize_pgn(gamepgn)[0]
+        game_id = headers.get('Site', '')
+        sides = [headers.get('White', '')] + ([headers.get('Black', '')] if both_colors else [])
+        return any(side.lower() in tracked and (game_id, side) not in stored for side in sides)
+
+    def finish(player, games):
+        rows = []
+        for game_rows, failure in games:
+            if failure is not None:
+                failures.append(failure)
+            for features in game_rows:
+                key = (features['game_id'], features['white_player'])
+                # (with both_colors, a game between two of the players gives both their rows at once)
+                if features['white_player'].lower() in tracked and key not in stored:
+                    stored.add(key)
+                    rows.append(features)
+        if rows:
+            store.append(rows)
+        added[player] = len(rows)
+
+    parse = functools.partial(refresh_features, both_colors=both_colors, only=only)
+    results = ingest_players(players, max_games, perf_type, cursors=cursors, parse=parse, finish=finish, wanted=wanted,
+                             **kwargs)
+    if compact:
+        store.compact()
+    return {player: added.get(player, result) for player, result in results.items()}, failures
+
+## (rows of game_features, None) of a pgn, or ([], (game_id, error)) if it fails
+## (at the module level, so a ProcessPoolExecutor can run it)
+def refresh_features(gamepgn, both_colors, only):
+    try:
+        return functions.game_features(functions.get_gameDict(gamepgn), both_colors, only), None
+    except Exception as error:
+        return [], (functions.tokenize_pgn(gamepgn)[0].get('Site', ''), error)
+
+
+########################################
+### Stand-in server
+########################################
+
+## A local server with the lichess games endpoint (GET /api/games/user/<name>, with max, since, until and perfType),
+## serving games from memory, for testing the ingestion offline
+## input: games : {player: iterable of pgn strings}, their createdAt is taken from the UTCDate/UTCTime tags
+##                (games without them get made up, one minute apart, in the order given, and the tags are added to
+##                their pgn, since lichess always has them)
+##        rate_limit_every : every nth request is answered with a 429 (0 never does)
+##        retry_after : the Retry-After (seconds) of the 429s
+##        chunk_games : number of games written per chunk of the (chunked) response
+class StandInServer:
+    def __init__(self, games, rate_limit_every=0, retry_after=0, chunk_games=1, host='127.0.0.1', port=0):
+        self.games = {}
+        for player, pgns in games.items():
+            self.games[player] = []
+            for n, gamepgn in enumerate(pgns):
+                headers = functions.tokenize_pgn(gamepgn)[0]
+                created_at = pgn_created_at(headers)
+                if created_at is None:
+                    created_at = 1500000000000 + 60000 * n
+                    moment = datetime.fromtimestamp(created_at / 1000, timezone.utc)
+                    gamepgn = '[UTCDate "%s"]\n[UTCTime "%s"]\n%s' % (moment.strftime('%Y.%m.%d'), moment.strftime('%H:%M:%S'), gamepgn)
+                self.games[player].append((created_at, headers, gamepgn))
+            # newest first, like lichess
+            self.games[player].sort(key=lambda game: -game[0])
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.chunk_games = chunk_games
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.connections = 0
+        self.server = None
+        self.serving = set()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        # (the connections clients kept alive are closed too, else their tasks are left pending on a closed loop)
+        for task in list(self.serving):
+            task.cancel()
+        await asyncio.gather(*self.serving, return_exceptions=True)
+        await self.server.wait_closed()
+
+    ## Runs the server on its own thread (for use with the blocking ingest_players)
+    @contextlib.contextmanager
+    def running(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+        try:
+            yield self
+        finally:
+            asyncio.run_coroutine_threadsafe(self.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        self.serving.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                request_headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+                    if not line:
+                        break
+                    key, value = line.split(':', 1)
+                    request_headers[key.strip().lower()] = value.strip()
+                method, target, version = request_line.decode('latin-1').split()
+                await self._respond(writer, target, request_headers)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.serving.discard(task)
+            writer.close()
+
+    async def _respond(self, writer, target, request_headers):
+        self.requests += 1
+        url = urlsplit(target)
+        if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+            writer.write(b'HTTP/1.1 429 Too Many Requests\r\nRetry-After: %d\r\nContent-Length: 0\r\n\r\n' % self.retry_after)
+            await writer.drain()
+            return
+        prefix = '/api/games/user/'
+        player = unquote(url.path[len(prefix):])
+        if not url.path.startswith(prefix) or player not in self.games:
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+            return
+
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        since = int(params.get('since', 0))
+        until = int(params.get('until', 2 ** 63))
+        games = [game for game in self.games[player] if since <= game[0] <= until][:int(params.get('max', 10 ** 9))]
+        ndjson = NDJSON in request_headers.get('accept', '')
+
+        content_type = NDJSON if ndjson else PGN
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: %s\r\nTransfer-Encoding: chunked\r\n\r\n' % content_type).encode())
+        for start in range(0, len(games), self.chunk_games):
+            body = ''
+            for created_at, headers, gamepgn in games[start: start + self.chunk_games]:
+                if ndjson:
+                    body += json.dumps({'id': pgn_game_id(headers), 'createdAt': created_at, 'pgn': gamepgn}) + '\n'
+                else:
+                    body += gamepgn + '\n\n\n'
+            data = body.encode('utf-8')
+            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
@@ -0,0 +1,281 @@
+########################################
+### Live games
+########################################
+
+### LiveGame follows a game that is still being played, one move at a time, so that a player can be classified
+### during the game rather than after it.
+###
+### ex. live = LiveGame(white_player='DrNykterstein', black_player='Konevlad', game_id='https://lichess.org/abc12345',
+###                     opening='B90')
+###     for san in moves_as_they_come:
+###         live.push_move(san)
+###         if live.game_dict['middle_game_index']:
+###             features = live.snapshot()
+###
+### push_move parses the move, adds its move dictionary and position to live.game_dict (the same layout as
+### get_gameDict), and moves the phase indices along, which only depend on the plies so far (see segment_phases).
+### It then updates the running totals of the STREAMING_FAMILIES, at a constant cost per move.
+###
+### snapshot() is get_features of the game so far (the same as get_features(get_gameDict(pgn of the moves so far))).
+### The streaming families come straight from their running totals; the other families are worked out from
+### live.game_dict, which costs a replay of the game so far. snapshot(streaming_only=True) only gives the streaming
+### features, in constant time.
+### Like get_features, snapshot is meant for games that have reached the middle game.
+
+import bisect
+
+import chess
+import numpy as np
+
+import functions
+
+class LiveGame:
+    ## opening : the ECO code of the game (ex. 'B90', the ECO tag of its pgn), needed for the opening features
+    ## thresholds : the limits of the game phases (see functions.segment_phases), PHASE_THRESHOLDS by default
+    def __init__(self, white_player='', black_player='', game_id='', opening=None, time_control='', **thresholds):
+        if not (isinstance(opening, str) and len(opening) > 1 and opening[0].isalpha() and opening[1:].isdigit()):
+            raise ValueError('opening must be the ECO code of the game (ex. \'B90\'), not %r' % (opening,))
+        self.board = chess.Board()
+        self.thresholds = dict(functions.PHASE_THRESHOLDS, **thresholds)
+        self.game_dict = {'white_moves': [], 'black_moves': [], 'board_states': [], 'board_states_FEN': [],
+                          'white_pieces': [], 'black_pieces': [], 'middle_game_index': None, 'end_game_index': None,
+                          'game_id': game_id, 'white_player': white_player, 'black_player': black_player,
+                          'opening': opening, 'time_control': time_control}
+        self.accumulators = {family: accumulator(self.game_dict) for family, accumulator in STREAMING_FAMILIES.items()}
+        # scratch space for the position of the ply being pushed
+        self.position = functions.GamePositions(1)
+
+    def __len__(self):
+        return len(self.game_dict['board_states'])
+
+    ## Plays the SAN move (raises ValueError if it isn't legal) and updates the running totals
+    def push_move(self, san):
+        game_dict = self.game_dict
+        ply = len(self)
+        move_dict, move = functions.parse_move(self.board, san, ply)
+        self.board.push(move)
+        functions.set_check(move_dict, self.board)
+        if ply % 2:
+            game_dict['black_moves'].append(move_dict)
+        else:
+            game_dict['white_moves'].append(move_dict)
+
+        position = self.position
+        position.set_ply(0, self.board)
+        position.finish()
+        game_dict['board_states'].append(position.board_state(0))
+        game_dict['board_states_FEN'].append(position.fen(0))
+        game_dict['white_pieces'].append(position.piece_locations(0, chess.WHITE))
+        game_dict['black_pieces'].append(position.piece_locations(0, chess.BLACK))
+        self._update_phases(ply)
+        # the derived indices of the game so far are out of date now
+        game_dict.pop('_derived', None)
+
+        for accumulator in self.accumulators.values():
+            accumulator.push(self.board, move, ply)
+
+    def push_moves(self, sans):
+        for san in sans:
+            self.push_move(san)
+
+    ## Same rules as get_gameDict: an index is set at the first ply that meets its limits (and an index of 0 doesn't count)
+    def _update_phases(self, ply):
+        game_dict = self.game_dict
+        pieces, white_back_rank, black_back_rank = [int(counts[0]) for counts in functions.phase_counts(self.position)]
+        if not game_dict['middle_game_index']:
+            if pieces <= self.thresholds['middle_pieces'] or (white_back_rank <= self.thresholds['back_rank_pieces'] and
+                                                             black_back_rank <= self.thresholds['back_rank_pieces']):
+                game_dict['middle_game_index'] = ply
+        if not game_dict['end_game_index'] and pieces <= self.thresholds['end_pieces']:
+            game_dict['end_game_index'] = ply
+
+    ## get_features of the game so far (see above)
+    def snapshot(self, streaming_only=False):
+        game_dict = self.game_dict
+        replayed = {}
+        if not streaming_only:
+            visitors = [family(game_dict) for family in functions.FEATURE_FAMILIES
+                        if isinstance(family, type) and family not in self.accumulators]
+            replayed = dict(zip([type(visitor) for visitor in visitors], functions.replay_game(game_dict, visitors)))
+
+        features = {}
+        for family in functions.FEATURE_FAMILIES:
+            if family in self.accumulators:
+                features.update(self.accumulators[family].result())
+            elif family in replayed:
+                features.update(replayed[family])
+            elif not streaming_only:
+                features.update(family(game_dict))
+        return features
+
+########################################
+### Running totals
+########################################
+
+### One accumulator per streaming feature family. push(board, move, ply) is called with the board after each ply,
+### and result() gives the family's features for the game so far, without changing the running totals.
+### The features that average over the middle game keep a running sum per ply (from the first ply of the middle game
+### on), so the range of plies get_features would use for the game so far can be summed in constant time.
+
+## The (mid_game, end_game) the visitors use: the phase indices, or the last ply for the ones not reached yet
+def live_phase_range(game_dict):
+    last = len(game_dict['board_states']) - 1
+    return game_dict['middle_game_index'] or last, game_dict['end_game_index'] or last
+
+## Families whose features only depend on the game's headers (game_id and white_player)
+class LiveHeaders:
+    def __init__(self, family, game_dict):
+        self.family = family
+        self.game_dict = game_dict
+
+    def push(self, board, move, ply):
+        pass
+
+    def result(self):
+        return self.family(self.game_dict)
+
+## Visitors that only look at the ply they are given (pins and forks)
+class LiveVisitor:
+    def __init__(self, visitor):
+        self.visitor = visitor
+
+    def push(self, board, move, ply):
+        self.visitor.visit(board, move, ply)
+
+    def result(self):
+        return self.visitor.result()
+
+## The discovered check chances after black's move only count once white has played the next move
+class LiveDiscoveredChecks:
+    def __init__(self, game_dict):
+        self.visitor = functions.DiscoveredCheckVisitor(game_dict)
+        self.pending = 0
+
+    def push(self, board, move, ply):
+        if ply % 2:
+            self.pending = functions.has_discovered_check(board)
+        else:
+            self.visitor.discovered_checks_chances += self.pending
+            self.pending = 0
+            self.visitor.visit(board, move, ply)
+
+    def result(self):
+        return self.visitor.result()
+
+## Running sums of a value of each ply of the middle game (plies from the middle game index on, up to the end game index)
+class LivePlySums:
+    def __init__(self, game_dict):
+        self.game_dict = game_dict
+        self.sums = [0]
+
+    def push(self, board, move, ply):
+        game_dict = self.game_dict
+        if not game_dict['middle_game_index'] or (game_dict['end_game_index'] and ply >= game_dict['end_game_index']):
+            return
+        self.sums.append(self.sums[-1] + self.ply_value(board))
+
+    ## (sum of the values over the plies the visitor would count, number of those plies, mid_game, end_game)
+    def totals(self):
+        mid_game, end_game = live_phase_range(self.game_dict)
+        n_plies = max(0, min(end_game - mid_game, len(self.sums) - 1))
+        return self.sums[n_plies], n_plies, mid_game, end_game
+
+class LivePiecesGuarded(LivePlySums):
+    def ply_value(self, board):
+        attacked, guarding, white = functions.PiecesGuardedVisitor.ply_totals(board)
+        return attacked / max(1, guarding * white)
+
+    def result(self):
+        total, n_plies, mid_game, end_game = self.totals()
+        mean = total / max(1, n_plies)
+        return {'pieces_guarded': mean / max(1, (end_game - mid_game))}
+
+class LiveKingSquares(LivePlySums):
+    def ply_value(self, board):
+        return functions.KingSquaresVisitor.ply_totals(board)
+
+    def result(self):
+        total, n_plies, mid_game, end_game = self.totals()
+        return {'king_squares_attacked': total / max(1, (end_game - mid_game))}
+
+## Exchanges on white's turns before the end game
+class LiveExchanges:
+    def __init__(self, game_dict):
+        self.game_dict = game_dict
+        self.plies = []
+        self.sums = [0]
+
+    def push(self, board, move, ply):
+        end_game = self.game_dict['end_game_index']
+        if not ply % 2 or (end_game and ply >= end_game):
+            return
+        self.plies.append(ply)
+        self.sums.append(self.sums[-1] + functions.ExchangeVisitor.ply_totals(board))
+
+    def result(self):
+        n_moves = bisect.bisect_left(self.plies, live_phase_range(self.game_dict)[1])
+        # (NaN before white's first move, like ExchangeVisitor)
+        return {'exchanges_possible': self.sums[n_moves] / n_moves if n_moves else np.nan}
+
+## Counts of white's moves by piece (see distribution_piece_moves)
+class LivePieceMoves:
+    def __init__(self, game_dict):
+        self.game_dict = game_dict
+        self.counts = dict.fromkeys(['P', 'N', 'B', 'R', 'Q', 'K', 'O'], 0)
+
+    def push(self, board, move, ply):
+        if ply % 2 == 0:
+            self.counts[self.game_dict['white_moves'][-1]['piece']] += 1
+
+    def result(self):
+        n_moves = len(self.game_dict['white_moves'])
+        features = dict.fromkeys(['P_moves', 'N_moves', 'B_moves', 'R_moves', 'Q_moves', 'K_moves'], 0)
+        if n_moves == 0:
+            return features
+        # castling counts as a king move and a rook move
+        for piece in ['P', 'N', 'B', 'R', 'Q', 'K']:
+            count = self.counts[piece]
+            if piece in ['R', 'K']:
+                count += self.counts['O']
+            features[piece + '_moves'] = count / n_moves
+        return features
+
+## king_safety: the white king moves (weighted by black's material), and the distance of black's pieces from the king
+class LiveKingSafety:
+    def __init__(self, game_dict):
+        self.game_dict = game_dict
+        self.king_plies = []
+        self.king_weights = [0]
+        self.distances = [0]
+
+    def push(self, board, move, ply):
+        game_dict = self.game_dict
+        # white's move i is counted at board state 2*i-1, with the material black had then
+        if ply % 2 == 0 and ply >= 2 and game_dict['white_moves'][-1]['piece'] == 'K':
+            black_pieces = game_dict['black_pieces'][ply - 1]
+            material = sum(functions.PIECE_VALUES[piece] * len(black_pieces[piece]) for piece in ['P', 'B', 'N', 'R', 'Q'])
+            self.king_plies.append(ply - 1)
+            self.king_weights.append(self.king_weights[-1] + material)
+        end_game = game_dict['end_game_index']
+        if not end_game or ply < end_game:
+            self.distances.append(self.distances[-1] + functions.distance_from_king(game_dict, ply))
+
+    def result(self):
+        end_game = live_phase_range(self.game_dict)[1]
+        king_moves = bisect.bisect_left(self.king_plies, end_game)
+        return {'king_moves': king_moves, 'king_moves_weighted': self.king_weights[king_moves],
+                'distance_from_king': self.distances[min(end_game, len(self.distances) - 1)] / max(1, end_game)}
+
+## The families snapshot takes from running totals, and how to make their accumulator for a game dictionary
+STREAMING_FAMILIES = {
+    functions.get_game_id: lambda game_dict: LiveHeaders(functions.get_game_id, game_dict),
+    functions.get_white: lambda game_dict: LiveHeaders(functions.get_white, game_dict),
+    functions.DiscoveredCheckVisitor: LiveDiscoveredChecks,
+    functions.distribution_piece_moves: LivePieceMoves,
+    functions.PinVisitor: lambda game_dict: LiveVisitor(functions.PinVisitor(game_dict)),
+    functions.ForkVisitor: lambda game_dict: LiveVisitor(functions.ForkVisitor(game_dict)),
+    functions.PiecesGuardedVisitor: LivePiecesGuarded,
+    functions.ExchangeVisitor: LiveExchanges,
+    functions.KingSquaresVisitor: LiveKingSquares,
+    functions.king_safety: LiveKingSafety,
+}
@@ -0,0 +1,178 @@
+########################################
+### Pairwise separability
+########################################
+
+### How well can one player's games be told apart from another's? The players_critical loop in Summary.ipynb answers
+### it for Konevlad against each other player in turn, one pair at a time, refitting the scaler (and PCA) for every fold.
+### pairwise_separability gives the cross validated accuracy of the same classifier (StandardScaler, optionally PCA,
+### the opening columns added unscaled, then an RBF SVC) for every pair of players at once:
+###
+### ex. store = FeatureStore('features.store')
+###     accuracy = pairwise_separability(store, min_games=250, n_components=50)
+###     accuracy.loc['Konevlad', 'AdriD']          # the matrix is symmetric, with NaN on the diagonal
+###     accuracy.attrs['timing']                   # see below
+###
+### The (pair, fold) fits are spread over a pool of processes. Each player's rows are split into n_splits folds once,
+### so fold k of a pair is the two players' fold k (stratified by construction), and the scaler and PCA of every
+### (pair, fold) are worked out from per-player, per-fold sums (row count, sum and X^T X of each fold) computed once
+### when a worker starts, instead of from the rows. Only the SVC is fit for each (pair, fold).
+###
+### attrs['timing'] has
+###     total_seconds, evaluate_seconds : the whole run, and the part spent on the (pair, fold) fits
+###     preprocess_seconds : the longest any worker took to load the rows and work out the fold sums
+###     fit_seconds : the time spent in SVC.fit, over every worker
+###     pairs, fits, workers, fits_per_second
+### and attrs['dropped_rows'] the number of rows left out for having missing values (the notebook's dropna()).
+
+import itertools
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from sklearn.svm import SVC
+
+from feature_table import FeatureStore
+
+## Added to the features as they are, after the scaling and PCA (like the notebook does)
+OPENING_COLUMNS = ['A', 'B', 'C', 'D', 'E', 'A#', 'B#', 'C#', 'D#', 'E#']
+
+## The rows of one player split into folds, and the count, sum and X^T X of the rows of each fold
+class PlayerFolds:
+    def __init__(self, X, openings, n_splits, rng):
+        self.X = X
+        self.openings = openings
+        self.fold = rng.permutation(len(X)) % n_splits
+        self.counts = np.bincount(self.fold, minlength=n_splits)
+        self.sums = np.array([X[self.fold == k].sum(axis=0) for k in range(n_splits)])
+        self.products = np.array([X[self.fold == k].T @ X[self.fold == k] for k in range(n_splits)])
+
+    ## (count, sum, X^T X) of the rows outside fold k
+    def train_sums(self, k):
+        return (self.counts.sum() - self.counts[k], self.sums.sum(axis=0) - self.sums[k],
+                self.products.sum(axis=0) - self.products[k])
+
+## The (mean, projection) of the train rows of fold k of a pair: the features of a row are (x - mean) @ projection,
+## which is StandardScaler, then PCA with n_components (if given) fit on those rows
+def fold_preprocessing(a, b, k, n_components=None):
+    n, total, products = [x + y for x, y in zip(a.train_sums(k), b.train_sums(k))]
+    mean = total / n
+    covariance = products / n - np.outer(mean, mean)
+    scale = np.sqrt(np.maximum(np.diag(covariance), 0))
+    # (constant features are left unscaled, like StandardScaler)
+    scale[scale < 10 * np.finfo(np.float64).eps] = 1
+    if not n_components:
+        return mean, np.diag(1 / scale)
+    # the principal components of the scaled rows are the top eigenvectors of their covariance
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance / np.outer(scale, scale))
+    components = eigenvectors[:, ::-1][:, :n_components]
+    return mean, components / scale[:, None]
+
+## The worker's data, set up once per process by _init_worker
+_WORKER = {}
+
+def _init_worker(store_path, players, scaled_columns, opening_columns, n_splits, seed, n_components, C):
+    start = time.perf_counter()
+    store = FeatureStore(store_path)
+    folds = []
+    dropped = 0
+    for i, player in enumerate(players):
+        X = np.asarray(store.select([player], scaled_columns), dtype=np.float64)
+        openings = np.asarray(store.select([player], opening_columns), dtype=np.float64)
+        complete = ~(np.isnan(X).any(axis=1) | np.isnan(openings).any(axis=1))
+        dropped += int((~complete).sum())
+        # (seeded by the player, so every worker splits a player's rows the same way)
+        folds.append(PlayerFolds(X[complete], openings[complete], n_splits, np.random.default_rng([seed, i])))
+    _WORKER.update(folds=folds, n_components=n_components, C=C, dropped=dropped,
+                   setup_seconds=time.perf_counter() - start)
+
+## Fits and scores fold k of the pair (i, j), returns (i, j, correct, total, fit_seconds, setup_seconds)
+## (setup_seconds is the worker's set up time with its first result, 0 after that)
+def _evaluate(task):
+    i, j, k = task
+    a, b = _WORKER['folds'][i], _WORKER['folds'][j]
+    mean, projection = fold_preprocessing(a, b, k, _WORKER['n_components'])
+
+    def features(player, train):
+        rows = (player.fold != k) if train else (player.fold == k)
+        return np.hstack([(player.X[rows] - mean) @ projection, player.openings[rows]])
+
+    X_train = np.vstack([features(a, True), features(b, True)])
+    y_train = np.r_[np.zeros(a.counts.sum() - a.counts[k]), np.ones(b.counts.sum() - b.counts[k])]
+    X_test = np.vstack([features(a, False), features(b, False)])
+    y_test = np.r_[np.zeros(a.counts[k]), np.ones(b.counts[k])]
+
+    start = time.perf_counter()
+    svc = SVC(kernel='rbf', C=_WORKER['C']).fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    correct = int((svc.predict(X_test) == y_test).sum())
+    setup_seconds = _WORKER.pop('setup_seconds', 0)
+    return i, j, correct, len(y_test), fit_seconds, setup_seconds
+
+## input: store : a FeatureStore (or the path of one)
+##        players : the players to compare (every player of the store with at least min_games rows by default)
+##        columns : the features to use (all of them by default), the OPENING_COLUMNS among them aren't scaled
+##        n_splits : folds of the cross validation
+##        n_components : PCA components after the scaler (None for no PCA, like the notebook's loop)
+##        C : the SVC's C
+##        workers : number of processes (None uses every core, 1 runs everything in this process)
+## output: DataFrame of the accuracy of every pair of players (see above)
+def pairwise_separability(store, players=None, columns=None, n_splits=10, n_components=None, C=1.0, min_games=0,
+                          workers=None, seed=0, verbose=False):
+    start = time.perf_counter()
+    if isinstance(store, str):
+        store = FeatureStore(store)
+    if players is None:
+        players = [player for player, runs in store.segments().items()
+                   if sum(stop - begin for begin, stop in runs) >= min_games]
+    columns = store.columns if columns is None else columns
+    scaled_columns = [column for column in columns if column not in OPENING_COLUMNS]
+    opening_columns = [column for column in columns if column in OPENING_COLUMNS]
+    n_components = min(n_components, len(scaled_columns)) if n_components else None
+    initargs = (store.path, list(players), scaled_columns, opening_columns, n_splits, seed, n_components, C)
+    tasks = [(i, j, k) for i, j in itertools.combinations(range(len(players)), 2) for k in range(n_splits)]
+
+    correct = np.zeros((len(players), len(players)))
+    total = np.zeros((len(players), len(players)))
+    fit_seconds = setup_seconds = 0
+    evaluate_start = time.perf_counter()
+    if workers == 1:
+        _init_worker(*initargs)
+        results = map(_evaluate, tasks)
+        dropped = _WORKER['dropped']
+    else:
+        workers = workers or os.cpu_count()
+        pool = Pool(workers, initializer=_init_worker, initargs=initargs)
+        results = pool.imap_unordered(_evaluate, tasks, chunksize=max(1, len(tasks) // (8 * workers)))
+        dropped = None
+    try:
+        for i, j, n_correct, n_test, fit_time, setup_time in results:
+            correct[i, j] += n_correct
+            total[i, j] += n_test
+            fit_seconds += fit_time
+            setup_seconds = max(setup_seconds, setup_time)
+    finally:
+        if workers != 1:
+            pool.close()
+            pool.join()
+    evaluate_seconds = time.perf_counter() - evaluate_start
+    if dropped is None:
+        # (the workers all dropped the same rows, counted here once)
+        dropped = sum(int(np.isnan(store.select([player], columns)).any(axis=1).sum()) for player in players)
+
+    with np.errstate(invalid='ignore'):
+        accuracy = (correct + correct.T) / (total + total.T)
+    np.fill_diagonal(accuracy, np.nan)
+    df = pd.DataFrame(accuracy, index=list(players), columns=list(players))
+    df.attrs['timing'] = {'total_seconds': time.perf_counter() - start, 'evaluate_seconds': evaluate_seconds,
+                          'preprocess_seconds': setup_seconds, 'fit_seconds': fit_seconds,
+                          'pairs': len(tasks) // n_splits, 'fits': len(tasks), 'workers': workers or 1,
+                          'fits_per_second': len(tasks) / max(evaluate_seconds, 1e-9)}
+    df.attrs['dropped_rows'] = dropped
+    if verbose:
+        timing = df.attrs['timing']
+        print('%d pairs, %d fits on %d workers in %.1fs (%.1f fits/s, %.1fs in SVC.fit, %.2fs preprocessing)'
+              % (timing['pairs'], timing['fits'], timing['workers'], timing['total_seconds'], timing['fits_per_second'],
+                 timing['fit_seconds'], timing['preprocess_seconds']))
+    return df
@@ -0,0 +1,154 @@
+########################################
+### Out-of-core training
+########################################
+
+### Summary.ipynb pd.concats every player's DataFrame and fits StandardScaler -> PCA -> SVC on the whole matrix in memory.
+### StreamingPipeline trains the same kind of model from a FeatureStore (see feature_table.py) one minibatch at a time,
+### so the memory it uses depends on the batch and block sizes, not on the size of the store:
+###     StandardScaler.partial_fit : the running mean and variance of each feature, one pass over the rows
+###     IncrementalPCA.partial_fit : one pass over the scaled rows
+###     SGDClassifier.partial_fit : a linear SVM (hinge loss), epochs passes over the rows
+###
+### ex. store = FeatureStore('features.store')
+###     model = StreamingPipeline(n_components=50).fit(store, players=['Konevlad', 'AdriD', 'Abik02'])
+###     model.score(store)                       # accuracy on the test rows of those players
+###     model.predict(store.select(['AdriD']))
+###
+###     for X, y in iter_minibatches(store, players, batch_size=1024): ...   # for other incremental models
+###
+### Rows are split into train and test by a hash of their game_id (test_fraction of the games are test rows), so every
+### pass sees the same split without keeping a list of the rows.
+### Missing values (see functions.FEATURE_SCHEMA) are left out of the scaler's statistics and then filled in with the
+### feature's mean (0 once scaled), rather than dropping the whole row like the notebook's dropna().
+
+import zlib
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+
+## Boolean mask of the rows whose game_id hashes into the test side
+def test_rows(game_ids, test_fraction):
+    hashes = np.array([zlib.crc32(game_id) for game_id in np.asarray(game_ids).tolist()], dtype=np.uint64)
+    return hashes < test_fraction * 2 ** 32
+
+## Generator of (X, y) minibatches of a FeatureStore: X a float32 (rows x features) array with NaN for missing values,
+## y the player of each row
+## input: players : only the rows of these players (all of them by default)
+##        columns : only these features (all of them by default)
+##        batch_size : rows per minibatch (the last minibatch has up to twice as many, so none is left tiny)
+##        block_size : rows read from the store at a time. With shuffle, the blocks are read in a random order and the
+##                     rows of each block are shuffled, so the store is still read in large sequential pieces.
+##        subset : 'train' or 'test' for only those rows (see test_rows), None for every row
+## At most a block and two minibatches are in memory at a time.
+def iter_minibatches(store, players=None, columns=None, batch_size=4096, block_size=65536, shuffle=True, seed=0,
+                     subset=None, test_fraction=0.2):
+    rng = np.random.default_rng(seed)
+    codes = None if players is None else [store.player_codes[player] for player in players if player in store.player_codes]
+    names = np.array(store.players, dtype=object)
+    positions = slice(None) if columns is None else store.column_positions(columns)
+    starts = np.arange(0, len(store), block_size)
+    if shuffle:
+        rng.shuffle(starts)
+
+    pending_X, pending_y, n_pending = [], [], 0
+    previous = None
+    for start in starts:
+        stop = min(start + block_size, len(store))
+        player = np.asarray(store.player[start:stop])
+        keep = np.ones(stop - start, dtype=bool) if codes is None else np.isin(player, codes)
+        if subset is not None:
+            test = test_rows(store.game_ids[start:stop], test_fraction)
+            keep &= test if subset == 'test' else ~test
+        rows = np.flatnonzero(keep)
+        if shuffle:
+            rng.shuffle(rows)
+        block = store.matrix[start:stop]
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            pending_X.append(np.asarray(block[batch][:, positions], dtype=np.float32))
+            pending_y.append(names[player[batch]])
+            n_pending += len(batch)
+            if n_pending >= batch_size:
+                # (held back one minibatch, so the leftover rows at the end can go with the last one)
+                if previous is not None:
+                    yield previous
+                previous = np.concatenate(pending_X), np.concatenate(pending_y)
+                pending_X, pending_y, n_pending = [], [], 0
+    if n_pending:
+        if previous is not None:
+            pending_X.insert(0, previous[0])
+            pending_y.insert(0, previous[1])
+        previous = np.concatenate(pending_X), np.concatenate(pending_y)
+    if previous is not None:
+        yield previous
+
+class StreamingPipeline:
+    ## classifier_options : passed on to SGDClassifier (ex. alpha, or loss='log_loss' for predict_proba)
+    ## IncrementalPCA needs at least n_components rows in every minibatch, so batch_size can't be smaller than n_components
+    def __init__(self, n_components=50, batch_size=4096, block_size=65536, epochs=5, test_fraction=0.2, seed=0,
+                 **classifier_options):
+        if batch_size < n_components:
+            raise ValueError('batch_size (%d) must be at least n_components (%d)' % (batch_size, n_components))
+        self.n_components = n_components
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.epochs = epochs
+        self.test_fraction = test_fraction
+        self.seed = seed
+        self.columns = None
+        self.classes = None
+        self.scaler = StandardScaler()
+        self.pca = IncrementalPCA(n_components=n_components)
+        self.classifier = SGDClassifier(**dict({'loss': 'hinge', 'random_state': seed}, **classifier_options))
+
+    def batches(self, store, players=None, subset='train', shuffle=True, seed=None):
+        return iter_minibatches(store, players, self.columns, self.batch_size, self.block_size, shuffle,
+                                self.seed if seed is None else seed, subset, self.test_fraction)
+
+    ## Fits the scaler, the PCA and then the classifier on the train rows of players (every player by default)
+    ## columns : the features to train on (all of them by default)
+    ## Raises ValueError if there are fewer features, or train rows, than n_components
+    def fit(self, store, players=None, columns=None):
+        self.columns = columns
+        players = store.players if players is None else players
+        self.classes = np.array(sorted(player for player in players if store.segments().get(player)), dtype=object)
+        n_features = len(store.columns if columns is None else columns)
+        if n_features < self.n_components:
+            raise ValueError('n_components (%d) is more than the %d features' % (self.n_components, n_features))
+
+        n_rows = 0
+        for X, y in self.batches(store, players, shuffle=False):
+            self.scaler.partial_fit(X)
+            n_rows += len(X)
+        # (with fewer rows than batch_size there is a single, smaller, minibatch)
+        if n_rows < self.n_components:
+            raise ValueError('n_components (%d) is more than the %d train rows' % (self.n_components, n_rows))
+        for X, y in self.batches(store, players, shuffle=False):
+            self.pca.partial_fit(self._scale(X))
+        for epoch in range(self.epochs):
+            for X, y in self.batches(store, players, seed=self.seed + epoch):
+                self.classifier.partial_fit(self.pca.transform(self._scale(X)), y, classes=self.classes)
+        return self
+
+    ## The scaled features, with the missing values at the mean
+    def _scale(self, X):
+        X = self.scaler.transform(X)
+        X[np.isnan(X)] = 0
+        return X
+
+    def transform(self, X):
+        return self.pca.transform(self._scale(np.asarray(X, dtype=np.float32)))
+
+    def predict(self, X):
+        return self.classifier.predict(self.transform(X))
+
+    ## Accuracy on the subset ('test' by default) of the rows of players (the players it was fit on by default)
+    def score(self, store, players=None, subset='test'):
+        players = self.classes if players is None else players
+        correct = total = 0
+        for X, y in self.batches(store, players, subset, shuffle=False):
+            correct += int((self.predict(X) == y).sum())
+            total += len(y)
+        return correct / max(1, total)